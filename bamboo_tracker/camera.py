@@ -0,0 +1,186 @@
+# Camera frame pipeline for the Bambu tracker.
+#
+# The latest JPEG from Home Assistant's camera_proxy is kept in memory and
+# served by snapshot() with an ETag, so clients polling an unchanged frame
+# get a 304, and by stream() as an MJPEG multipart stream. Frames with the
+# same content hash as the last one are dropped, which is most of them for
+# an idle printer.
+#
+# Frames are fetched every CAMERA_INTERVAL seconds while anyone is watching,
+# meaning a stream is open or a snapshot was requested in the last
+# CAMERA_IDLE_AFTER seconds, and every CAMERA_IDLE_INTERVAL seconds
+# otherwise. The first request after an idle spell waits briefly for a
+# fresh frame instead of getting an old one.
+#
+# Set CAMERA_SAVE to also write each new frame to NAME/pic.jpg, atomically
+# with a rename so readers never see a partial file.
+
+import os
+import time
+import asyncio
+import hashlib
+import logging
+
+from aiohttp import web
+
+INTERVAL = float(os.environ.get('CAMERA_INTERVAL', 1))
+IDLE_INTERVAL = float(os.environ.get('CAMERA_IDLE_INTERVAL', 60))
+IDLE_AFTER = float(os.environ.get('CAMERA_IDLE_AFTER', 120))
+SAVE = os.environ.get('CAMERA_SAVE')
+
+FRESH_WAIT = 3
+KEEPALIVE = 10
+BOUNDARY = 'frame'
+
+
+def write_atomic(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class Camera:
+    def __init__(self, fetch, path=None):
+        # fetch is a coroutine function returning the JPEG bytes
+        self.fetch = fetch
+        self.path = path
+        self.frame = None
+        self.etag = None
+        self.fetched_at = 0
+        self.viewers = 0
+        self.last_viewed = 0
+        self.wakeup = None
+        self.new_frame = None
+        self.fetched = None
+        self.stats = dict(fetched=0, unchanged=0, errors=0, saved=0, served=0, not_modified=0, streamed=0)
+
+    def watched(self):
+        return self.viewers > 0 or time.monotonic() - self.last_viewed < IDLE_AFTER
+
+    def set(self, frame):
+        # returns True if the frame is new
+        self.fetched_at = time.monotonic()
+
+        etag = '"{}"'.format(hashlib.sha1(frame).hexdigest())
+        if etag == self.etag:
+            self.stats['unchanged'] += 1
+            return False
+
+        self.frame = frame
+        self.etag = etag
+
+        # wake streams, each waits on the event current when it last sent
+        self.new_frame.set()
+        self.new_frame = asyncio.Event()
+        return True
+
+    async def save(self, frame):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, write_atomic, self.path, frame)
+        self.stats['saved'] += 1
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        self.new_frame = asyncio.Event()
+        self.fetched = asyncio.Event()
+
+        while True:
+            try:
+                logging.debug('Getting camera frame...')
+                frame = await self.fetch()
+                self.stats['fetched'] += 1
+
+                if self.set(frame) and self.path:
+                    await self.save(frame)
+                    logging.debug('Saved snapshot.')
+            except KeyboardInterrupt:
+                break
+            except BaseException as e:
+                self.stats['errors'] += 1
+                logging.error('Problem getting camera frame: %s', e)
+
+            self.fetched.set()
+            self.fetched = asyncio.Event()
+
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), INTERVAL if self.watched() else IDLE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def latest(self):
+        # marks the camera as watched, and if the frame is stale because it
+        # wasn't, waits for the next fetch
+        self.last_viewed = time.monotonic()
+
+        if self.wakeup and time.monotonic() - self.fetched_at > INTERVAL * 2:
+            fetched = self.fetched
+            self.wakeup.set()
+            try:
+                await asyncio.wait_for(fetched.wait(), FRESH_WAIT)
+            except asyncio.TimeoutError:
+                pass
+
+        return self.frame
+
+    async def snapshot(self, request):
+        frame = await self.latest()
+        if frame is None:
+            raise web.HTTPServiceUnavailable(text='No camera frame yet')
+
+        headers = {'ETag': self.etag, 'Cache-Control': 'no-cache'}
+
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+            if '*' in tags or self.etag in tags:
+                self.stats['not_modified'] += 1
+                return web.Response(status=304, headers=headers)
+
+        self.stats['served'] += 1
+        return web.Response(body=frame, content_type='image/jpeg', headers=headers)
+
+    async def stream(self, request):
+        response = web.StreamResponse(headers={
+            'Content-Type': 'multipart/x-mixed-replace; boundary=' + BOUNDARY,
+            'Cache-Control': 'no-cache',
+        })
+        await response.prepare(request)
+
+        self.viewers += 1
+        logging.info('Camera stream opened, %s viewers', self.viewers)
+
+        try:
+            sent = None
+            await self.latest()
+
+            while True:
+                # slow clients skip straight to the newest frame
+                new_frame = self.new_frame
+                if self.frame is not None and self.frame is not sent:
+                    sent = self.frame
+                    part = '--{}\r\nContent-Type: image/jpeg\r\nContent-Length: {}\r\n\r\n'.format(BOUNDARY, len(sent))
+                    await response.write(part.encode() + sent + b'\r\n')
+                    self.stats['streamed'] += 1
+
+                # resend the same frame now and then, so a stream of an idle
+                # printer notices when its client has gone
+                try:
+                    await asyncio.wait_for(new_frame.wait(), KEEPALIVE)
+                except asyncio.TimeoutError:
+                    sent = None
+        except ConnectionResetError:
+            pass
+        finally:
+            self.viewers -= 1
+            self.last_viewed = time.monotonic()
+            logging.info('Camera stream closed, %s viewers', self.viewers)
+
+        return response
+
+    def log_stats(self):
+        s = self.stats
+        logging.info('Camera stats: %s fetched, %s unchanged, %s errors, %s saved, %s served, %s not modified, %s streamed, %s viewers',
+            s['fetched'], s['unchanged'], s['errors'], s['saved'], s['served'], s['not_modified'], s['streamed'], self.viewers)
@@ -11,15 +11,18 @@ logging.getLogger('aiohttp').setLevel(logging.DEBUG if DEBUG else logging.WARNIN
 logging.info('Boot up...')
 
 import time
-import json
 import asyncio
-import aiohttp
-import aiofiles
 from aiohttp import web
 import sys
 import ssl
 
 import secrets
+import camera
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import http_client
+from common import printers
+from common.outbox import Outbox, DIRECTORY
 
 app = web.Application()
 
@@ -36,116 +39,30 @@ if len(sys.argv) != 4:
 _, NAME, SERIAL, LISTEN_PORT = sys.argv
 SERIAL = SERIAL.lower()
 
-printer = dict(
-    info=dict(),
-    temperature=dict(),
-)
+# status can come from printer_poller instead, leaving only the camera here
+CAMERA_ONLY = os.environ.get('CAMERA_ONLY')
 
-async def printer_status():
-    while True:
-        sleep_time = 5 if DEBUG else 60
-        await asyncio.sleep(sleep_time)
-
-        try:
-            headers = {'Authorization': 'Bearer ' + secrets.HOMEASSISTANT_TOKEN}
-            url = secrets.HOMEASSISTANT_URL + '/api/states'
-            async with aiohttp.ClientSession() as session:
-                res = await session.get(url, headers=headers, timeout=10, ssl=sslcontext)
-                res.raise_for_status()
-                res = await res.json()
-        except KeyboardInterrupt:
-            break
-        except BaseException as e:
-            printer['info']['online'] = False
-            logging.error('Problem getting status from Home Assistant URL %s:', url)
-            logging.exception(e)
-
-        entities = [
-            f'sensor.p1s_{SERIAL}_print_status',
-            f'sensor.p1s_{SERIAL}_print_progress',
-            f'sensor.p1s_{SERIAL}_current_layer',
-            f'sensor.p1s_{SERIAL}_total_layer_count',
-            f'sensor.p1s_{SERIAL}_remaining_time',
-            f'sensor.p1s_{SERIAL}_bed_temperature',
-            f'sensor.p1s_{SERIAL}_bed_target_temperature',
-            f'sensor.p1s_{SERIAL}_nozzle_temperature',
-            f'sensor.p1s_{SERIAL}_nozzle_target_temperature',
-        ]
-        status = {}
-
-        for entry in res:
-            if entry['entity_id'] in entities:
-                status[entry['entity_id'].split('_',2)[2]] = entry['state']
-
-        logging.debug('Status data:\n%s', json.dumps(status, indent=4))
-
-        if not status:
-            raise Exception('Status empty, do you have the correct serial number?')
-
-        # massage data into old integration format
-        printer['info']['online'] = True
-        printer['info']['gcode_state'] = status['print_status'].upper()
-        printer['info']['current_layer'] = status['current_layer']
-        printer['info']['total_layers'] = status['total_layer_count']
-        printer['info']['print_percentage'] = status['print_progress']
-        printer['info']['remaining_time'] = status['remaining_time']
-
-        printer['temperature']['bed_temp'] = status['bed_temperature']
-        printer['temperature']['target_bed_temp'] = status['bed_target_temperature']
-        printer['temperature']['nozzle_temp'] = status['nozzle_temperature']
-        printer['temperature']['target_nozzle_temp'] = status['nozzle_target_temperature']
-
-        logging.info('Sending to portal...')
-        logging.debug('JSON data:\n%s', json.dumps(printer, indent=4))
-
-        try:
-            url = 'https://api.my.protospace.ca/stats/{}/printer3d/'.format(NAME)
-            async with aiohttp.ClientSession() as session:
-                await session.post(url, json=printer, timeout=10)
-        except KeyboardInterrupt:
-            break
-        except BaseException as e:
-            logging.error('Problem sending printer data to portal %s:', url)
-            logging.exception(e)
-
-        try:
-            url = 'https://api.spaceport.dns.t0.vc/stats/{}/printer3d/'.format(NAME)
-            async with aiohttp.ClientSession() as session:
-                await session.post(url, json=printer, timeout=10)
-        except KeyboardInterrupt:
-            break
-        except BaseException as e:
-            logging.info('Problem sending printer data to dev portal %s:', url)
-
-        logging.debug('Done sending.')
-
-
-
-async def printer_camera():
-    while True:
-        await asyncio.sleep(1)
+# one outbox per printer, several trackers can run from this directory
+outbox = Outbox(path=os.environ.get('OUTBOX_PATH', os.path.join(DIRECTORY, 'outbox_{}.db'.format(NAME))))
 
-        try:
-            logging.debug('Getting camera frame...')
+# 'poll' fetches /api/states every minute, 'websocket' subscribes to changes
+MODE = os.environ.get('HOMEASSISTANT_MODE', 'poll')
 
-            headers = {'Authorization': 'Bearer ' + secrets.HOMEASSISTANT_TOKEN}
-            url = secrets.HOMEASSISTANT_URL + f'/api/camera_proxy/camera.p1s_{SERIAL}_camera'
-            async with aiohttp.ClientSession() as session:
-                res = await session.get(url, headers=headers, timeout=10, ssl=sslcontext)
-                res.raise_for_status()
+uploader = printers.StatusUploader([printers.BambuPrinter(NAME, SERIAL)], outbox,
+    secrets.HOMEASSISTANT_URL, secrets.HOMEASSISTANT_TOKEN, ssl=sslcontext)
 
-                f = await aiofiles.open(NAME + '/pic.jpg', mode='wb')
-                try:
-                    await f.write(await res.read())
-                finally:
-                    await f.close()
 
-            logging.debug('Saved snapshot.')
-        except KeyboardInterrupt:
-            break
-        except BaseException as e:
-            logging.error('Problem getting camera frame from Home Assistant URL %s:', url)
-            logging.exception(e)
+async def fetch_frame():
+    headers = {'Authorization': 'Bearer ' + secrets.HOMEASSISTANT_TOKEN}
+    url = secrets.HOMEASSISTANT_URL + f'/api/camera_proxy/camera.p1s_{SERIAL}_camera'
+    return await http_client.get(url, read='bytes', headers=headers, ssl=sslcontext)
+
+printer_camera = camera.Camera(fetch_frame, path=os.path.join(NAME, 'pic.jpg') if camera.SAVE else None)
+
+async def camera_stats():
+    while True:
+        await asyncio.sleep(300)
+        printer_camera.log_stats()
 
 
 async def index(request):
@@ -153,6 +70,10 @@ async def index(request):
 
 async def main():
     app.router.add_get('/', index)
+    app.router.add_get('/' + NAME + '/pic.jpg', printer_camera.snapshot)
+    app.router.add_get('/' + NAME + '/stream.mjpg', printer_camera.stream)
+    # anything else in the printer's directory, after the routes above so
+    # they take precedence over a saved pic.jpg
     app.add_routes([web.static('/' + NAME, NAME)])
 
     runner = web.AppRunner(app)
@@ -169,8 +90,11 @@ def task_died(future):
     exit()
 
 loop = asyncio.get_event_loop()
-loop.create_task(printer_status()).add_done_callback(task_died)
-loop.create_task(printer_camera()).add_done_callback(task_died)
+if not CAMERA_ONLY:
+    status_task = uploader.watch() if MODE == 'websocket' else uploader.poll(5 if DEBUG else 60)
+    loop.create_task(status_task).add_done_callback(task_died)
+loop.create_task(printer_camera.run()).add_done_callback(task_died)
+loop.create_task(camera_stats())
 loop.create_task(main())
 loop.run_forever()
 
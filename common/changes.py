@@ -0,0 +1,85 @@
+# Change detection for uploads that repeat the same payload every cycle.
+#
+# check() hashes the normalized payload for each target, usually the URL,
+# and returns None when it matches the last one sent there, so an idle
+# printer isn't uploaded every minute. Unchanged payloads are still sent
+# every CHANGES_HEARTBEAT seconds so the portal sees the bridge is alive.
+#
+# With delta=True, changed payloads are cut down to the fields that
+# differ from the last upload to that target. Heartbeats and first uploads
+# are always sent in full. Only use it for endpoints that merge partial
+# updates.
+#
+# Tunable with the CHANGES_HEARTBEAT and CHANGES_DELTA environment
+# variables.
+
+import os
+import json
+import time
+import hashlib
+import logging
+
+HEARTBEAT = float(os.environ.get('CHANGES_HEARTBEAT', 600))
+DELTA = bool(os.environ.get('CHANGES_DELTA'))
+
+
+def normalize(data):
+    return json.dumps(data, sort_keys=True, separators=(',', ':'), default=str)
+
+def digest(data):
+    return hashlib.sha1(normalize(data).encode()).hexdigest()
+
+def diff(old, new):
+    # fields of new that differ from old, recursing into dicts
+    result = {}
+    for key, value in new.items():
+        if key not in old:
+            result[key] = value
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            changed = diff(old[key], value)
+            if changed:
+                result[key] = changed
+        elif normalize(value) != normalize(old[key]):
+            result[key] = value
+    return result
+
+
+class ChangeDetector:
+    def __init__(self, heartbeat=HEARTBEAT, delta=DELTA):
+        self.heartbeat = heartbeat
+        self.delta = delta
+        self.last = {}   # target -> (hash, time sent, time sent in full, payload if delta)
+        self.stats = dict(sent=0, heartbeats=0, deltas=0, suppressed=0)
+
+    def check(self, target, data):
+        # returns the payload to upload to target, or None to skip it
+        now = time.monotonic()
+        hashed = digest(data)
+        last = self.last.get(target)
+        full = now
+
+        if last and last[0] == hashed:
+            if now - last[1] < self.heartbeat:
+                self.stats['suppressed'] += 1
+                return None
+            self.stats['heartbeats'] += 1
+            result = data
+        elif last and self.delta and now - last[2] < self.heartbeat:
+            self.stats['deltas'] += 1
+            result = diff(last[3], data)
+            full = last[2]
+        else:
+            result = data
+
+        self.stats['sent'] += 1
+        self.last[target] = (hashed, now, full, json.loads(normalize(data)) if self.delta else None)
+        return result
+
+    def forget(self, target):
+        # call if an upload failed so the next check() sends in full
+        self.last.pop(target, None)
+
+    def log_stats(self):
+        s = self.stats
+        logging.info('Change stats: %s sent, %s heartbeats, %s deltas, %s suppressed',
+            s['sent'], s['heartbeats'], s['deltas'], s['suppressed'])
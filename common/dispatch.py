@@ -0,0 +1,155 @@
+# Bounded worker pool for handling incoming messages.
+#
+# Messages are hashed by key (the MQTT topic) onto a fixed number of
+# workers, each with its own bounded queue, so messages with the same key
+# are handled one at a time in the order they arrived while different keys
+# run concurrently. What happens when a queue is full is set by the policy:
+#
+#   block        put() waits for room, pushing back on the reader
+#   drop-oldest  the oldest queued message of that worker is discarded
+#   coalesce     a message replaces any still queued one with the same key,
+#                otherwise behaves like drop-oldest
+#
+# Tunable with the DISPATCH_WORKERS, DISPATCH_QUEUE_SIZE and DISPATCH_POLICY
+# environment variables.
+
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+
+WORKERS = int(os.environ.get('DISPATCH_WORKERS', 8))
+QUEUE_SIZE = int(os.environ.get('DISPATCH_QUEUE_SIZE', 1000))
+POLICY = os.environ.get('DISPATCH_POLICY', 'block')
+
+POLICIES = ['block', 'drop-oldest', 'coalesce']
+
+
+class Shard:
+    def __init__(self, size):
+        self.size = size
+        self.keys = deque()
+        self.items = {}   # coalesce only: key -> (message, queued time)
+        self.queue = deque()   # other policies: (key, message, queued time)
+        self.not_empty = asyncio.Event()
+        self.not_full = asyncio.Event()
+        self.not_full.set()
+
+    def __len__(self):
+        return len(self.keys) + len(self.queue)
+
+    def pop(self):
+        if self.keys:
+            key = self.keys.popleft()
+            message, queued = self.items.pop(key)
+            return key, message, queued
+        return self.queue.popleft()
+
+
+class Dispatcher:
+    def __init__(self, handler, workers=WORKERS, queue_size=QUEUE_SIZE, policy=POLICY):
+        # handler is a coroutine function taking one message
+        if policy not in POLICIES:
+            raise ValueError('Unknown dispatch policy: {}'.format(policy))
+
+        self.handler = handler
+        self.workers = workers
+        self.queue_size = queue_size
+        self.policy = policy
+        self.shards = []
+        self.tasks = []
+        self.stats = dict(
+            queued=0,
+            handled=0,
+            errors=0,
+            dropped=0,
+            coalesced=0,
+            max_depth=0,
+            wait_total=0.0,
+            wait_max=0.0,
+            latency_total=0.0,
+            latency_max=0.0,
+        )
+
+    def start(self):
+        # must be called from inside the running event loop
+        size = max(1, self.queue_size // self.workers)
+        self.shards = [Shard(size) for _ in range(self.workers)]
+        self.tasks = [asyncio.ensure_future(self.work(shard)) for shard in self.shards]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def depth(self):
+        return sum(len(shard) for shard in self.shards)
+
+    async def put(self, key, message):
+        shard = self.shards[hash(key) % len(self.shards)]
+        now = time.monotonic()
+
+        if self.policy == 'coalesce' and key in shard.items:
+            queued = shard.items[key][1]
+            shard.items[key] = (message, queued)
+            self.stats['coalesced'] += 1
+            return
+
+        if self.policy == 'block':
+            while len(shard) >= shard.size:
+                shard.not_full.clear()
+                await shard.not_full.wait()
+        elif len(shard) >= shard.size:
+            shard.pop()
+            self.stats['dropped'] += 1
+
+        if self.policy == 'coalesce':
+            shard.keys.append(key)
+            shard.items[key] = (message, now)
+        else:
+            shard.queue.append((key, message, now))
+
+        shard.not_empty.set()
+        self.stats['queued'] += 1
+        self.stats['max_depth'] = max(self.stats['max_depth'], self.depth())
+
+    async def work(self, shard):
+        while True:
+            while not len(shard):
+                shard.not_empty.clear()
+                await shard.not_empty.wait()
+
+            key, message, queued = shard.pop()
+            shard.not_full.set()
+
+            start = time.monotonic()
+            wait = start - queued
+            self.stats['wait_total'] += wait
+            self.stats['wait_max'] = max(self.stats['wait_max'], wait)
+
+            try:
+                await self.handler(message)
+            except Exception as e:
+                self.stats['errors'] += 1
+                logging.error('Problem handling message for %s:', key)
+                logging.exception(e)
+            finally:
+                latency = time.monotonic() - start
+                self.stats['handled'] += 1
+                self.stats['latency_total'] += latency
+                self.stats['latency_max'] = max(self.stats['latency_max'], latency)
+
+    def get_stats(self):
+        result = dict(self.stats, depth=self.depth())
+        count = self.stats['handled']
+        result['wait_avg'] = self.stats['wait_total'] / count if count else 0.0
+        result['latency_avg'] = self.stats['latency_total'] / count if count else 0.0
+        return result
+
+    def log_stats(self):
+        s = self.get_stats()
+        logging.info('Dispatch stats: depth %s (max %s), %s handled, %s errors, %s dropped, %s coalesced, wait avg %.3fs max %.3fs, handler avg %.3fs max %.3fs',
+            s['depth'], s['max_depth'], s['handled'], s['errors'], s['dropped'], s['coalesced'],
+            s['wait_avg'], s['wait_max'], s['latency_avg'], s['latency_max'])
@@ -0,0 +1,151 @@
+# Event-driven alternative to polling Home Assistant's /api/states.
+#
+# EntityWatcher opens the WebSocket API and subscribes to only the entities
+# a bridge cares about with subscribe_entities. Home Assistant sends their
+# current states once, then a small diff whenever one changes, so updates
+# arrive within a second and nothing else in Home Assistant is transferred.
+#
+# The callback is given the {entity_id: state} dict whenever a state value
+# changes. Attribute-only changes are ignored. Changes arriving within
+# HOMEASSISTANT_DEBOUNCE seconds of each other are sent as one callback, so
+# a burst like a print finishing doesn't become a burst of uploads. The
+# watcher reconnects with backoff and the subscription resends every state,
+# so nothing is missed while disconnected.
+
+import os
+import random
+import asyncio
+import logging
+
+import aiohttp
+
+from . import http_client
+
+DEBOUNCE = float(os.environ.get('HOMEASSISTANT_DEBOUNCE', 2))
+HEARTBEAT = 30
+MAX_BACKOFF = 60
+
+
+class AuthError(Exception):
+    pass
+
+
+class EntityWatcher:
+    def __init__(self, url, token, entities, callback, debounce=DEBOUNCE, ssl=None):
+        # url is the same base URL used for the REST API, like http://ha:8123
+        self.url = url.replace('http', 'ws', 1).rstrip('/') + '/api/websocket'
+        self.token = token
+        self.entities = list(entities)
+        self.callback = callback
+        self.debounce = debounce
+        self.ssl = ssl
+        self.states = {}
+        self.pending = None
+        self.connected = False
+        self.stats = dict(connects=0, events=0, changes=0, callbacks=0)
+
+    def apply(self, event):
+        # returns True if any state value changed
+        changed = False
+
+        # a: full states, sent on subscribe and for new entities
+        for entity_id, entity in event.get('a', {}).items():
+            changed |= self.set(entity_id, entity['s'])
+
+        # c: diffs, '+' holds the new values
+        for entity_id, diff in event.get('c', {}).items():
+            if 's' in diff.get('+', {}):
+                changed |= self.set(entity_id, diff['+']['s'])
+
+        # r: removed entities
+        for entity_id in event.get('r', []):
+            if self.states.pop(entity_id, None) is not None:
+                changed = True
+
+        return changed
+
+    def set(self, entity_id, state):
+        if self.states.get(entity_id) == state:
+            return False
+        self.states[entity_id] = state
+        self.stats['changes'] += 1
+        return True
+
+    async def notify(self):
+        if self.debounce:
+            await asyncio.sleep(self.debounce)
+        self.pending = None
+        self.stats['callbacks'] += 1
+
+        try:
+            await self.callback(dict(self.states))
+        except BaseException as e:
+            logging.error('Problem handling Home Assistant state change:')
+            logging.exception(e)
+
+    def changed(self):
+        if not self.pending:
+            self.pending = asyncio.ensure_future(self.notify())
+
+    async def connect(self):
+        session = http_client.get_session()
+
+        async with session.ws_connect(self.url, ssl=self.ssl, heartbeat=HEARTBEAT) as ws:
+            msg = await ws.receive_json()
+            if msg.get('type') != 'auth_required':
+                raise Exception('Unexpected Home Assistant greeting: {}'.format(msg))
+
+            await ws.send_json(dict(type='auth', access_token=self.token))
+            msg = await ws.receive_json()
+            if msg.get('type') != 'auth_ok':
+                raise AuthError(msg.get('message', msg))
+
+            await ws.send_json(dict(id=1, type='subscribe_entities', entity_ids=self.entities))
+
+            self.connected = True
+            self.stats['connects'] += 1
+            logging.info('Subscribed to %s Home Assistant entities at %s', len(self.entities), self.url)
+
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    break
+
+                msg = msg.json()
+                if msg.get('type') == 'result' and not msg.get('success'):
+                    raise Exception('Home Assistant refused subscription: {}'.format(msg.get('error')))
+                if msg.get('type') != 'event':
+                    continue
+
+                self.stats['events'] += 1
+                if self.apply(msg['event']):
+                    self.changed()
+
+    async def run(self):
+        failures = 0
+
+        while True:
+            try:
+                await self.connect()
+                failures = 0
+                logging.info('Home Assistant closed the connection, reconnecting...')
+            except KeyboardInterrupt:
+                break
+            except asyncio.CancelledError:
+                raise
+            except AuthError as e:
+                # won't fix itself, but keep trying slowly in case the token is replaced
+                logging.error('Home Assistant rejected token: %s', e)
+                failures = max(failures, 10)
+            except BaseException as e:
+                logging.error('Problem with Home Assistant connection %s: %s', self.url, e)
+            finally:
+                self.connected = False
+
+            failures += 1
+            backoff = min(MAX_BACKOFF, 2 ** failures) * random.uniform(0.5, 1)
+            await asyncio.sleep(backoff)
+
+    def log_stats(self):
+        s = self.stats
+        logging.info('Home Assistant stats: %s connects, %s events, %s changes, %s callbacks',
+            s['connects'], s['events'], s['changes'], s['callbacks'])
@@ -0,0 +1,116 @@
+# Shared outbound HTTP client for the bridges.
+#
+# Keeps one long-lived aiohttp session per process so requests to Home
+# Assistant and the portal reuse pooled keep-alive connections instead of
+# doing a fresh TCP + TLS handshake every time.
+
+import os
+import time
+import logging
+
+import aiohttp
+
+TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', 10))
+CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5))
+LIMIT = int(os.environ.get('HTTP_POOL_LIMIT', 20))
+LIMIT_PER_HOST = int(os.environ.get('HTTP_POOL_LIMIT_PER_HOST', 4))
+KEEPALIVE = float(os.environ.get('HTTP_KEEPALIVE', 60))
+DNS_CACHE_TTL = int(os.environ.get('HTTP_DNS_CACHE_TTL', 300))
+
+stats = dict(
+    requests=0,
+    errors=0,
+    connections_created=0,
+    handshakes_avoided=0,
+    latency_total=0.0,
+    latency_max=0.0,
+)
+
+_session = None
+
+
+async def on_connection_create_end(session, ctx, params):
+    stats['connections_created'] += 1
+
+async def on_connection_reuseconn(session, ctx, params):
+    stats['handshakes_avoided'] += 1
+
+
+def get_session():
+    # must be called from inside the running event loop
+    global _session
+
+    if _session is None or _session.closed:
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+
+        connector = aiohttp.TCPConnector(
+            limit=LIMIT,
+            limit_per_host=LIMIT_PER_HOST,
+            keepalive_timeout=KEEPALIVE,
+            ttl_dns_cache=DNS_CACHE_TTL,
+        )
+        timeout = aiohttp.ClientTimeout(total=TIMEOUT, sock_connect=CONNECT_TIMEOUT)
+
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=timeout,
+            trace_configs=[trace_config],
+        )
+        logging.debug('Created shared HTTP session')
+
+    return _session
+
+async def close():
+    global _session
+
+    if _session and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def request(method, url, read='json', **kwargs):
+    # Responses are always read and released back to the pool here, callers
+    # only get the decoded body. read can be 'json', 'text', 'bytes' or None.
+    start = time.monotonic()
+    stats['requests'] += 1
+
+    try:
+        async with get_session().request(method, url, **kwargs) as res:
+            res.raise_for_status()
+
+            if read == 'json':
+                return await res.json(content_type=None)
+            elif read == 'text':
+                return await res.text()
+            elif read == 'bytes':
+                return await res.read()
+            else:
+                return res.status
+    except BaseException:
+        stats['errors'] += 1
+        raise
+    finally:
+        latency = time.monotonic() - start
+        stats['latency_total'] += latency
+        stats['latency_max'] = max(stats['latency_max'], latency)
+
+async def get(url, read='json', **kwargs):
+    return await request('GET', url, read=read, **kwargs)
+
+async def post(url, read=None, **kwargs):
+    return await request('POST', url, read=read, **kwargs)
+
+
+def get_stats():
+    result = dict(stats)
+    count = stats['requests']
+    result['latency_avg'] = stats['latency_total'] / count if count else 0.0
+    return result
+
+def log_stats():
+    s = get_stats()
+    logging.info('HTTP stats: %s requests, %s errors, %s connections, %s handshakes avoided, avg %.3fs, max %.3fs',
+        s['requests'], s['errors'], s['connections_created'], s['handshakes_avoided'],
+        s['latency_avg'], s['latency_max'])
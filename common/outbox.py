@@ -0,0 +1,221 @@
+# Durable outbox for uploads to the portal.
+#
+# Instead of posting directly, bridges put() the request into a SQLite
+# database in WAL mode and a background sender delivers it. Items survive
+# restarts and outages. synchronous=NORMAL means commits are only fsynced
+# at WAL checkpoints, so bursts of puts share a sync. The sender posts up
+# to OUTBOX_BATCH items at once so a backlog drains at full speed after an
+# outage, and backs off exponentially while the portal is failing.
+#
+# With combine=True, items waiting for the same URL are sent as one JSON
+# list per request instead, for endpoints that accept lists. If the portal
+# rejects the list they're retried one at a time.
+#
+# Items put with a key replace any undelivered item with the same key, for
+# uploads where only the latest state matters. Once the outbox holds
+# OUTBOX_MAX_ITEMS the oldest items are dropped.
+#
+# The database is outbox.db next to the bridge's main.py by default.
+# Tunable with the OUTBOX_PATH, OUTBOX_MAX_ITEMS, OUTBOX_BATCH and
+# OUTBOX_MAX_BACKOFF environment variables.
+
+import os, sys
+import json
+import time
+import random
+import sqlite3
+import asyncio
+import logging
+import threading
+
+import aiohttp
+
+from . import http_client
+
+# next to the bridge's main.py rather than in the working directory, so a
+# service started from somewhere else still finds its queue
+DIRECTORY = os.path.dirname(os.path.abspath(sys.argv[0]))
+PATH = os.environ.get('OUTBOX_PATH', os.path.join(DIRECTORY, 'outbox.db'))
+MAX_ITEMS = int(os.environ.get('OUTBOX_MAX_ITEMS', 100000))
+BATCH = int(os.environ.get('OUTBOX_BATCH', 20))
+MAX_BACKOFF = float(os.environ.get('OUTBOX_MAX_BACKOFF', 300))
+
+BASE_BACKOFF = 1
+
+# responses that mean the item will never be accepted, it's logged and
+# dropped instead of holding up the ones behind it. Auth and not found
+# errors are retried, since a rotated token or a wrong URL gets fixed and
+# the items are still wanted then.
+PERMANENT_ERRORS = [400, 413, 422]
+
+
+class Outbox:
+    def __init__(self, path=PATH, max_items=MAX_ITEMS, batch=BATCH, combine=False, permanent_errors=PERMANENT_ERRORS):
+        self.path = path
+        self.max_items = max_items
+        self.batch = batch
+        self.combine = combine
+        self.permanent_errors = permanent_errors
+        self.lock = threading.Lock()
+        self.wakeup = None
+        self.loop = None
+        self.task = None
+        self.thread = None
+        self.failures = 0
+        self.stats = dict(queued=0, superseded=0, sent=0, failed=0, dropped=0, combined=0)
+
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('pragma journal_mode=wal')
+        self.db.execute('pragma synchronous=normal')
+        self.db.execute('''create table if not exists items (
+            id integer primary key autoincrement,
+            key text,
+            url text not null,
+            data text not null,
+            headers text,
+            created real not null
+        )''')
+
+        # databases from the scanner's old copy of the outbox lack these
+        columns = [row[1] for row in self.db.execute('pragma table_info(items)')]
+        for column in ['key', 'headers']:
+            if column not in columns:
+                self.db.execute('alter table items add column {} text'.format(column))
+
+        self.db.execute('create index if not exists items_key on items (key)')
+
+    def put(self, url, data, headers=None, key=None):
+        with self.lock:
+            self.db.execute('begin')
+            if key is not None:
+                cursor = self.db.execute('delete from items where key = ?', (key,))
+                self.stats['superseded'] += cursor.rowcount
+
+            self.db.execute('insert into items (key, url, data, headers, created) values (?, ?, ?, ?, ?)',
+                (key, url, json.dumps(data), json.dumps(headers) if headers else None, time.time()))
+
+            count = self.db.execute('select count(*) from items').fetchone()[0]
+            if count > self.max_items:
+                self.db.execute('delete from items where id in (select id from items order by id limit ?)', (count - self.max_items,))
+                self.stats['dropped'] += count - self.max_items
+            self.db.execute('commit')
+
+        self.stats['queued'] += 1
+        self.notify()
+
+    def notify(self):
+        if self.wakeup and self.loop:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def peek(self, count):
+        with self.lock:
+            rows = self.db.execute('select id, url, data, headers from items order by id limit ?', (count,)).fetchall()
+        return [(id, url, json.loads(data), json.loads(headers) if headers else None) for id, url, data, headers in rows]
+
+    def remove(self, ids):
+        if not ids:
+            return
+        with self.lock:
+            self.db.executemany('delete from items where id = ?', [(id,) for id in ids])
+
+    def depth(self):
+        with self.lock:
+            return self.db.execute('select count(*) from items').fetchone()[0]
+
+    async def send(self, item):
+        # returns True if the item is done with, delivered or not
+        id, url, data, headers = item
+        try:
+            await http_client.post(url, json=data, headers=headers)
+            self.stats['sent'] += 1
+            return True
+        except aiohttp.ClientResponseError as e:
+            if e.status in self.permanent_errors:
+                self.stats['dropped'] += 1
+                logging.error('Portal %s rejected item %s with %s, dropping: %s', url, id, e.status, data)
+                return True
+            logging.error('Problem sending item %s to portal %s: %s', id, url, e)
+        except BaseException as e:
+            logging.error('Problem sending item %s to portal %s: %s', id, url, e)
+
+        self.stats['failed'] += 1
+        return False
+
+    async def send_combined(self, items):
+        # items all for one URL, returns whether each is done with
+        if len(items) == 1:
+            return [await self.send(items[0])]
+
+        id, url, data, headers = items[0]
+        try:
+            await http_client.post(url, json=[item[2] for item in items], headers=headers)
+            self.stats['sent'] += len(items)
+            self.stats['combined'] += 1
+            return [True] * len(items)
+        except aiohttp.ClientResponseError as e:
+            if e.status in self.permanent_errors:
+                logging.error('Portal %s rejected %s combined items with %s, sending them one at a time', url, len(items), e.status)
+                return await asyncio.gather(*[self.send(item) for item in items])
+            logging.error('Problem sending %s combined items to portal %s: %s', len(items), url, e)
+        except BaseException as e:
+            logging.error('Problem sending %s combined items to portal %s: %s', len(items), url, e)
+
+        self.stats['failed'] += len(items)
+        return [False] * len(items)
+
+    async def send_all(self, items):
+        if not self.combine:
+            return items, await asyncio.gather(*[self.send(item) for item in items])
+
+        groups = {}
+        for item in items:
+            groups.setdefault((item[1], json.dumps(item[3])), []).append(item)
+
+        done = await asyncio.gather(*[self.send_combined(group) for group in groups.values()])
+        items = [item for group in groups.values() for item in group]
+        return items, [result for results in done for result in results]
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            items = self.peek(self.batch)
+            if not items:
+                await self.wakeup.wait()
+                continue
+
+            items, results = await self.send_all(items)
+            self.remove([item[0] for item, done in zip(items, results) if done])
+
+            if all(results):
+                if self.failures:
+                    logging.info('Portal reachable again, %s items left in outbox', self.depth())
+                self.failures = 0
+                continue
+
+            self.failures += 1
+            backoff = min(MAX_BACKOFF, BASE_BACKOFF * 2 ** self.failures) * random.uniform(0.5, 1)
+            logging.info('Retrying outbox in %.1fs, %s items waiting', backoff, self.depth())
+            await asyncio.sleep(backoff)
+
+    def start(self):
+        # must be called from inside the running event loop
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.ensure_future(self.run())
+
+    def start_thread(self):
+        # for bridges without an event loop, sends from its own thread
+        def run():
+            asyncio.run(self.run_in_thread())
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+    async def run_in_thread(self):
+        self.start()
+        await self.task
+
+    def log_stats(self):
+        s = self.stats
+        logging.info('Outbox stats: %s waiting, %s queued, %s superseded, %s sent, %s combined requests, %s failed, %s dropped',
+            self.depth(), s['queued'], s['superseded'], s['sent'], s['combined'], s['failed'], s['dropped'])
@@ -0,0 +1,241 @@
+# Turns Home Assistant entity states into the printer3d payloads the portal
+# expects, for each kind of printer we track.
+#
+# Each printer lists the entity ids it reads, mapped to a field name, so a
+# poller can route a single /api/states response to every printer in one
+# pass. format() takes the {field: state} dict collected for that printer.
+#
+# StatusUploader does the rest for printer_poller and the single printer
+# trackers: fetching states by polling or through an EntityWatcher, and
+# uploading changed payloads to the portal and the dev portal.
+
+import json
+import asyncio
+import logging
+
+from . import http_client
+from .homeassistant import EntityWatcher
+from .changes import ChangeDetector
+
+PORTAL_URL = 'https://api.my.protospace.ca/stats/{}/printer3d/'
+DEV_PORTAL_URL = 'https://api.spaceport.dns.t0.vc/stats/{}/printer3d/'
+
+
+class BambuPrinter:
+    # Bambu P1S through the Bambu Lab integration
+    FIELDS = [
+        'print_status',
+        'print_progress',
+        'current_layer',
+        'total_layer_count',
+        'remaining_time',
+        'bed_temperature',
+        'bed_target_temperature',
+        'nozzle_temperature',
+        'nozzle_target_temperature',
+    ]
+
+    def __init__(self, name, serial):
+        self.name = name
+        self.serial = serial.lower()
+        self.entities = {'sensor.p1s_{}_{}'.format(self.serial, field): field for field in self.FIELDS}
+
+    def format(self, status):
+        # massage data into old integration format
+        return dict(
+            info=dict(
+                online=True,
+                gcode_state=status['print_status'].upper(),
+                current_layer=status['current_layer'],
+                total_layers=status['total_layer_count'],
+                print_percentage=status['print_progress'],
+                remaining_time=status['remaining_time'],
+            ),
+            temperature=dict(
+                bed_temp=status['bed_temperature'],
+                target_bed_temp=status['bed_target_temperature'],
+                nozzle_temp=status['nozzle_temperature'],
+                target_nozzle_temp=status['nozzle_target_temperature'],
+            ),
+        )
+
+
+class PrusaPrinter:
+    # Prusa through the PrusaLink integration, entities start with the
+    # device name like sensor.prusa_xl_progress
+    FIELDS = [
+        'print_speed',
+        'material',
+        'progress',
+        'filename',
+        'print_start',
+        'print_finish',
+    ]
+
+    def __init__(self, name, prefix=None):
+        self.name = name
+        prefix = 'sensor.' + (prefix or name)
+        self.entities = {prefix + '_' + field: field for field in self.FIELDS}
+        self.entities[prefix] = 'state'
+
+    def format(self, status):
+        return dict(
+            info=dict(
+                online=True,
+                state=status['state'].title(),
+                print_speed=status['print_speed'],
+                material=status['material'],
+                progress=status['progress'],
+                filename=status['filename'],
+                print_start=status['print_start'],
+                print_finish=status['print_finish'],
+            ),
+        )
+
+
+TYPES = dict(
+    bambu=BambuPrinter,
+    prusa=PrusaPrinter,
+)
+
+def from_config(config):
+    # config is a dict like dict(type='bambu', name='p1s1', serial='01P09C...')
+    config = dict(config)
+    kind = config.pop('type')
+    return TYPES[kind](**config)
+
+
+class StatusUploader:
+    def __init__(self, printers, outbox, homeassistant_url, token, ssl=None):
+        self.printers = printers
+        self.outbox = outbox
+        self.homeassistant_url = homeassistant_url
+        self.token = token
+        self.ssl = ssl
+
+        # skips uploads of unchanged status apart from a heartbeat
+        self.changes = ChangeDetector()
+
+        # latest payload per printer, resent by watch() for heartbeats
+        self.current = {}
+        self.watcher = None
+
+        # entity id -> (printer, field), so each state is looked up once
+        self.routes = {}
+        for printer in printers:
+            for entity_id, field in printer.entities.items():
+                self.routes[entity_id] = (printer, field)
+
+    def route_states(self, states):
+        # states is a list of {'entity_id': ..., 'state': ...} like /api/states
+        status = {printer.name: {} for printer in self.printers}
+
+        for entry in states:
+            route = self.routes.get(entry['entity_id'])
+            if route:
+                printer, field = route
+                status[printer.name][field] = entry['state']
+
+        return status
+
+    def format_status(self, status):
+        payloads = {}
+
+        for printer in self.printers:
+            logging.debug('%s status data:\n%s', printer.name, json.dumps(status[printer.name], indent=4))
+
+            try:
+                payloads[printer] = printer.format(status[printer.name])
+            except KeyError as e:
+                logging.error('Missing %s entity %s, is the printer configured right?', printer.name, e)
+
+        return payloads
+
+    async def send_dev(self, printer, data):
+        url = DEV_PORTAL_URL.format(printer.name)
+        data = self.changes.check(url, data)
+        if data is None:
+            return
+
+        try:
+            await http_client.post(url, json=data)
+        except BaseException as e:
+            self.changes.forget(url)
+            logging.info('Problem sending printer data to dev portal %s:', url)
+
+    async def send_payloads(self, payloads):
+        self.current.update(payloads)
+        sent = 0
+
+        for printer, data in payloads.items():
+            # only the latest status matters if the portal is behind, but deltas
+            # can't replace each other
+            url = PORTAL_URL.format(printer.name)
+            data = self.changes.check(url, data)
+            if data is None:
+                continue
+
+            logging.debug('JSON data for %s:\n%s', url, json.dumps(data, indent=4))
+            try:
+                self.outbox.put(url, data, key=None if self.changes.delta else url)
+                sent += 1
+            except BaseException as e:
+                logging.error('Problem queueing printer data for portal %s:', url)
+                logging.exception(e)
+
+        logging.info('Queued %s of %s printers for portal', sent, len(payloads))
+
+        await asyncio.gather(*[self.send_dev(printer, data) for printer, data in payloads.items()])
+
+        logging.debug('Done sending.')
+
+    def log_stats(self):
+        self.changes.log_stats()
+        self.outbox.log_stats()
+        http_client.log_stats()
+
+    async def poll(self, interval=60):
+        # fetches /api/states every interval seconds
+        self.outbox.start()
+
+        while True:
+            await asyncio.sleep(interval)
+
+            try:
+                headers = {'Authorization': 'Bearer ' + self.token}
+                url = self.homeassistant_url + '/api/states'
+                res = await http_client.get(url, headers=headers, ssl=self.ssl)
+            except KeyboardInterrupt:
+                break
+            except BaseException as e:
+                logging.error('Problem getting status from Home Assistant URL %s:', url)
+                logging.exception(e)
+                continue
+
+            await self.send_payloads(self.format_status(self.route_states(res)))
+            self.log_stats()
+
+    async def on_change(self, states):
+        status = self.route_states({'entity_id': entity_id, 'state': state} for entity_id, state in states.items())
+        await self.send_payloads(self.format_status(status))
+
+    async def watch(self):
+        # subscribes to the printers' entities over the WebSocket API
+        self.outbox.start()
+
+        self.watcher = EntityWatcher(self.homeassistant_url, self.token, self.routes.keys(), self.on_change, ssl=self.ssl)
+        task = asyncio.ensure_future(self.watcher.run())
+
+        try:
+            while not task.done():
+                await asyncio.sleep(60)
+
+                # nothing has changed, but heartbeats may be due
+                await self.send_payloads(self.current)
+
+                self.watcher.log_stats()
+                self.log_stats()
+        finally:
+            task.cancel()
+
+        await task
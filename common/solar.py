@@ -0,0 +1,123 @@
+# Coalescing uploader for solar power readings.
+#
+# The portal only keeps the latest power per user, so readings are held
+# here and only the newest one per user is sent. Pending readings go out
+# every SOLAR_FLUSH_INTERVAL seconds, or sooner when one moves by more than
+# SOLAR_CHANGE_THRESHOLD (a fraction of the last sent value) from what the
+# portal last got. With SOLAR_BATCH set all users are sent as one list in a
+# single request, otherwise each user is its own request, sent together.
+# Given an outbox, requests are queued there instead of sent directly.
+
+import os
+import asyncio
+import logging
+
+from . import http_client
+
+DEBUG = os.environ.get('DEBUG')
+
+if DEBUG:
+    URL = 'https://api.spaceport.dns.t0.vc/stats/solar_data/'
+else:
+    URL = 'https://api.my.protospace.ca/stats/solar_data/'
+
+FLUSH_INTERVAL = float(os.environ.get('SOLAR_FLUSH_INTERVAL', 60))
+CHANGE_THRESHOLD = float(os.environ.get('SOLAR_CHANGE_THRESHOLD', 0.25))
+BATCH = bool(os.environ.get('SOLAR_BATCH'))
+
+# shortest time between flushes, however much the power moves
+MIN_INTERVAL = 5
+
+
+def changed(old, new, threshold):
+    try:
+        old, new = float(old), float(new)
+    except (TypeError, ValueError):
+        return old != new
+    return abs(new - old) > threshold * max(abs(old), 1)
+
+
+class SolarUploader:
+    def __init__(self, url=URL, interval=FLUSH_INTERVAL, threshold=CHANGE_THRESHOLD, batch=BATCH, outbox=None):
+        self.url = url
+        self.outbox = outbox
+        self.interval = interval
+        self.threshold = threshold
+        self.batch = batch
+        self.pending = {}   # user -> newest power not sent yet
+        self.sent = {}   # user -> power the portal last got
+        self.wakeup = None
+        self.task = None
+        self.stats = dict(readings=0, coalesced=0, requests=0, errors=0)
+
+    def update(self, user, power):
+        self.stats['readings'] += 1
+        if user in self.pending:
+            self.stats['coalesced'] += 1
+        self.pending[user] = power
+
+        if self.wakeup and (user not in self.sent or changed(self.sent[user], power, self.threshold)):
+            self.wakeup.set()
+
+    async def post(self, data):
+        self.stats['requests'] += 1
+
+        if self.outbox:
+            # a queued reading for the same user is stale now
+            key = '{}#{}'.format(self.url, data['user']) if isinstance(data, dict) else None
+            self.outbox.put(self.url, data, key=key)
+            return True
+
+        try:
+            await http_client.post(self.url, json=data)
+            return True
+        except BaseException as e:
+            self.stats['errors'] += 1
+            logging.error('Problem sending json to portal %s:', self.url)
+            logging.exception(e)
+            return False
+
+    async def flush(self):
+        if not self.pending:
+            return
+
+        pending, self.pending = self.pending, {}
+
+        if self.batch:
+            data = [dict(user=user, power=power) for user, power in pending.items()]
+            results = [await self.post(data)] * len(pending)
+        else:
+            results = await asyncio.gather(*[self.post(dict(user=user, power=power)) for user, power in pending.items()])
+
+        for (user, power), ok in zip(pending.items(), results):
+            if ok:
+                self.sent[user] = power
+            else:
+                # retry next flush unless a newer reading came in meanwhile
+                self.pending.setdefault(user, power)
+
+        if self.outbox:
+            logging.info('Queued %s solar users in outbox', len(pending))
+        else:
+            logging.info('Sent %s of %s solar users to portal URL: %s', sum(results), len(pending), self.url)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+            self.wakeup.clear()
+            await self.flush()
+            await asyncio.sleep(MIN_INTERVAL)
+
+    def start(self):
+        # must be called from inside the running event loop
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.ensure_future(self.run())
+
+    def log_stats(self):
+        s = self.stats
+        logging.info('Solar stats: %s readings, %s coalesced, %s requests, %s errors',
+            s['readings'], s['coalesced'], s['requests'], s['errors'])
@@ -0,0 +1,76 @@
+# Routing table from MQTT topic filters to handlers.
+#
+# Filters use the usual MQTT wildcards: + matches one level and # matches
+# any number of remaining levels, including none. They are kept in a trie
+# split on '/', so matching a topic walks at most one path per wildcard
+# and costs the same however many unrelated routes are registered. The
+# bridge subscribes to filters() only, instead of '#'.
+
+
+class Node:
+    def __init__(self):
+        self.children = {}
+        self.handlers = []   # for filters ending at this level
+        self.rest = []   # for filters ending in '#' below this level
+
+
+class TopicRouter:
+    def __init__(self):
+        self.root = Node()
+        self.routes = []   # (filter, handler) in the order added
+
+    def add(self, topic_filter, handler):
+        levels = topic_filter.split('/')
+        if '#' in levels[:-1]:
+            raise ValueError('# must be the last level of a filter: {}'.format(topic_filter))
+
+        node = self.root
+        for level in levels:
+            if level == '#':
+                node.rest.append(handler)
+                break
+            node = node.children.setdefault(level, Node())
+        else:
+            node.handlers.append(handler)
+
+        self.routes.append((topic_filter, handler))
+
+    def route(self, topic_filter):
+        # decorator form of add()
+        def decorator(handler):
+            self.add(topic_filter, handler)
+            return handler
+        return decorator
+
+    def filters(self):
+        return list(dict.fromkeys(topic_filter for topic_filter, handler in self.routes))
+
+    def match(self, topic):
+        levels = topic.split('/')
+        handlers = []
+        nodes = [self.root]
+
+        for i, level in enumerate(levels):
+            next_nodes = []
+            for node in nodes:
+                # wildcards don't match topics starting with $, like $SYS
+                wildcards = not (i == 0 and level.startswith('$'))
+                if wildcards:
+                    handlers += node.rest
+
+                child = node.children.get(level)
+                if child:
+                    next_nodes.append(child)
+                if wildcards:
+                    child = node.children.get('+')
+                    if child:
+                        next_nodes.append(child)
+
+            nodes = next_nodes
+            if not nodes:
+                return handlers
+
+        for node in nodes:
+            handlers += node.handlers
+            handlers += node.rest   # 'a/#' also matches 'a'
+        return handlers
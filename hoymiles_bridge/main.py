@@ -6,63 +6,159 @@ logging.basicConfig(stream=sys.stdout,
     level=logging.DEBUG if DEBUG else logging.INFO)
 
 import time
-import json
+import datetime
 
 import asyncio
-import aiohttp
+from aiohttp import web
 from hoymiles_wifi.dtu import DTU
+from google.protobuf.json_format import MessageToDict
 
 import secrets
 
-async def process_solar_data(data):
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import http_client
+from common.outbox import Outbox
+from common.solar import SolarUploader, changed
+
+# polled faster while power is changing, slower when it's steady and
+# slowest at night when it's 0
+MIN_INTERVAL = float(os.environ.get('HOYMILES_MIN_INTERVAL', 30))
+INTERVAL = float(os.environ.get('HOYMILES_INTERVAL', 180))
+NIGHT_INTERVAL = float(os.environ.get('HOYMILES_NIGHT_INTERVAL', 900))
+CHANGE_THRESHOLD = float(os.environ.get('HOYMILES_CHANGE_THRESHOLD', 0.1))
+
+# DTUs are fragile, don't talk to many at once
+CONCURRENCY = int(os.environ.get('HOYMILES_CONCURRENCY', 2))
+
+# cached readings are served here for other tools on the network
+LISTEN_HOST = os.environ.get('HOYMILES_LISTEN_HOST', '127.0.0.1')
+LISTEN_PORT = int(os.environ.get('HOYMILES_LISTEN_PORT', 8087))
+
+outbox = Outbox()
+solar_uploader = SolarUploader(outbox=outbox)
+
+# older configs have a single SOLAR_INFO
+DTUS = getattr(secrets, 'SOLAR_DTUS', None) or [secrets.SOLAR_INFO]
+
+dtu_limit = None
+
+class DtuState:
+    def __init__(self, info):
+        self.name = info['name']
+        self.ip = info['dtu_ip']
+        self.client = DTU(self.ip)   # reused every poll
+        self.interval = INTERVAL
+        self.power = None
+        self.serial = None
+        self.data = None
+        self.updated = None
+        self.error = None
+
+    def as_dict(self):
+        return dict(
+            name=self.name,
+            dtu_ip=self.ip,
+            serial=self.serial,
+            power=self.power,
+            updated=self.updated,
+            interval=self.interval,
+            error=self.error,
+            data=self.data,
+        )
+
+states = [DtuState(info) for info in DTUS]
+
+def next_interval(dtu, old_power, power):
+    if not power:
+        return NIGHT_INTERVAL
+    if old_power is None or changed(old_power, power, CHANGE_THRESHOLD):
+        return max(MIN_INTERVAL, dtu.interval / 2)
+    return min(INTERVAL, dtu.interval * 2)
+
+async def process_solar_data(dtu, data):
     try:
 
         serial = data.device_serial_number
         dtu_power = getattr(data, 'dtu_power', 0)
         power = dtu_power // 10
-        name = secrets.SOLAR_INFO['name']
 
-        logging.info('DTU Serial: %s, user: %s, power: %s', serial, name, power)
+        logging.info('DTU Serial: %s, user: %s, power: %s', serial, dtu.name, power)
 
-        async with aiohttp.ClientSession() as session:
-            data = dict(user=name, power=power)
+        dtu.interval = next_interval(dtu, dtu.power, power)
+        dtu.serial = serial
+        dtu.power = power
+        dtu.data = MessageToDict(data)
+        dtu.updated = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        dtu.error = None
 
-            if DEBUG:
-                url = 'https://api.spaceport.dns.t0.vc/stats/solar_data/'
-            else:
-                url = 'https://api.my.protospace.ca/stats/solar_data/'
-
-            await session.post(url, json=data, timeout=10)
-
-            logging.info('Sent to portal URL: %s', url)
+        # a user with several DTUs gets their total
+        total = sum(d.power or 0 for d in states if d.name == dtu.name)
+        solar_uploader.update(dtu.name, total)
     except BaseException as e:
-        logging.error('Problem sending json to portal:')
+        logging.error('Problem processing DTU data:')
         logging.exception(e)
 
-async def get_hoymiles_data():
+async def get_hoymiles_data(dtu):
     try:
-        dtu = DTU(secrets.SOLAR_INFO['dtu_ip'])
-        response = await dtu.async_get_real_data_new()
+        async with dtu_limit:
+            response = await dtu.client.async_get_real_data_new()
 
         if response:
             logging.debug('DTU response: %s', response)
             return response
         else:
-            raise
+            raise Exception('No response from DTU')
     except BaseException as e:
-        logging.error('Problem getting data from DTU:')
+        dtu.error = str(e)
+        logging.error('Problem getting data from DTU %s:', dtu.ip)
         logging.exception(e)
         return False
 
-async def main():
+async def poll_dtu(dtu):
     while True:
-        data = await get_hoymiles_data()
+        data = await get_hoymiles_data(dtu)
         if data:
-            await process_solar_data(data)
+            await process_solar_data(dtu, data)
         else:
             logging.info('Bad data.')
+            dtu.interval = INTERVAL
+
+        logging.debug('Polling DTU %s again in %ss', dtu.ip, dtu.interval)
+        await asyncio.sleep(dtu.interval)
+
+async def log_stats():
+    while True:
+        await asyncio.sleep(300)
+        solar_uploader.log_stats()
+        outbox.log_stats()
+        http_client.log_stats()
+
+async def index(request):
+    return web.json_response([dtu.as_dict() for dtu in states])
+
+async def dtu_status(request):
+    for dtu in states:
+        if request.match_info['dtu'] in (dtu.ip, dtu.serial):
+            return web.json_response(dtu.as_dict())
+    raise web.HTTPNotFound(text='No such DTU')
+
+async def main():
+    global dtu_limit
+    dtu_limit = asyncio.Semaphore(CONCURRENCY)
+
+    outbox.start()
+    solar_uploader.start()
+
+    app = web.Application()
+    app.router.add_get('/', index)
+    app.router.add_get('/{dtu}', dtu_status)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, LISTEN_HOST, LISTEN_PORT)
+    await site.start()
 
-        await asyncio.sleep(180)
+    await asyncio.gather(log_stats(), *[poll_dtu(dtu) for dtu in states])
 
 
 if __name__ == '__main__':
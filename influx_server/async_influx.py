@@ -0,0 +1,85 @@
+# Non-blocking InfluxDB 1.x query client for the asyncio server.
+#
+# Talks to the /query HTTP endpoint over one pooled aiohttp session and
+# returns points shaped like influxdb-python's ResultSet.get_points().
+
+import json
+
+import aiohttp
+
+
+class InfluxError(Exception):
+    pass
+
+
+def result_points(result):
+    if 'error' in result:
+        raise InfluxError(result['error'])
+
+    points = []
+    for series in result.get('series', []):
+        columns = series['columns']
+        points += [dict(zip(columns, row)) for row in series.get('values', [])]
+    return points
+
+
+class AsyncInfluxClient:
+    def __init__(self, host='localhost', port=8086, database='telegraf', pool_size=20, timeout=30):
+        self.url = 'http://{}:{}/query'.format(host, port)
+        self.database = database
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.session = None
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+
+    def params(self, q, epoch, **extra):
+        params = dict(db=self.database, q=q, **extra)
+        if epoch:
+            params['epoch'] = epoch
+        return params
+
+    async def query(self, q, epoch=None, timeout=None):
+        # returns one point list per statement in q
+        timeout = aiohttp.ClientTimeout(total=timeout or self.timeout)
+
+        # sent as a form so long multi-statement queries don't hit URL limits
+        async with self.get_session().post(self.url, data=self.params(q, epoch), timeout=timeout) as res:
+            data = await res.json(content_type=None)
+
+        if 'error' in data:
+            raise InfluxError(data['error'])
+        res.raise_for_status()
+
+        return [result_points(result) for result in data.get('results', [])]
+
+    async def query_chunked(self, q, chunk_size, epoch=None, timeout=None):
+        # yields a point list for every chunk InfluxDB sends. Chunks are
+        # JSON documents separated by newlines.
+        timeout = aiohttp.ClientTimeout(sock_read=timeout or self.timeout)
+        params = self.params(q, epoch, chunked='true', chunk_size=str(chunk_size))
+
+        async with self.get_session().post(self.url, data=params, timeout=timeout) as res:
+            res.raise_for_status()
+            buffer = b''
+
+            async for data in res.content.iter_any():
+                buffer += data
+                *lines, buffer = buffer.split(b'\n')
+
+                for line in lines:
+                    if line.strip():
+                        for result in json.loads(line).get('results', []):
+                            yield result_points(result)
+
+            if buffer.strip():
+                for result in json.loads(buffer).get('results', []):
+                    yield result_points(result)
@@ -0,0 +1,327 @@
+# Asyncio version of main.py. Serves the same routes and JSON from a single
+# event loop, querying InfluxDB through a pooled non-blocking client with
+# per-query timeouts, so one slow month query doesn't hold up other callers.
+#
+# Run with: python async_server.py
+
+import os, logging
+DEBUG = os.environ.get('DEBUG')
+logging.basicConfig(
+        format='[%(asctime)s] %(levelname)s %(module)s/%(funcName)s - %(message)s',
+        level=logging.DEBUG if DEBUG else logging.INFO)
+
+import asyncio
+from aiohttp import web
+from influxdb import InfluxDBClient
+
+from async_influx import AsyncInfluxClient
+from cache import QueryCache
+from live import LastValues, MQTT_HOST
+from stream import Hub, KEEPALIVE, format_event
+from rolling import RollingWindows, window_statement, moving_average as average_points
+from rollup import Rollups
+from queries import (
+    DOMAINS, SENSORS, TOPICS, FORMATS, INCREMENTAL_LOOKUPS, LAST_VALUE_TTL, STREAM_CHUNK_SIZE, API_DOCS,
+    parse_spec, parse_sensors, lookup_range, open_end, last_statement, raw_statement, columnar, format_points,
+    encode_rows, cache_headers, not_modified, plan_batch, finish_batch,
+)
+
+POOL_SIZE = int(os.environ.get('INFLUX_POOL_SIZE', 20))
+QUERY_TIMEOUT = float(os.environ.get('INFLUX_QUERY_TIMEOUT', 30))
+
+influx = AsyncInfluxClient('localhost', 8086, 'telegraf', pool_size=POOL_SIZE, timeout=QUERY_TIMEOUT)
+cache = QueryCache(max_points=200000)
+
+# rollups are built by a background thread with the blocking client, only
+# the request path has to be non-blocking
+rollups = Rollups(InfluxDBClient('localhost', 8086, database='telegraf'), TOPICS)
+hub = Hub()
+last_values = LastValues(TOPICS, hub=hub)
+
+def tiered_statement(topic, start, end, window):
+    return rollups.window_statement(topic, start, end, window) or window_statement(topic, start, end, window)
+
+rolling = RollingWindows(statement=tiered_statement)
+
+async def fetch_statements(statements):
+    return await influx.query(';'.join(statements), epoch='s')
+
+async def history_query(topic, lookup, start, end, window, moving_average):
+    window_minutes, average_count = parse_spec(window, moving_average)
+
+    if window_minutes:
+        if lookup in INCREMENTAL_LOOKUPS:
+            plan = rolling.plan(topic, start, open_end(lookup, end), window_minutes)
+            if plan:
+                results = await fetch_statements(rolling.statements(plan, topic, window_minutes))
+                points = rolling.finish(plan, results)
+                if points is not None:
+                    if points and average_count:
+                        points = average_points(points, average_count)
+                    return points
+
+        statement = rollups.window_statement(topic, start, end, window_minutes)
+        if statement:
+            result = (await influx.query(statement))[0]
+            if average_count:
+                result = average_points(result, average_count)
+            return result
+
+    q = raw_statement(topic, start, end, window, moving_average)
+    return (await influx.query(q))[0]
+
+async def batch_query(topics, lookup, start, end, window, average_count):
+    plans, statements = plan_batch(rolling, tiered_statement, topics, lookup, start, end, window)
+    series = finish_batch(rolling, plans, await fetch_statements(statements), average_count)
+
+    for i, topic in enumerate(topics):
+        if series[i] is None:
+            points = (await fetch_statements([tiered_statement(topic, start, end, window)]))[0]
+            series[i] = format_points(points, average_count)
+
+    return series
+
+async def last_value(topic):
+    return (await influx.query(last_statement(topic)))[0][0]
+
+def sensor_topic(request):
+    domain = request.match_info['domain']
+    kind = request.match_info['kind']
+    num = int(request.match_info['num'])
+    measurement = request.match_info['measurement']
+
+    if (kind, num, measurement) not in SENSORS:
+        raise web.HTTPNotFound()
+
+    if domain not in DOMAINS:
+        raise web.HTTPNotFound()
+
+    return '{}/{}/{}/{}'.format(domain, kind, num, measurement)
+
+def request_range(lookup):
+    time_range = lookup_range(lookup)
+    if not time_range:
+        raise web.HTTPNotFound()
+    return time_range
+
+def conditional_response(request, response, key, output, ttl, result):
+    headers = cache_headers(key, output, ttl, response.body, result)
+    if not_modified(request.headers, headers, ttl):
+        return web.Response(status=304, headers=headers)
+
+    response.headers.update(headers)
+    return response
+
+def closed_not_modified(request, key, output, ttl):
+    # returns a 304 response if the client already has this closed range
+    if ttl is not None:
+        return None
+
+    headers = cache_headers(key, output, ttl)
+    if not_modified(request.headers, headers, ttl):
+        return web.Response(status=304, headers=headers)
+    return None
+
+@web.middleware
+async def cors(request, handler):
+    try:
+        response = await handler(request)
+    except web.HTTPException as e:
+        e.headers['Access-Control-Allow-Origin'] = '*'
+        raise
+
+    if not response.prepared:
+        response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
+
+async def index(request):
+    return web.Response(text=API_DOCS, content_type='text/html')
+
+async def sensors(request):
+    topic = sensor_topic(request)
+    result = last_values.get(topic)
+    if result:
+        return web.json_response(result)
+
+    key = (topic, None, None, None, None)
+    result = await cache.get_or_compute_async(key, LAST_VALUE_TTL, lambda: last_value(topic))
+    last_values.seed(topic, result)
+
+    return web.json_response(result)
+
+async def stream_history(request, key, topic, start, end, window, moving_average, output, ttl):
+    mimetype = 'text/csv' if output == 'csv' else 'application/x-ndjson'
+    response = web.StreamResponse(headers={
+        'Content-Type': mimetype,
+        'Access-Control-Allow-Origin': '*',
+    })
+
+    # streamed before the body is known, so only closed ranges get a tag
+    if ttl is None:
+        response.headers.update(cache_headers(key, output, ttl))
+    await response.prepare(request)
+
+    points = cache.get(key)
+    if points is not None:
+        for data in encode_rows(points, output):
+            await response.write(data.encode())
+    else:
+        # moving averages over rollups would have to be applied across
+        # chunks, leave those to InfluxDB
+        window_minutes, average_count = parse_spec(window, moving_average)
+        statement = None
+        if window_minutes and not average_count:
+            statement = rollups.window_statement(topic, start, end, window_minutes)
+        if not statement:
+            statement = raw_statement(topic, start, end, window, moving_average)
+
+        header = True
+        async for chunk in influx.query_chunked(statement, STREAM_CHUNK_SIZE):
+            for data in encode_rows(chunk, output, header=header):
+                await response.write(data.encode())
+            header = False
+
+        if header and output == 'csv':
+            await response.write(b'time,value\n')
+
+    await response.write_eof()
+    return response
+
+async def sensors_history(request):
+    topic = sensor_topic(request)
+    lookup = request.match_info['lookup']
+
+    window = request.query.get('window', 15)
+    moving_average = request.query.get('moving_average', None)
+    output = request.query.get('format', 'json')
+
+    if output not in FORMATS:
+        raise web.HTTPBadRequest()
+
+    start, end, ttl = request_range(lookup)
+    key = (topic, start, end, str(window), moving_average)
+
+    response = closed_not_modified(request, key, output, ttl)
+    if response:
+        return response
+
+    if output in ['ndjson', 'csv']:
+        return await stream_history(request, key, topic, start, end, window, moving_average, output, ttl)
+
+    result = await cache.get_or_compute_async(key, ttl, lambda: history_query(topic, lookup, start, end, window, moving_average))
+
+    if output == 'columnar':
+        response = web.json_response(columnar(result))
+    else:
+        response = web.json_response(dict(result=result))
+    return conditional_response(request, response, key, output, ttl, result)
+
+async def sensors_batch(request):
+    domain = request.match_info['domain']
+    lookup = request.match_info['lookup']
+
+    if domain not in DOMAINS:
+        raise web.HTTPNotFound()
+
+    window = request.query.get('window', 15)
+    moving_average = request.query.get('moving_average', None)
+
+    try:
+        sensors = parse_sensors(request.query.get('sensors', None))
+    except ValueError:
+        raise web.HTTPBadRequest()
+
+    if any(sensor not in SENSORS for sensor in sensors):
+        raise web.HTTPNotFound()
+
+    window_minutes, average_count = parse_spec(window, moving_average)
+    if not window_minutes:
+        raise web.HTTPBadRequest()
+
+    start, end, ttl = request_range(lookup)
+    topics = ['{}/{}/{}/{}'.format(domain, *sensor) for sensor in sensors]
+
+    async def run_query():
+        series = await batch_query(topics, lookup, start, end, window_minutes, average_count)
+        return {'{}/{}/{}'.format(*sensor): points for sensor, points in zip(sensors, series)}
+
+    key = (tuple(topics), start, end, str(window), moving_average)
+
+    response = closed_not_modified(request, key, 'json', ttl)
+    if response:
+        return response
+
+    result = await cache.get_or_compute_async(key, ttl, run_query)
+
+    return conditional_response(request, web.json_response(dict(result=result)), key, 'json', ttl, result)
+
+async def sensors_live(request):
+    domain = request.match_info['domain']
+
+    if domain not in DOMAINS:
+        raise web.HTTPNotFound()
+
+    if not MQTT_HOST:
+        raise web.HTTPServiceUnavailable()
+
+    try:
+        sensors = parse_sensors(request.query.get('sensors', None))
+    except ValueError:
+        raise web.HTTPBadRequest()
+
+    if any(sensor not in SENSORS for sensor in sensors):
+        raise web.HTTPNotFound()
+
+    topics = ['{}/{}/{}/{}'.format(domain, *sensor) for sensor in sensors]
+
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'Access-Control-Allow-Origin': '*',
+    })
+    await response.prepare(request)
+
+    loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+    subscriber = hub.subscribe(topics, lambda: loop.call_soon_threadsafe(wakeup.set))
+
+    try:
+        for topic, point in last_values.snapshot(topics).items():
+            await response.write(format_event(topic, point).encode())
+
+        while True:
+            try:
+                await asyncio.wait_for(wakeup.wait(), KEEPALIVE)
+            except asyncio.TimeoutError:
+                await response.write(b': keepalive\n\n')
+                continue
+
+            wakeup.clear()
+            await response.write(''.join(subscriber.drain()).encode())
+    finally:
+        hub.unsubscribe(subscriber)
+
+async def on_startup(app):
+    if MQTT_HOST:
+        app['last_values'] = asyncio.ensure_future(last_values.run())
+
+async def on_cleanup(app):
+    if 'last_values' in app:
+        app['last_values'].cancel()
+    await influx.close()
+
+def make_app():
+    app = web.Application(middlewares=[cors])
+    app.router.add_get('/', index)
+    app.router.add_get('/{domain}/live', sensors_live)
+    app.router.add_get('/{domain}/batch/{lookup}', sensors_batch)
+    app.router.add_get('/{domain}/{kind}/{num:\\d+}/{measurement}', sensors)
+    app.router.add_get('/{domain}/{kind}/{num:\\d+}/{measurement}/{lookup}', sensors_history)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == '__main__':
+    rollups.start()
+    web.run_app(make_app(), host='127.0.0.1', port=6900)
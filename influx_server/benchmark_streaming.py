@@ -0,0 +1,142 @@
+# Compares the time to first byte, total time and peak memory of a large
+# history response built as one JSON list against the streamed ndjson and
+# csv formats.
+#
+# A stand-in InfluxDB runs in a subprocess and answers every query with the
+# same number of rows, as msgpack for normal queries like InfluxDB does and
+# as JSON lines when chunked. Requests go through main.py's Flask app with
+# its test client, with the body read in full, chunk by chunk for the
+# streamed formats. Time to first byte is until the first chunk of the body
+# comes out of the response iterator. Time and memory are measured in separate runs, since
+# tracemalloc slows Python down.
+#
+# Usage: python benchmark_streaming.py [rows]
+
+import os, sys
+import json
+import time
+import socket
+import subprocess
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+URL = '/sensors/air/0/pm25/2024-01-01?window=1'
+
+
+def series(first, count):
+    values = [['2024-01-01T08:00:{:02d}.{:06d}Z'.format(i % 60, i % 1000000), 10 + (i % 97) * 0.25] for i in range(first, first + count)]
+    return dict(name='mqtt_consumer', columns=['time', 'value'], values=values)
+
+
+class FakeInflux(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.do_GET()
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+
+        if params.get('chunked') == ['true']:
+            # a JSON document per chunk, one per line
+            size = int(params.get('chunk_size', ['10000'])[0])
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for first in range(0, ROWS, size):
+                count = min(size, ROWS - first)
+                result = dict(statement_id=0, series=[series(first, count)])
+                if first + count < ROWS:
+                    result['partial'] = True
+                data = (json.dumps(dict(results=[result])) + '\n').encode()
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.write(b'0\r\n\r\n')
+            return
+
+        import msgpack
+        body = msgpack.packb(dict(results=[dict(statement_id=0, series=[series(0, ROWS)])]))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-msgpack')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(port):
+    HTTPServer(('127.0.0.1', port), FakeInflux).serve_forever()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_for(port):
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('stand-in InfluxDB did not start')
+
+
+def fetch(app, output, start):
+    # returns the time of the first chunk and the number of body bytes,
+    # read the way a client would
+    response = app.test_client().get(URL + '&format=' + output)
+    assert response.status_code == 200, response.status_code
+    first = None
+    size = 0
+    for chunk in response.response:
+        if first is None:
+            first = time.perf_counter() - start
+        size += len(chunk)
+    response.close()
+    return first, size
+
+def measure(server, output, traced):
+    server.cache = server.QueryCache(max_points=200000)   # nothing cached between runs
+
+    if traced:
+        tracemalloc.start()
+    start = time.perf_counter()
+    first, size = fetch(server.app, output, start)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] if traced else 0
+    if traced:
+        tracemalloc.stop()
+    return first, seconds, peak, size
+
+def main():
+    port = free_port()
+    influx = subprocess.Popen([sys.executable, __file__, str(ROWS), '--serve', str(port)])
+
+    try:
+        wait_for(port)
+
+        sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+        import main as server
+        from influxdb import InfluxDBClient
+        server.client = InfluxDBClient('127.0.0.1', port, database='telegraf')
+        server.stream_client = InfluxDBClient('127.0.0.1', port, database='telegraf', headers={'Accept': 'application/json'})
+
+        print('{} rows from {}'.format(ROWS, URL))
+        print('format   first byte    total   peak memory   body')
+        for output in ['json', 'ndjson', 'csv']:
+            first, seconds, _, size = measure(server, output, traced=False)
+            _, _, peak, _ = measure(server, output, traced=True)
+            print('{:8} {:9.2f}s  {:6.2f}s  {:9.1f} MB  {:6.1f} MB'.format(output, first, seconds, peak / 1e6, size / 1e6))
+    finally:
+        influx.terminate()
+        influx.wait()
+
+
+if __name__ == '__main__':
+    if '--serve' in sys.argv:
+        serve(int(sys.argv[3]))
+    else:
+        main()
@@ -0,0 +1,147 @@
+# In-process cache for InfluxDB query results.
+#
+# Entries expire after a per-entry TTL (None means never) and the least
+# recently used ones are evicted once the total number of cached points
+# goes over max_points. Identical queries that are already running are
+# coalesced so a burst of requests only hits InfluxDB once.
+
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+
+
+class InflightQuery:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def result_size(value):
+    if isinstance(value, list):
+        return max(len(value), 1)
+    if isinstance(value, dict):
+        return max(sum(len(v) for v in value.values() if isinstance(v, list)), 1)
+    return 1
+
+
+class QueryCache:
+    def __init__(self, max_points=200000):
+        self.max_points = max_points
+        self.entries = OrderedDict()   # key -> (expires, size, value)
+        self.points = 0
+        self.inflight = {}
+        self.inflight_async = {}
+        self.lock = threading.Lock()
+        self.stats = dict(hits=0, misses=0, coalesced=0, evictions=0)
+
+    def lookup(self, key):
+        # caller must hold the lock
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        expires, size, value = entry
+        if expires is not None and expires <= time.monotonic():
+            self.remove(key)
+            return None
+
+        self.entries.move_to_end(key)
+        return entry
+
+    def remove(self, key):
+        # caller must hold the lock
+        expires, size, value = self.entries.pop(key)
+        self.points -= size
+
+    def store(self, key, value, ttl):
+        size = result_size(value)
+        if size > self.max_points:
+            return
+
+        expires = None if ttl is None else time.monotonic() + ttl
+
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+
+            self.entries[key] = (expires, size, value)
+            self.points += size
+
+            while self.points > self.max_points:
+                oldest = next(iter(self.entries))
+                self.remove(oldest)
+                self.stats['evictions'] += 1
+
+    def get(self, key):
+        with self.lock:
+            entry = self.lookup(key)
+            return entry and entry[2]
+
+    def get_or_compute(self, key, ttl, compute):
+        with self.lock:
+            entry = self.lookup(key)
+            if entry:
+                self.stats['hits'] += 1
+                return entry[2]
+
+            call = self.inflight.get(key)
+            leader = call is None
+            if leader:
+                call = InflightQuery()
+                self.inflight[key] = call
+                self.stats['misses'] += 1
+            else:
+                self.stats['coalesced'] += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = compute()
+            self.store(key, call.result, ttl)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            call.event.set()
+
+    async def get_or_compute_async(self, key, ttl, compute):
+        # same as get_or_compute() for a coroutine function, for the asyncio
+        # server. The query runs in its own task so a client going away
+        # doesn't cancel it for everyone else waiting on it.
+        with self.lock:
+            entry = self.lookup(key)
+            if entry:
+                self.stats['hits'] += 1
+                return entry[2]
+
+            task = self.inflight_async.get(key)
+            if task is None:
+                task = asyncio.ensure_future(self.compute_async(key, ttl, compute))
+                self.inflight_async[key] = task
+                self.stats['misses'] += 1
+            else:
+                self.stats['coalesced'] += 1
+
+        return await asyncio.shield(task)
+
+    async def compute_async(self, key, ttl, compute):
+        try:
+            result = await compute()
+            self.store(key, result, ttl)
+            return result
+        finally:
+            with self.lock:
+                del self.inflight_async[key]
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries), points=self.points)
@@ -0,0 +1,292 @@
+# Checks that history answered from the rollup tiers matches the raw query.
+#
+# Synthetic points for a few topics are kept by a fake InfluxDB client that
+# runs the handful of statements Rollups and the history routes send: the
+# raw mean() group by, the "select ... into" statements building each tier,
+# and sum / count over a tier. The tiers are built the way the background
+# thread does, then windowed queries over many ranges are asked both ways.
+# Ranges and windows include ones not aligned to the tier buckets, which
+# have to fall back to a finer tier or the raw query. Then points are
+# written late into buckets that are already built, and the next pass has
+# to fold them in.
+#
+# The fake only checks the arithmetic, so every statement it's sent is also
+# checked against the InfluxQL it stands in for: the whole statement's
+# shape, that each tier is built from the one below at its own bucket size
+# over aligned ranges, grouped by "topic" so it stays a tag, and that the
+# topic regex matches exactly the topics. Given the address of a real
+# influxd, the same checks run against it instead, in a scratch database
+# that's dropped afterwards.
+#
+# Usage: python check_rollups.py [points per topic] [influxd host:port]
+
+import re
+import sys
+import bisect
+import random
+import time
+
+import rollup
+from rollup import Rollups, TIERS
+from rolling import window_statement
+
+POINTS = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+INFLUXD = sys.argv[2] if len(sys.argv) > 2 else None
+DATABASE = 'check_rollups'
+TOPICS = ['sensors/air/0/pm25', 'sensors/air/1/temp', 'sensors/ambient/0/co2']
+DAYS = 10
+TOLERANCE = 1e-9
+
+RANGE = re.compile(r'time >= (\d+)s and time < (\d+)s')
+WINDOW = re.compile(r'group by time\((\d+)m\)')
+MEASUREMENT = re.compile(r' from (\w+) ')
+TOPIC = re.compile(r'"topic" = \'([^\']+)\'')
+
+# every statement Rollups and the history routes may send
+TOPIC_REGEX = r'"topic" =~ /(?P<regex>\^\(.+\)\$)/'
+TIME_RANGE = r'time >= (?P<start>\d+)s and time < (?P<end>\d+)s'
+STATEMENTS = [
+    re.compile(r'select (?P<fields>sum\("value"\) as sum, count\("value"\) as count|sum\("sum"\) as sum, sum\("count"\) as count) '
+        r'into (?P<into>\w+) from (?P<source>\w+) where ' + TOPIC_REGEX + ' and ' + TIME_RANGE +
+        r' group by time\((?P<minutes>\d+)m\), "topic" fill\(none\)'),
+    re.compile(r'select first\("value"\) from mqtt_consumer where ' + TOPIC_REGEX),
+    re.compile(r'select last\("count"\) from (?P<tier>\w+) where ' + TOPIC_REGEX),
+    re.compile(r'select mean\("value"\) as value from mqtt_consumer where "topic" = \'[^\']+\' and ' + TIME_RANGE +
+        r' group by time\(\d+m\) fill\(none\)'),
+    re.compile(r'select sum\("sum"\) / sum\("count"\) as value from (?P<tier>\w+) where "topic" = \'[^\']+\' and ' + TIME_RANGE +
+        r' group by time\(\d+m\) fill\(none\)'),
+]
+
+
+def check_statement(q):
+    for pattern in STATEMENTS:
+        match = pattern.fullmatch(q)
+        if match:
+            break
+    else:
+        raise AssertionError('unexpected statement: ' + q)
+
+    found = match.groupdict()
+    tiers = [measurement for measurement, minutes in TIERS]
+
+    if found.get('tier'):
+        assert found['tier'] in tiers, q
+
+    if found.get('regex'):
+        regex = re.compile(found['regex'].replace('\\/', '/'))
+        assert all(regex.match(topic) for topic in TOPICS), q
+        assert not any(regex.match(topic + 'x') or regex.match('x' + topic) for topic in TOPICS), q
+
+    if found.get('into'):
+        index = tiers.index(found['into'])
+        minutes = TIERS[index][1]
+        source = 'mqtt_consumer' if index == 0 else tiers[index - 1]
+        assert found['source'] == source, q
+        assert found['fields'].startswith('sum("value")') == (index == 0), q
+        assert int(found['minutes']) == minutes, q
+        assert int(found['start']) % (minutes * 60) == 0 and int(found['end']) % (minutes * 60) == 0, q
+
+
+class Result:
+    def __init__(self, points):
+        self.points = points
+
+    def get_points(self):
+        return iter(self.points)
+
+
+class FakeInflux:
+    """Runs the statements Rollups and the history routes send against
+    points held in memory"""
+
+    def __init__(self):
+        self.raw = {}   # topic -> [(time, value)]
+        self.tiers = {}   # measurement -> topic -> {bucket time: (sum, count)}
+        self.sorted = {}   # (measurement, topic) -> ([time], [(time, sum, count)])
+
+    def rows(self, measurement, topic, start, end):
+        # (time, sum, count) of the rows of measurement for topic in range
+        key = (measurement, topic)
+        if key not in self.sorted:
+            if measurement == 'mqtt_consumer':
+                rows = [(t, v, 1) for t, v in self.raw.get(topic, [])]
+            else:
+                rows = sorted((t, s, c) for t, (s, c) in self.tiers.get(measurement, {}).get(topic, {}).items())
+            self.sorted[key] = ([row[0] for row in rows], rows)
+
+        times, rows = self.sorted[key]
+        return rows[bisect.bisect_left(times, start):bisect.bisect_left(times, end)]
+
+    def grouped(self, statement, topic):
+        start, end = map(int, RANGE.search(statement).groups())
+        size = int(WINDOW.search(statement).group(1)) * 60
+        measurement = MEASUREMENT.search(statement).group(1)
+
+        buckets = {}
+        for t, s, c in self.rows(measurement, topic, start, end):
+            bucket = buckets.setdefault(t // size * size, [0.0, 0])
+            bucket[0] += s
+            bucket[1] += c
+        return sorted(buckets.items())
+
+    def write(self, topic, points):
+        self.raw[topic] = sorted(self.raw.get(topic, []) + points)
+        self.sorted = {}
+
+    def query(self, q, epoch=None, method='GET'):
+        check_statement(q)
+
+        if ' into ' in q:
+            measurement = q.split(' into ')[1].split()[0]
+            self.sorted = {key: rows for key, rows in self.sorted.items() if key[0] != measurement}
+            for topic in TOPICS:
+                table = self.tiers.setdefault(measurement, {}).setdefault(topic, {})
+                for t, (s, c) in self.grouped(q, topic):
+                    table[t] = (s, c)
+            return Result([])
+
+        if q.startswith('select first("value")'):
+            times = [points[0][0] for points in self.raw.values() if points]
+            return Result([dict(time=min(times))] if times else [])
+
+        if q.startswith('select last("count")'):
+            measurement = MEASUREMENT.search(q).group(1)
+            times = [max(table) for table in self.tiers.get(measurement, {}).values() if table]
+            return Result([dict(time=max(times))] if times else [])
+
+        topic = TOPIC.search(q).group(1)
+        return Result([dict(time=t, value=s / c) for t, (s, c) in self.grouped(q, topic)])
+
+
+class RealInflux:
+    """The InfluxDB client on a scratch database, checking statements on
+    their way to influxd"""
+
+    def __init__(self, address):
+        from influxdb import InfluxDBClient
+
+        host, port = address.split(':')
+        self.client = InfluxDBClient(host, int(port), database=DATABASE)
+        self.client.drop_database(DATABASE)
+        self.client.create_database(DATABASE)
+
+    def write(self, topic, points):
+        body = [dict(measurement='mqtt_consumer', tags=dict(topic=topic), time=t, fields=dict(value=v)) for t, v in points]
+        self.client.write_points(body, time_precision='s', batch_size=10000)
+
+    def query(self, q, epoch=None, method='GET'):
+        check_statement(q)
+        return self.client.query(q, epoch=epoch, method=method)
+
+    def close(self):
+        self.client.drop_database(DATABASE)
+
+
+def generate(client, now):
+    random.seed(4)
+    start = now - DAYS * 86400
+    for topic in TOPICS:
+        # one point a second at most, influxd keeps one per time and topic
+        times = random.sample(range(start, now - 3600), POINTS)
+        client.write(topic, [(t, random.uniform(-20, 400)) for t in times])
+    return start
+
+def write_late(client, start, end):
+    # points stamped between start and end, arriving now
+    for topic in TOPICS:
+        times = random.sample(range(start, end), POINTS // 100)
+        client.write(topic, [(t, random.uniform(-20, 400)) for t in times])
+
+def ranges(first, built):
+    # (start, end, window minutes), aligned to each tier and not
+    cases = []
+    for minutes in [1, 5, 7, 15, 30, 45, 60, 90, 120, 360, 1440]:
+        size = minutes * 60
+        for offset in [0, 30, 60, 420, 900, 3600, 5400, 86400 + 60]:
+            start = (first // 86400 + 1) * 86400 + offset
+            for length in [size * 3, 86400, 86400 * 2 + 900, 86400 * 5]:
+                end = start + length
+                if end <= built:
+                    cases.append((start, end, minutes))
+    return cases
+
+def differences(client, rollups, topic, start, end, minutes):
+    # (tier used, buckets that differ from the raw query, worst relative error)
+    statement = rollups.window_statement(topic, start, end, minutes)
+    if not statement:
+        return 'raw', 0, 0.0
+
+    raw = {p['time']: p['value'] for p in client.query(window_statement(topic, start, end, minutes)).get_points()}
+    tiered = {p['time']: p['value'] for p in client.query(statement).get_points()}
+
+    # buckets only one of them has count as differing
+    differ = len(raw.keys() ^ tiered.keys())
+    worst = 0.0
+    for t in raw.keys() & tiered.keys():
+        error = abs(raw[t] - tiered[t]) / max(abs(raw[t]), 1)
+        worst = max(worst, error)
+        if error >= TOLERANCE:
+            differ += 1
+    return MEASUREMENT.search(statement).group(1), differ, worst
+
+def check_late(client, rollups):
+    # late points within LATE_TIME of the newest 15 minute bucket
+    built = rollups.built_until['rollup_15m']
+    start = (built - rollup.LATE_TIME // 2) // 900 * 900
+    write_late(client, start, built - 60)
+
+    def compare():
+        differ = 0
+        for topic in TOPICS:
+            for minutes in [1, 15]:
+                tier, count, worst = differences(client, rollups, topic, start, built, minutes)
+                assert tier != 'raw', (topic, start, built, minutes)
+                differ += count
+        return differ
+
+    stale = compare()
+    rollups.build()
+    assert stale, 'late points changed nothing, the check is broken'
+    assert not compare(), 'late points missing from the tiers'
+    print('Late points changed {} buckets, all folded in by the next pass'.format(stale))
+
+def main():
+    client = RealInflux(INFLUXD) if INFLUXD else FakeInflux()
+    try:
+        check(client)
+    finally:
+        if INFLUXD:
+            client.close()
+
+def check(client):
+    now = int(time.time()) // 86400 * 86400
+    first = generate(client, now)
+
+    rollups = Rollups(client, TOPICS)
+    rollup.CHUNK_BUCKETS = 97   # build in uneven chunks like a catch-up would
+    rollups.load_progress()
+    rollups.build()
+    built = rollups.built_until[TIERS[-1][0]]
+    print('Built tiers until', ', '.join('{} {}'.format(m, rollups.built_until[m]) for m, _ in TIERS))
+
+    used = {}
+    compared = 0
+    worst = 0.0
+    for start, end, minutes in ranges(first, built):
+        for topic in TOPICS:
+            tier, differ, error = differences(client, rollups, topic, start, end, minutes)
+            used[tier] = used.get(tier, 0) + 1
+            assert not differ, (topic, start, end, minutes)
+            if tier != 'raw':
+                worst = max(worst, error)
+                compared += 1
+
+    print('Queries answered by:', ', '.join('{} {}'.format(k, v) for k, v in sorted(used.items())))
+    print('Compared {} tier answers with the raw query, worst relative error {:.2g}'.format(compared, worst))
+    assert compared and 'raw' in used and len(used) > 2
+
+    check_late(client, rollups)
+
+
+if __name__ == '__main__':
+    main()
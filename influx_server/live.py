@@ -0,0 +1,121 @@
+# Last-value table fed straight from MQTT.
+#
+# The sensors publish to the same broker telegraf reads from, so instead of
+# asking InfluxDB for last(value) on every request the latest reading of
+# each topic is kept in memory as it arrives. Values are only served while
+# the subscription is up; otherwise callers fall back to InfluxDB and seed
+# the table with what it returns.
+#
+# Enabled by setting MQTT_HOST. MQTT_PORT, MQTT_USERNAME, MQTT_PASSWORD and
+# MQTT_TLS (any value) are optional.
+
+import os
+import ssl
+import time
+import asyncio
+import logging
+import threading
+
+import aiomqtt
+
+from queries import parse_time
+from rolling import format_time
+
+MQTT_HOST = os.environ.get('MQTT_HOST')
+MQTT_PORT = int(os.environ.get('MQTT_PORT', 8883 if os.environ.get('MQTT_TLS') else 1883))
+MQTT_USERNAME = os.environ.get('MQTT_USERNAME')
+MQTT_PASSWORD = os.environ.get('MQTT_PASSWORD')
+MQTT_TLS = os.environ.get('MQTT_TLS')
+
+RECONNECT_DELAY = 5
+
+
+class LastValues:
+    def __init__(self, topics, filters=None, hub=None):
+        self.topics = set(topics)
+        self.hub = hub   # stream.Hub that new readings are published to
+        self.filters = filters or sorted(set(t.split('/')[0] + '/#' for t in topics))
+        self.values = {}   # topic -> (timestamp, point)
+        self.connected = False
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def set(self, topic, timestamp, value):
+        with self.lock:
+            current = self.values.get(topic)
+            if current and current[0] > timestamp:
+                return None
+            point = dict(time=format_time(timestamp), value=value)
+            self.values[topic] = (timestamp, point)
+            return point
+
+    def update(self, topic, payload, timestamp=None):
+        if topic not in self.topics:
+            return
+
+        try:
+            value = float(payload)
+        except ValueError:
+            logging.debug('Non-numeric payload on %s: %s', topic, payload)
+            return
+
+        point = self.set(topic, timestamp or time.time(), value)
+        if point and self.hub:
+            self.hub.publish(topic, point)
+
+    def seed(self, topic, point):
+        # point as returned by InfluxDB, won't replace a newer MQTT reading
+        self.set(topic, parse_time(point['time']), point['value'])
+
+    def snapshot(self, topics):
+        if not self.connected:
+            return {}
+        return {topic: self.values[topic][1] for topic in topics if topic in self.values}
+
+    def get(self, topic):
+        # returns None if the value can't be trusted to be the latest
+        if not self.connected:
+            return None
+
+        entry = self.values.get(topic)
+        return entry and entry[1]
+
+    async def run(self):
+        tls_params = aiomqtt.TLSParameters(cert_reqs=ssl.CERT_REQUIRED) if MQTT_TLS else None
+
+        while True:
+            try:
+                async with aiomqtt.Client(
+                    hostname=MQTT_HOST,
+                    port=MQTT_PORT,
+                    username=MQTT_USERNAME,
+                    password=MQTT_PASSWORD,
+                    tls_params=tls_params,
+                ) as client:
+                    for topic_filter in self.filters:
+                        await client.subscribe(topic_filter)
+
+                    logging.info('Subscribed to %s on %s', ', '.join(self.filters), MQTT_HOST)
+                    self.connected = True
+
+                    async for message in client.messages:
+                        try:
+                            self.update(message.topic.value, message.payload.decode())
+                        except (UnicodeDecodeError, ValueError) as e:
+                            logging.warning('Skipping bad message on %s: %s', message.topic.value, e)
+            except aiomqtt.MqttError as e:
+                logging.error('Lost MQTT connection: %s', e)
+            except Exception as e:
+                logging.exception('Problem with MQTT subscription, reconnecting: %s', e)
+            finally:
+                # readings may be missed while disconnected, start over
+                self.connected = False
+                with self.lock:
+                    self.values = {}
+
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    def start(self):
+        # for the threaded server, runs the subscription on its own loop
+        self.thread = threading.Thread(target=lambda: asyncio.run(self.run()), daemon=True)
+        self.thread.start()
@@ -1,183 +1,276 @@
-from flask import Flask, abort, request
+import json
+import threading
+
+from flask import Flask, Response, abort, jsonify, request
 from flask_cors import CORS
 from influxdb import InfluxDBClient
-from datetime import datetime, timedelta
-import pytz
+from influxdb.resultset import ResultSet
+
+from cache import QueryCache
+from live import LastValues, MQTT_HOST
+from stream import Hub, KEEPALIVE, format_event
+from rolling import RollingWindows, window_statement, iter_moving_average, moving_average as average_points
+from rollup import Rollups
+from queries import (
+    DOMAINS, SENSORS, TOPICS, FORMATS, INCREMENTAL_LOOKUPS, LAST_VALUE_TTL, STREAM_CHUNK_SIZE, API_DOCS,
+    parse_spec, parse_sensors, lookup_range, open_end, last_statement, raw_statement, columnar, format_points,
+    encode_rows, cache_headers, not_modified, plan_batch, finish_batch,
+)
 
 app = Flask(__name__)
 CORS(app)
-client = InfluxDBClient('localhost', 8086, database='telegraf')
-
-SENSORS = [
-    ('air', 0, 'pm25'),
-    ('air', 0, 'temp'),
-    ('air', 1, 'pm25'),
-    ('air', 1, 'temp'),
-    ('sound', 0, 'db'),
-]
-
-TIMEZONE = pytz.timezone('America/Edmonton')
+DATABASE = 'telegraf'
+client = InfluxDBClient('localhost', 8086, database=DATABASE)
+
+# msgpack responses are read whole by the client, ask for JSON lines when
+# streaming so chunks can be handed on as they arrive
+stream_client = InfluxDBClient('localhost', 8086, database=DATABASE, headers={'Accept': 'application/json'})
+
+# the client's own chunked reading goes through iter_lines() 512 bytes at a
+# time, which rescans the line so far on every read, so lines are read here
+STREAM_READ_SIZE = 256 * 1024
+
+cache = QueryCache(max_points=200000)
+rollups = Rollups(client, TOPICS)
+hub = Hub()
+last_values = LastValues(TOPICS, hub=hub)
+
+def tiered_statement(topic, start, end, window):
+    return rollups.window_statement(topic, start, end, window) or window_statement(topic, start, end, window)
+
+rolling = RollingWindows(statement=tiered_statement)
+
+def fetch_statements(statements):
+    results = client.query(';'.join(statements), epoch='s')
+    if not isinstance(results, list):
+        results = [results]
+    return [list(r.get_points()) for r in results]
+
+def stream_points(topic, start, end, window, moving_average):
+    window_minutes, average_count = parse_spec(window, moving_average)
+    statement = None
+
+    if window_minutes:
+        statement = rollups.window_statement(topic, start, end, window_minutes)
+
+    if not statement:
+        statement = raw_statement(topic, start, end, window, moving_average)
+        average_count = None
+
+    def points():
+        params = dict(q=statement, db=DATABASE, chunked='true', chunk_size=STREAM_CHUNK_SIZE)
+        response = stream_client.request('query', params=params, stream=True)
+        try:
+            for line in response.iter_lines(chunk_size=STREAM_READ_SIZE):
+                if line:
+                    for result in json.loads(line).get('results', []):
+                        yield from ResultSet(result).get_points()
+        finally:
+            response.close()
+
+    if average_count:
+        return iter_moving_average(points(), average_count)
+    return points()
+
+def history_query(topic, lookup, start, end, window, moving_average):
+    window_minutes, average_count = parse_spec(window, moving_average)
+
+    if window_minutes:
+        if lookup in INCREMENTAL_LOOKUPS:
+            result = rolling.query(fetch_statements, topic, start, open_end(lookup, end), window_minutes, average_count)
+            if result is not None:
+                return result
+
+        statement = rollups.window_statement(topic, start, end, window_minutes)
+        if statement:
+            result = list(client.query(statement).get_points())
+            if average_count:
+                result = average_points(result, average_count)
+            return result
+
+    q = raw_statement(topic, start, end, window, moving_average)
+    return list(client.query(q).get_points())
+
+def batch_query(topics, lookup, start, end, window, average_count):
+    plans, statements = plan_batch(rolling, tiered_statement, topics, lookup, start, end, window)
+    series = finish_batch(rolling, plans, fetch_statements(statements), average_count)
+
+    for i, topic in enumerate(topics):
+        if series[i] is None:
+            points = fetch_statements([tiered_statement(topic, start, end, window)])[0]
+            series[i] = format_points(points, average_count)
+
+    return series
+
+def conditional_response(response, key, output, ttl, result):
+    headers = cache_headers(key, output, ttl, response.get_data(), result)
+    if not_modified(request.headers, headers, ttl):
+        return Response(status=304, headers=headers)
+
+    response.headers.update(headers)
+    return response
+
+def closed_not_modified(key, output, ttl):
+    # returns a 304 response if the client already has this closed range
+    if ttl is not None:
+        return None
+
+    headers = cache_headers(key, output, ttl)
+    if not_modified(request.headers, headers, ttl):
+        return Response(status=304, headers=headers)
+    return None
 
 @app.route('/')
 def index():
-    return '''<pre>
-Protospace IoT API Docs
-=======================
-
-This API allows you to get data from Protospace sensors.
-
-
-Sensors
--------
-
-Air:
-    0: Classroom ceiling PM2.5 particulate in ug/m3 and temperature sensor.
-    1: Wood shop ceiling PM2.5 particulate in ug/m3 and temperature sensor.
+    return API_DOCS
 
+@app.route('/<string:domain>/<string:kind>/<int:num>/<string:measurement>')
+def sensors(domain, kind, num, measurement):
+    if (kind, num, measurement) not in SENSORS:
+        abort(404)
 
-Routes
-------
-
-<b>GET /sensors/{kind}/{num}/{measurement}</b>
-
-Get the last value recorded for that sensor.
+    if domain not in DOMAINS:
+        abort(404)
 
-Current measurements:
-    /sensors/air/0/temp
-    /sensors/air/0/pm25
-    /sensors/air/1/temp
-    /sensors/air/1/pm25
+    topic = '{}/{}/{}/{}'.format(domain, kind, num, measurement)
+    result = last_values.get(topic)
+    if result:
+        return result
 
-Examples:
-    <a href="https://ps-iot.dns.t0.vc/sensors/air/0/temp">https://ps-iot.dns.t0.vc/sensors/air/0/temp</a>
-    <a href="https://ps-iot.dns.t0.vc/sensors/air/0/pm25">https://ps-iot.dns.t0.vc/sensors/air/0/pm25</a>
-    <a href="https://ps-iot.dns.t0.vc/sensors/air/1/temp">https://ps-iot.dns.t0.vc/sensors/air/1/temp</a>
-    <a href="https://ps-iot.dns.t0.vc/sensors/air/1/pm25">https://ps-iot.dns.t0.vc/sensors/air/1/pm25</a>
+    q = last_statement(topic)
+    key = (topic, None, None, None, None)
+    result = cache.get_or_compute(key, LAST_VALUE_TTL, lambda: list(client.query(q).get_points())[0])
+    last_values.seed(topic, result)
 
+    return result
 
-<b>GET /sensors/{kind}/{num}/{measurement}/today</b>
+@app.route('/<string:domain>/<string:kind>/<int:num>/<string:measurement>/<string:lookup>')
+def sensors_history(domain, kind, num, measurement, lookup):
+    if (kind, num, measurement) not in SENSORS:
+        abort(404)
 
-Get all sensor readings from today so far (Calgary timezone).
+    if domain not in DOMAINS:
+        abort(404)
 
-Examples:
-    <a href="https://ps-iot.dns.t0.vc/sensors/air/0/temp/today">https://ps-iot.dns.t0.vc/sensors/air/0/temp/today</a>
-    <a href="https://ps-iot.dns.t0.vc/sensors/air/0/pm25/today">https://ps-iot.dns.t0.vc/sensors/air/0/pm25/today</a>
+    window = request.args.get('window', 15)
+    moving_average = request.args.get('moving_average', None)
+    output = request.args.get('format', 'json')
 
+    if output not in FORMATS:
+        abort(400)
 
-<b>GET /sensors/{kind}/{num}/{measurement}/{duration}</b>
+    topic = '{}/{}/{}/{}'.format(domain, kind, num, measurement)
+    time_range = lookup_range(lookup)
+    if not time_range:
+        abort(404)
+    start, end, ttl = time_range
 
-Get all sensor readings from the specified duration.
+    key = (topic, start, end, str(window), moving_average)
 
-Current durations:
-    day (last 24 hours)
-    week (last 7 days)
-    month (last 30 days)
+    response = closed_not_modified(key, output, ttl)
+    if response:
+        return response
 
-Examples:
-    <a href="https://ps-iot.dns.t0.vc/sensors/air/0/temp/day">https://ps-iot.dns.t0.vc/sensors/air/0/temp/day</a>
-    <a href="https://ps-iot.dns.t0.vc/sensors/air/0/temp/week">https://ps-iot.dns.t0.vc/sensors/air/0/temp/week</a>
-    <a href="https://ps-iot.dns.t0.vc/sensors/air/0/temp/month">https://ps-iot.dns.t0.vc/sensors/air/0/temp/month</a>
+    if output in ['ndjson', 'csv']:
+        points = cache.get(key)
+        if points is None:
+            points = stream_points(topic, start, end, window, moving_average)
 
+        # streamed before the body is known, so only closed ranges get a tag
+        headers = cache_headers(key, output, ttl) if ttl is None else {}
+        mimetype = 'text/csv' if output == 'csv' else 'application/x-ndjson'
+        return Response(encode_rows(points, output), mimetype=mimetype, headers=headers)
 
-<b>GET /sensors/{kind}/{num}/{measurement}/{date}</b>
+    result = cache.get_or_compute(key, ttl, lambda: history_query(topic, lookup, start, end, window, moving_average))
 
-Get all sensor readings from the specified date (Calgary timezone).
+    if output == 'columnar':
+        response = jsonify(columnar(result))
+    else:
+        response = jsonify(result=result)
+    return conditional_response(response, key, output, ttl, result)
 
-Date format:
-    YYYY-MM-DD
+@app.route('/<string:domain>/batch/<string:lookup>')
+def sensors_batch(domain, lookup):
+    if domain not in DOMAINS:
+        abort(404)
 
-Example:
-    <a href="https://ps-iot.dns.t0.vc/sensors/air/0/temp/2021-06-26">https://ps-iot.dns.t0.vc/sensors/air/0/temp/2021-06-26</a>
+    window = request.args.get('window', 15)
+    moving_average = request.args.get('moving_average', None)
 
+    try:
+        sensors = parse_sensors(request.args.get('sensors', None))
+    except ValueError:
+        abort(400)
 
-Parameters
-----------
+    if any(sensor not in SENSORS for sensor in sensors):
+        abort(404)
 
-These query parameters apply to the previous three routes.
+    window_minutes, average_count = parse_spec(window, moving_average)
+    if not window_minutes:
+        abort(400)
 
-<b>?window={n}</b>
+    time_range = lookup_range(lookup)
+    if not time_range:
+        abort(404)
+    start, end, ttl = time_range
 
-Average samples into windows of n minutes. The default is 15 minutes and the minimum is 1 minute.
+    topics = ['{}/{}/{}/{}'.format(domain, *sensor) for sensor in sensors]
 
-Examples:
-    <a href="https://ps-iot.dns.t0.vc/sensors/air/0/pm25/2021-06-26?window=10">https://ps-iot.dns.t0.vc/sensors/air/0/pm25/2021-06-26?window=10</a>
-    <a href="https://ps-iot.dns.t0.vc/sensors/air/0/pm25/today?window=60">https://ps-iot.dns.t0.vc/sensors/air/0/pm25/today?window=60</a>
+    def run_query():
+        series = batch_query(topics, lookup, start, end, window_minutes, average_count)
+        return {'{}/{}/{}'.format(*sensor): points for sensor, points in zip(sensors, series)}
 
-<b>?moving_average={n}</b>
+    key = (tuple(topics), start, end, str(window), moving_average)
 
-Apply a moving average of the previous n samples to each window. The minimum is 2.
+    response = closed_not_modified(key, 'json', ttl)
+    if response:
+        return response
 
-Examples:
-    <a href="https://ps-iot.dns.t0.vc/sensors/air/0/pm25/2021-06-26?moving_average=10">https://ps-iot.dns.t0.vc/sensors/air/0/pm25/2021-06-26?moving_average=10</a>
-    <a href="https://ps-iot.dns.t0.vc/sensors/air/0/pm25/today?window=1&moving_average=100">https://ps-iot.dns.t0.vc/sensors/air/0/pm25/today?window=1&moving_average=100</a>
-</pre>'''
+    result = cache.get_or_compute(key, ttl, run_query)
 
-@app.route('/<string:domain>/<string:kind>/<int:num>/<string:measurement>')
-def sensors(domain, kind, num, measurement):
-    if (kind, num, measurement) not in SENSORS:
-        abort(404)
+    return conditional_response(jsonify(result=result), key, 'json', ttl, result)
 
-    if domain not in ['sensors', 'test']:
+@app.route('/<string:domain>/live')
+def sensors_live(domain):
+    if domain not in DOMAINS:
         abort(404)
 
-    topic = '{}/{}/{}/{}'.format(domain, kind, num, measurement)
-    q = 'select last(value) as value from mqtt_consumer where "topic" = \'' + topic + '\''
-    result = list(client.query(q).get_points())[0]
+    if not MQTT_HOST:
+        abort(503)
 
-    return result
+    try:
+        sensors = parse_sensors(request.args.get('sensors', None))
+    except ValueError:
+        abort(400)
 
-@app.route('/<string:domain>/<string:kind>/<int:num>/<string:measurement>/<string:lookup>')
-def sensors_history(domain, kind, num, measurement, lookup):
-    if (kind, num, measurement) not in SENSORS:
+    if any(sensor not in SENSORS for sensor in sensors):
         abort(404)
 
-    if domain not in ['sensors', 'test']:
-        abort(404)
+    topics = ['{}/{}/{}/{}'.format(domain, *sensor) for sensor in sensors]
 
-    window = request.args.get('window', 15)
-    moving_average = request.args.get('moving_average', None)
+    def events():
+        wakeup = threading.Event()
+        subscriber = hub.subscribe(topics, wakeup.set)
 
-    topic = '{}/{}/{}/{}'.format(domain, kind, num, measurement)
+        try:
+            for topic, point in last_values.snapshot(topics).items():
+                yield format_event(topic, point)
 
-    try:
-        parse_date = datetime.strptime(lookup, '%Y-%m-%d')
-        start = TIMEZONE.localize(parse_date)
-        end = start + timedelta(days=1)
-    except ValueError:
-        now = datetime.now(tz=TIMEZONE)
-
-        if lookup == 'today':
-            start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-            end = now
-        elif lookup == 'day':
-            start = now - timedelta(days=1)
-            end = now
-        elif lookup == 'week':
-            start = now - timedelta(days=7)
-            end = now
-        elif lookup == 'month':
-            start = now - timedelta(days=30)
-            end = now
-        else:
-            abort(404)
-
-    start = int(start.timestamp())
-    end = int(end.timestamp())
-
-
-    if window and moving_average:
-        q = 'select moving_average(mean("value"),{}) as value from mqtt_consumer where "topic" = \'{}\' and time >= {}s and time < {}s group by time({}m) fill(none)'.format(moving_average, topic, start, end, window)
-    elif window:
-        q = 'select mean("value") as value from mqtt_consumer where "topic" = \'{}\' and time >= {}s and time < {}s group by time({}m) fill(none)'.format(topic, start, end, window)
-    elif moving_average:
-        q = 'select moving_average("value", {}) as value from mqtt_consumer where "topic" = \'{}\' and time >= {}s and time < {}s'.format(moving_average, topic, start, end)
-    else:
-        q = 'select value from mqtt_consumer where "topic" = \'{}\' and time >= {}s and time < {}s'.format(moving_average, topic, start, end)
+            while True:
+                if not wakeup.wait(KEEPALIVE):
+                    yield ': keepalive\n\n'
+                    continue
 
-    result = list(client.query(q).get_points())
+                wakeup.clear()
+                yield ''.join(subscriber.drain())
+        finally:
+            hub.unsubscribe(subscriber)
 
-    return dict(result=result)
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 
 if __name__ == '__main__':
+    rollups.start()
+    if MQTT_HOST:
+        last_values.start()
     app.run(port=6900)
@@ -0,0 +1,403 @@
+# Sensor list, lookups and InfluxQL statements shared by the Flask server in
+# main.py and the asyncio server in async_server.py. Nothing in here does I/O.
+
+from datetime import datetime, timedelta, timezone
+from email.utils import formatdate, parsedate_to_datetime
+import hashlib
+import json
+import pytz
+
+from rolling import format_time, moving_average
+
+DOMAINS = ['sensors', 'test']
+
+SENSORS = [
+    ('air', 0, 'pm25'),
+    ('air', 0, 'temp'),
+    ('air', 1, 'pm25'),
+    ('air', 1, 'temp'),
+    ('sound', 0, 'db'),
+]
+
+TOPICS = ['{}/{}/{}/{}'.format(domain, *sensor) for domain in DOMAINS for sensor in SENSORS]
+
+TIMEZONE = pytz.timezone('America/Edmonton')
+
+# how long to cache results, in seconds. Ranges that end this long before
+# now are treated as closed and cached until evicted.
+LAST_VALUE_TTL = 5
+OPEN_RANGE_TTL = 60
+CLOSED_RANGE_AGE = 3600
+
+# how long clients may keep responses for ranges that can't change anymore
+CLOSED_MAX_AGE = 365 * 24 * 60 * 60
+
+# rolling lookups have their end time rounded down to this many seconds so
+# that requests within the same step share a cache entry. The incremental
+# ones are still read up to now, see open_end().
+ROLLING_TTL = dict(
+    today=60,
+    day=60,
+    week=300,
+    month=900,
+)
+
+# lookups answered by the incremental window aggregation in rolling.py
+INCREMENTAL_LOOKUPS = ['day', 'week', 'month']
+
+# json and columnar are built in memory, ndjson and csv are streamed
+FORMATS = ['json', 'columnar', 'ndjson', 'csv']
+STREAM_CHUNK_SIZE = 10000
+STREAM_ROWS_PER_WRITE = 1000
+
+API_DOCS = '''<pre>
+Protospace IoT API Docs
+=======================
+
+This API allows you to get data from Protospace sensors.
+
+
+Sensors
+-------
+
+Air:
+    0: Classroom ceiling PM2.5 particulate in ug/m3 and temperature sensor.
+    1: Wood shop ceiling PM2.5 particulate in ug/m3 and temperature sensor.
+
+
+Routes
+------
+
+<b>GET /sensors/{kind}/{num}/{measurement}</b>
+
+Get the last value recorded for that sensor.
+
+Current measurements:
+    /sensors/air/0/temp
+    /sensors/air/0/pm25
+    /sensors/air/1/temp
+    /sensors/air/1/pm25
+
+Examples:
+    <a href="https://ps-iot.dns.t0.vc/sensors/air/0/temp">https://ps-iot.dns.t0.vc/sensors/air/0/temp</a>
+    <a href="https://ps-iot.dns.t0.vc/sensors/air/0/pm25">https://ps-iot.dns.t0.vc/sensors/air/0/pm25</a>
+    <a href="https://ps-iot.dns.t0.vc/sensors/air/1/temp">https://ps-iot.dns.t0.vc/sensors/air/1/temp</a>
+    <a href="https://ps-iot.dns.t0.vc/sensors/air/1/pm25">https://ps-iot.dns.t0.vc/sensors/air/1/pm25</a>
+
+
+<b>GET /sensors/{kind}/{num}/{measurement}/today</b>
+
+Get all sensor readings from today so far (Calgary timezone).
+
+Examples:
+    <a href="https://ps-iot.dns.t0.vc/sensors/air/0/temp/today">https://ps-iot.dns.t0.vc/sensors/air/0/temp/today</a>
+    <a href="https://ps-iot.dns.t0.vc/sensors/air/0/pm25/today">https://ps-iot.dns.t0.vc/sensors/air/0/pm25/today</a>
+
+
+<b>GET /sensors/{kind}/{num}/{measurement}/{duration}</b>
+
+Get all sensor readings from the specified duration.
+
+Current durations:
+    day (last 24 hours)
+    week (last 7 days)
+    month (last 30 days)
+
+Results are cached, so they can be up to a minute behind for today and day,
+5 minutes for week and 15 minutes for month.
+
+Examples:
+    <a href="https://ps-iot.dns.t0.vc/sensors/air/0/temp/day">https://ps-iot.dns.t0.vc/sensors/air/0/temp/day</a>
+    <a href="https://ps-iot.dns.t0.vc/sensors/air/0/temp/week">https://ps-iot.dns.t0.vc/sensors/air/0/temp/week</a>
+    <a href="https://ps-iot.dns.t0.vc/sensors/air/0/temp/month">https://ps-iot.dns.t0.vc/sensors/air/0/temp/month</a>
+
+
+<b>GET /sensors/{kind}/{num}/{measurement}/{date}</b>
+
+Get all sensor readings from the specified date (Calgary timezone).
+
+Date format:
+    YYYY-MM-DD
+
+Example:
+    <a href="https://ps-iot.dns.t0.vc/sensors/air/0/temp/2021-06-26">https://ps-iot.dns.t0.vc/sensors/air/0/temp/2021-06-26</a>
+
+
+<b>GET /sensors/batch/{lookup}?sensors={kind}/{num}/{measurement},...</b>
+
+Get the readings of several sensors at once. The lookup is any of today, a
+duration or a date from above. Leave out sensors to get all of them.
+Results are keyed by {kind}/{num}/{measurement}.
+
+Example:
+    <a href="https://ps-iot.dns.t0.vc/sensors/batch/day?sensors=air/0/pm25,air/1/pm25">https://ps-iot.dns.t0.vc/sensors/batch/day?sensors=air/0/pm25,air/1/pm25</a>
+
+
+<b>GET /sensors/live?sensors={kind}/{num}/{measurement},...</b>
+
+Server-sent event stream of readings as they arrive. Each "reading" event
+has the topic, time and value as JSON, starting with the latest value of
+every sensor. Leave out sensors to get all of them. Slow clients miss the
+oldest readings rather than falling behind.
+
+Example:
+    <a href="https://ps-iot.dns.t0.vc/sensors/live?sensors=air/0/pm25">https://ps-iot.dns.t0.vc/sensors/live?sensors=air/0/pm25</a>
+
+
+Parameters
+----------
+
+These query parameters apply to the today, duration, date and batch routes
+above. The live route takes none of them.
+
+<b>?window={n}</b>
+
+Average samples into windows of n minutes. The default is 15 minutes and the minimum is 1 minute.
+
+Examples:
+    <a href="https://ps-iot.dns.t0.vc/sensors/air/0/pm25/2021-06-26?window=10">https://ps-iot.dns.t0.vc/sensors/air/0/pm25/2021-06-26?window=10</a>
+    <a href="https://ps-iot.dns.t0.vc/sensors/air/0/pm25/today?window=60">https://ps-iot.dns.t0.vc/sensors/air/0/pm25/today?window=60</a>
+
+<b>?moving_average={n}</b>
+
+Apply a moving average of the previous n samples to each window. The minimum is 2.
+
+Examples:
+    <a href="https://ps-iot.dns.t0.vc/sensors/air/0/pm25/2021-06-26?moving_average=10">https://ps-iot.dns.t0.vc/sensors/air/0/pm25/2021-06-26?moving_average=10</a>
+    <a href="https://ps-iot.dns.t0.vc/sensors/air/0/pm25/today?window=1&moving_average=100">https://ps-iot.dns.t0.vc/sensors/air/0/pm25/today?window=1&moving_average=100</a>
+
+<b>?format={json|columnar|ndjson|csv}</b>
+
+Single sensor routes only. json is the default. columnar returns parallel
+time and value arrays with times as epoch seconds. ndjson and csv stream
+one reading per line as they are read from the database, so the first
+readings arrive right away and memory stays flat, which is best for large
+ranges. ndjson takes longer to finish than json though, up to twice as
+long, since each line is encoded on its own. csv finishes about as fast
+as json.
+
+Examples:
+    <a href="https://ps-iot.dns.t0.vc/sensors/air/0/pm25/month?window=1&format=columnar">https://ps-iot.dns.t0.vc/sensors/air/0/pm25/month?window=1&format=columnar</a>
+    <a href="https://ps-iot.dns.t0.vc/sensors/air/0/pm25/month?window=1&format=csv">https://ps-iot.dns.t0.vc/sensors/air/0/pm25/month?window=1&format=csv</a>
+</pre>'''
+
+
+def range_ttl(end):
+    if end <= datetime.now(tz=TIMEZONE).timestamp() - CLOSED_RANGE_AGE:
+        return None
+    return OPEN_RANGE_TTL
+
+def parse_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def parse_spec(window, moving_average):
+    # returns window minutes and moving average count, or None for both if
+    # they can't be served from rollups or the incremental buckets
+    window_minutes = parse_int(window)
+    average_count = parse_int(moving_average)
+
+    if not window_minutes or window_minutes < 1:
+        return None, None
+    if moving_average and (not average_count or average_count < 2):
+        return None, None
+
+    return window_minutes, average_count
+
+def parse_sensors(names):
+    # raises ValueError if a name isn't kind/num/measurement
+    if not names:
+        return SENSORS
+
+    sensors = []
+    for name in names.split(','):
+        kind, num, measurement = name.split('/')
+        sensors.append((kind, int(num), measurement))
+    return sensors
+
+def lookup_range(lookup):
+    # returns the start and end timestamps and the cache TTL for a lookup,
+    # or None if the lookup isn't known
+    try:
+        parse_date = datetime.strptime(lookup, '%Y-%m-%d')
+        start = TIMEZONE.localize(parse_date)
+        end = start + timedelta(days=1)
+        ttl = range_ttl(end.timestamp())
+    except ValueError:
+        now = datetime.now(tz=TIMEZONE)
+
+        if lookup in ROLLING_TTL:
+            ttl = ROLLING_TTL[lookup]
+            now = datetime.fromtimestamp(int(now.timestamp()) // ttl * ttl, tz=TIMEZONE)
+
+        if lookup == 'today':
+            start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+            end = now
+        elif lookup == 'day':
+            start = now - timedelta(days=1)
+            end = now
+        elif lookup == 'week':
+            start = now - timedelta(days=7)
+            end = now
+        elif lookup == 'month':
+            start = now - timedelta(days=30)
+            end = now
+        else:
+            return None
+
+    return int(start.timestamp()), int(end.timestamp()), ttl
+
+def open_end(lookup, end):
+    # the end to read an incremental lookup up to. Its range is rounded for
+    # the cache key, but reading on to now only adds a little to the tail
+    # query, and keeps month from lagging by the rounding on top of the TTL.
+    if lookup in INCREMENTAL_LOOKUPS:
+        return max(end, int(datetime.now(tz=TIMEZONE).timestamp()))
+    return end
+
+def last_statement(topic):
+    return 'select last(value) as value from mqtt_consumer where "topic" = \'' + topic + '\''
+
+def raw_statement(topic, start, end, window, moving_average):
+    if window and moving_average:
+        q = 'select moving_average(mean("value"),{}) as value from mqtt_consumer where "topic" = \'{}\' and time >= {}s and time < {}s group by time({}m) fill(none)'.format(moving_average, topic, start, end, window)
+    elif window:
+        q = 'select mean("value") as value from mqtt_consumer where "topic" = \'{}\' and time >= {}s and time < {}s group by time({}m) fill(none)'.format(topic, start, end, window)
+    elif moving_average:
+        q = 'select moving_average("value", {}) as value from mqtt_consumer where "topic" = \'{}\' and time >= {}s and time < {}s'.format(moving_average, topic, start, end)
+    else:
+        q = 'select value from mqtt_consumer where "topic" = \'{}\' and time >= {}s and time < {}s'.format(moving_average, topic, start, end)
+
+    return q
+
+def parse_time(value):
+    # InfluxDB's RFC3339 times can have up to nanosecond precision, which
+    # fromisoformat() doesn't take, so only the seconds are kept
+    return int(datetime.fromisoformat(value[:19]).replace(tzinfo=timezone.utc).timestamp())
+
+def columnar(points):
+    return dict(
+        time=[parse_time(p['time']) for p in points],
+        value=[p['value'] for p in points],
+    )
+
+def make_etag(data):
+    return '"{}"'.format(hashlib.sha1(data).hexdigest())
+
+def key_etag(key, output):
+    # closed ranges never change, so their tag only depends on the request
+    # and can be checked before anything is queried
+    return make_etag(repr((key, output)).encode())
+
+def newest_time(result):
+    if isinstance(result, dict):
+        times = [newest_time(points) for points in result.values()]
+        return max([t for t in times if t is not None], default=None)
+
+    if not result:
+        return None
+    return parse_time(result[-1]['time'])
+
+def cache_headers(key, output, ttl, body=None, result=None):
+    # body is needed for open ranges, whose tag is a hash of the response
+    if ttl is None:
+        headers = {
+            'ETag': key_etag(key, output),
+            'Cache-Control': 'public, max-age={}, immutable'.format(CLOSED_MAX_AGE),
+        }
+    else:
+        headers = {
+            'ETag': make_etag(body),
+            'Cache-Control': 'no-cache',
+        }
+
+    modified = newest_time(result) if result is not None else None
+    if modified:
+        headers['Last-Modified'] = formatdate(modified, usegmt=True)
+    return headers
+
+def not_modified(request_headers, headers, ttl):
+    if_none_match = request_headers.get('If-None-Match')
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+        return '*' in tags or headers['ETag'] in tags
+
+    # newest point times are bucket starts, so they don't move when a bucket
+    # of an open range is updated. Only trust them once the range is closed.
+    if_modified_since = request_headers.get('If-Modified-Since')
+    if if_modified_since and ttl is None and 'Last-Modified' in headers:
+        try:
+            return parsedate_to_datetime(headers['Last-Modified']) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+def format_points(points, average_count=None):
+    # points queried with epoch second times to the usual output
+    points = [dict(time=format_time(p['time']), value=p['value']) for p in points]
+    if average_count:
+        points = moving_average(points, average_count)
+    return points
+
+def encode_rows(points, output, header=True):
+    # batch rows so each write to the client isn't a single line
+    rows = []
+    if output == 'csv' and header:
+        rows.append('time,value\n')
+
+    for point in points:
+        if output == 'csv':
+            rows.append('{},{}\n'.format(point['time'], point['value']))
+        else:
+            rows.append(json.dumps(point) + '\n')
+
+        if len(rows) >= STREAM_ROWS_PER_WRITE:
+            yield ''.join(rows)
+            rows = []
+
+    if rows:
+        yield ''.join(rows)
+
+def plan_batch(rolling, statement, topics, lookup, start, end, window):
+    # plans every topic up front so they can all go to InfluxDB in one
+    # request. Returns the plans and the statements to run with epoch='s'.
+    plans = []
+    statements = []
+
+    for topic in topics:
+        plan = None
+        if lookup in INCREMENTAL_LOOKUPS:
+            plan = rolling.plan(topic, start, open_end(lookup, end), window)
+
+        if plan:
+            topic_statements = rolling.statements(plan, topic, window)
+        else:
+            topic_statements = [statement(topic, start, end, window)]
+
+        plans.append((topic, plan, len(topic_statements)))
+        statements += topic_statements
+
+    return plans, statements
+
+def finish_batch(rolling, plans, results, average_count):
+    # returns one point list per topic, or None where the incremental
+    # buckets changed meanwhile and the topic has to be queried again
+    series = []
+
+    for topic, plan, count in plans:
+        topic_results, results = results[:count], results[count:]
+
+        if plan:
+            points = rolling.finish(plan, topic_results)
+            if points is not None and average_count:
+                points = moving_average(points, average_count)
+        else:
+            points = format_points(topic_results[0], average_count)
+
+        series.append(points)
+
+    return series
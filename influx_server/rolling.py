@@ -0,0 +1,184 @@
+# Incremental window aggregation for the rolling day / week / month lookups.
+#
+# Window buckets that closed before now never change, so they are kept in
+# memory per (topic, window) and only the partial buckets at either end of
+# the range are asked from InfluxDB each time. The stitched result matches
+# what a single "group by time(Nm) fill(none)" query over the range returns.
+
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+
+# buckets are only stored once they ended this many seconds ago so late
+# points from telegraf still land in them
+SETTLE_TIME = 60
+
+# longest range served from the stores, older buckets are pruned
+RETENTION = 31 * 24 * 60 * 60
+
+MAX_STORES = 32
+
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def window_statement(topic, start, end, window):
+    return 'select mean("value") as value from mqtt_consumer where "topic" = \'{}\' and time >= {}s and time < {}s group by time({}m) fill(none)'.format(topic, start, end, window)
+
+def iter_moving_average(points, n):
+    # same as InfluxDB's moving_average(): the mean of each run of n points,
+    # stamped with the time of the last point in the run
+    run = deque()
+    total = 0
+
+    for point in points:
+        run.append(point['value'])
+        total += point['value']
+        if len(run) > n:
+            total -= run.popleft()
+        if len(run) == n:
+            yield dict(time=point['time'], value=total / n)
+
+def moving_average(points, n):
+    return list(iter_moving_average(points, n))
+
+
+class WindowStore:
+    def __init__(self, size):
+        self.size = size
+        self.buckets = {}   # bucket start timestamp -> mean value
+        self.covered = None   # (start, end) range that buckets are known for
+        self.lock = threading.Lock()
+
+    def missing(self, start, end):
+        with self.lock:
+            if not self.covered:
+                return [(start, end)]
+
+            covered_start, covered_end = self.covered
+            if start > covered_end or end < covered_start:
+                return [(start, end)]
+
+            ranges = []
+            if start < covered_start:
+                ranges.append((start, covered_start))
+            if end > covered_end:
+                ranges.append((covered_end, end))
+            return ranges
+
+    def add(self, start, end, points):
+        with self.lock:
+            if self.covered and (start > self.covered[1] or end < self.covered[0]):
+                # not contiguous with what we have, start over
+                self.buckets = {}
+                self.covered = None
+
+            for point in points:
+                self.buckets[point['time']] = point['value']
+
+            if self.covered:
+                start = min(start, self.covered[0])
+                end = max(end, self.covered[1])
+            self.covered = (start, end)
+
+    def prune(self, before):
+        before = -(-before // self.size) * self.size
+
+        with self.lock:
+            if not self.covered or self.covered[0] >= before:
+                return
+
+            self.buckets = {t: v for t, v in self.buckets.items() if t >= before}
+            self.covered = (min(before, self.covered[1]), self.covered[1])
+
+    def points(self, start, end):
+        # returns None if part of the range was pruned or reset meanwhile
+        with self.lock:
+            if not self.covered or start < self.covered[0] or end > self.covered[1]:
+                return None
+
+            times = sorted(t for t in self.buckets if start <= t < end)
+            return [dict(time=format_time(t), value=self.buckets[t]) for t in times]
+
+
+class Plan:
+    def __init__(self, store, start, end, head_end, tail_start, fills):
+        self.store = store
+        self.start = start
+        self.end = end
+        self.head_end = head_end
+        self.tail_start = tail_start
+        self.fills = fills
+
+        self.ranges = list(fills)
+        if start < head_end:
+            self.ranges.insert(0, (start, head_end))
+        self.ranges.append((tail_start, end))
+
+
+class RollingWindows:
+    def __init__(self, statement=window_statement):
+        # statement builds the query for one window aligned range
+        self.statement = statement
+        self.stores = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_store(self, topic, window):
+        key = (topic, window)
+
+        with self.lock:
+            if key not in self.stores:
+                self.stores[key] = WindowStore(window * 60)
+                while len(self.stores) > MAX_STORES:
+                    self.stores.popitem(last=False)
+
+            self.stores.move_to_end(key)
+            return self.stores[key]
+
+    def plan(self, topic, start, end, window):
+        # returns None if the range is too short to have any closed buckets
+        size = window * 60
+        head_end = -(-start // size) * size
+        tail_start = (end - SETTLE_TIME) // size * size
+
+        if tail_start <= head_end:
+            return None
+
+        store = self.get_store(topic, window)
+        fills = store.missing(head_end, tail_start)
+        return Plan(store, start, end, head_end, tail_start, fills)
+
+    def statements(self, plan, topic, window):
+        return [self.statement(topic, start, end, window) for start, end in plan.ranges]
+
+    def finish(self, plan, results):
+        # results are lists of points with epoch second times, one per
+        # statement in the same order
+        results = list(results)
+        head = results.pop(0) if plan.start < plan.head_end else []
+        tail = results.pop()
+
+        for (start, end), points in zip(plan.fills, results):
+            plan.store.add(start, end, points)
+        plan.store.prune(plan.end - RETENTION)
+
+        closed = plan.store.points(plan.head_end, plan.tail_start)
+        if closed is None:
+            return None
+
+        points = [dict(time=format_time(p['time']), value=p['value']) for p in head]
+        points += closed
+        points += [dict(time=format_time(p['time']), value=p['value']) for p in tail]
+        return points
+
+    def query(self, fetch, topic, start, end, window, moving_average_n=None):
+        # fetch takes a list of statements and returns a list of point lists
+        plan = self.plan(topic, start, end, window)
+        if not plan:
+            return None
+
+        points = self.finish(plan, fetch(self.statements(plan, topic, window)))
+
+        if points and moving_average_n:
+            points = moving_average(points, moving_average_n)
+        return points
@@ -0,0 +1,125 @@
+# Downsampled rollup series for sensor history.
+#
+# A background thread keeps sum and count of "value" per topic at fixed
+# resolutions in their own measurements, each tier built from the one below
+# it. Windowed history queries are then answered from the coarsest tier that
+# evenly divides the window and the range, instead of from raw points.
+# Storing sum and count rather than the mean keeps the result exact.
+#
+# Raw points can be written well after their timestamp, after an MQTT
+# backlog or a bridge outage. Every pass rebuilds the last LATE_TIME of
+# each tier so those are folded in, the rewritten buckets replace the old
+# ones. Points later than that are only in the raw data, and history from
+# the tiers leaves them out.
+
+import time
+import logging
+import threading
+
+# (measurement, minutes), finest first
+TIERS = [
+    ('rollup_1m', 1),
+    ('rollup_15m', 15),
+    ('rollup_1h', 60),
+    ('rollup_1d', 1440),
+]
+
+# raw points younger than this aren't rolled up yet, telegraf may still be
+# delivering them
+SETTLE_TIME = 300
+
+# how far behind where each tier is built until it's rebuilt every pass
+LATE_TIME = 3600
+
+RUN_INTERVAL = 60
+
+# most each tier is advanced by in one statement while catching up
+CHUNK_BUCKETS = 1440
+
+
+class Rollups:
+    def __init__(self, client, topics):
+        self.client = client
+        self.topics = topics
+        self.built_until = {}   # measurement -> timestamp tier is complete up to
+        self.thread = None
+
+    def topic_regex(self):
+        return '/^(' + '|'.join(t.replace('/', '\\/') for t in self.topics) + ')$/'
+
+    def window_statement(self, topic, start, end, window):
+        # returns None if no tier can answer this exactly
+        for measurement, minutes in reversed(TIERS):
+            size = minutes * 60
+
+            if window % minutes or start % size or end % size:
+                continue
+            if end > self.built_until.get(measurement, 0):
+                continue
+
+            return 'select sum("sum") / sum("count") as value from {} where "topic" = \'{}\' and time >= {}s and time < {}s group by time({}m) fill(none)'.format(measurement, topic, start, end, window)
+
+        return None
+
+    def load_progress(self):
+        source_start = None
+
+        for measurement, minutes in TIERS:
+            size = minutes * 60
+            q = 'select last("count") from {} where "topic" =~ {}'.format(measurement, self.topic_regex())
+            points = list(self.client.query(q, epoch='s').get_points())
+
+            if points:
+                self.built_until[measurement] = points[0]['time'] // size * size + size
+                continue
+
+            if source_start is None:
+                q = 'select first("value") from mqtt_consumer where "topic" =~ {}'.format(self.topic_regex())
+                points = list(self.client.query(q, epoch='s').get_points())
+                source_start = points[0]['time'] if points else int(time.time())
+
+            self.built_until[measurement] = source_start // size * size
+
+    def build_tier(self, index):
+        measurement, minutes = TIERS[index]
+        size = minutes * 60
+
+        if index == 0:
+            source = 'mqtt_consumer'
+            fields = 'sum("value") as sum, count("value") as count'
+            source_until = int(time.time()) - SETTLE_TIME
+        else:
+            source = TIERS[index - 1][0]
+            fields = 'sum("sum") as sum, sum("count") as count'
+            source_until = self.built_until[source]
+
+        target = source_until // size * size
+        start = min(self.built_until[measurement], (target - LATE_TIME) // size * size)
+
+        while start < target:
+            end = min(start + CHUNK_BUCKETS * size, target)
+            q = 'select {} into {} from {} where "topic" =~ {} and time >= {}s and time < {}s group by time({}m), "topic" fill(none)'.format(fields, measurement, source, self.topic_regex(), start, end, minutes)
+            self.client.query(q, method='POST')
+
+            self.built_until[measurement] = end
+            start = end
+
+    def build(self):
+        for index in range(len(TIERS)):
+            self.build_tier(index)
+
+    def run(self):
+        while True:
+            try:
+                if len(self.built_until) < len(TIERS):
+                    self.load_progress()
+                self.build()
+            except BaseException as e:
+                logging.error('Problem building rollups:')
+                logging.exception(e)
+
+            time.sleep(RUN_INTERVAL)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
@@ -0,0 +1,75 @@
+# Fan-out of live readings to server-sent event subscribers.
+#
+# Readings from the MQTT subscription in live.py are encoded once and
+# appended to every interested subscriber's queue. Queues are bounded and
+# drop their oldest event when a client falls behind, so a slow viewer
+# can't hold up the others or grow memory.
+
+import json
+import threading
+from collections import deque
+
+QUEUE_SIZE = 100
+
+# comment line sent when nothing else has been, keeps proxies from closing
+# an idle connection
+KEEPALIVE = 15
+
+
+def format_event(topic, point):
+    data = dict(topic=topic, time=point['time'], value=point['value'])
+    return 'event: reading\ndata: {}\n\n'.format(json.dumps(data))
+
+
+class Subscriber:
+    def __init__(self, topics, notify, size=QUEUE_SIZE):
+        self.topics = topics
+        self.notify = notify   # called from the publishing thread
+        self.queue = deque(maxlen=size)
+        self.dropped = 0
+
+    def put(self, event):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(event)
+        self.notify()
+
+    def drain(self):
+        events = []
+        while self.queue:
+            events.append(self.queue.popleft())
+        return events
+
+
+class Hub:
+    def __init__(self):
+        self.subscribers = set()
+        self.lock = threading.Lock()
+
+    def subscribe(self, topics, notify):
+        subscriber = Subscriber(set(topics), notify)
+        with self.lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, topic, point):
+        with self.lock:
+            subscribers = [s for s in self.subscribers if topic in s.topics]
+
+        if not subscribers:
+            return
+
+        event = format_event(topic, point)
+        for subscriber in subscribers:
+            subscriber.put(event)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(
+                subscribers=len(self.subscribers),
+                dropped=sum(s.dropped for s in self.subscribers),
+            )
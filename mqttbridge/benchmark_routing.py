@@ -0,0 +1,108 @@
+# Compares subscribing to '#' and filtering in process_mqtt() against
+# subscribing to the router's filters only.
+#
+# Broker traffic is simulated from a mix of topics, only some of which the
+# bridge handles, and fed through the dispatcher like main.py does. Results
+# are broker messages covered per CPU-second, so messages the broker no
+# longer sends count as free for the filtered case. TLS and MQTT decoding
+# aren't included, so real savings are larger.
+#
+# Usage: python benchmark_routing.py [messages]
+
+import os, sys
+import time
+import random
+import asyncio
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.dispatch import Dispatcher
+from common.topics import TopicRouter
+
+MESSAGES = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+TRAFFIC = (
+    ['aps/{}/power'.format(10000 + i) for i in range(10)] +
+    ['aps/{}'.format(10000 + i) for i in range(10)] +
+    ['sensors/air/{}/{}'.format(i, m) for i in range(4) for m in ['pm25', 'pm10', 'temp', 'tvoc']] +
+    ['spaceport/door/scan', 'spaceport/door/open', 'tele/printer/STATE', 'tele/printer/SENSOR'] +
+    ['zigbee2mqtt/device_{}'.format(i) for i in range(40)] +
+    ['homeassistant/sensor/node_{}/state'.format(i) for i in range(40)]
+)
+
+
+class Topic:
+    def __init__(self, value):
+        self.value = value
+
+class Message:
+    def __init__(self, topic, payload):
+        self.topic = Topic(topic)
+        self.payload = payload
+
+
+async def handle(topic, text):
+    pass
+
+async def process_before(message):
+    # old process_mqtt()
+    text = message.payload.decode()
+    topic = message.topic.value
+    if topic.startswith('aps/'):
+        await handle(topic, text)
+
+def process_after(router):
+    async def process_mqtt(message):
+        topic = message.topic.value
+        handlers = router.match(topic)
+        if not handlers:
+            return
+        text = message.payload.decode()
+        for handler in handlers:
+            await handler(topic, text)
+    return process_mqtt
+
+async def run(messages, process):
+    dispatcher = Dispatcher(process)
+    dispatcher.start()
+
+    for message in messages:
+        await dispatcher.put(message.topic.value, message)
+
+    while dispatcher.depth():
+        await asyncio.sleep(0)
+    await dispatcher.stop()
+
+def make_router(extra_routes):
+    router = TopicRouter()
+    router.add('aps/+/power', handle)
+    router.add('aps/+', handle)
+    for i in range(extra_routes):
+        router.add('unrelated/{}/+/state'.format(i), handle)
+    return router
+
+def subscribed(message, router):
+    # what the broker would still send with the router's filters
+    return bool(router.match(message.topic.value))
+
+def measure(coroutine):
+    start = time.process_time()
+    asyncio.run(coroutine)
+    return time.process_time() - start
+
+def main():
+    random.seed(1)
+    messages = [Message(random.choice(TRAFFIC), b'{"current_power": 123}') for _ in range(MESSAGES)]
+
+    seconds = measure(run(messages, process_before))
+    print('subscribe #:        {:10.0f} msgs per CPU-second'.format(MESSAGES / seconds))
+
+    for extra_routes in [0, 100]:
+        router = make_router(extra_routes)
+        delivered = [m for m in messages if subscribed(m, router)]
+        seconds = measure(run(delivered, process_after(router)))
+        print('router, {:3} extra:  {:10.0f} msgs per CPU-second ({} of {} delivered)'.format(
+            extra_routes, MESSAGES / seconds, len(delivered), MESSAGES))
+
+
+if __name__ == '__main__':
+    main()
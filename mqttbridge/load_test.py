@@ -0,0 +1,103 @@
+# Replays synthetic MQTT traffic through the dispatcher to check that queue
+# depth and memory stay flat under a burst.
+#
+# The rate offered is compared with the rate the dispatcher accepted and
+# the rate the handlers got through, along with how long messages waited in
+# the queues and how long the producer was held up by the block policy. If
+# the handlers can't keep up with the offered rate, the run shows how the
+# policy copes with overload rather than that rate being handled, and the
+# output says so. By default handlers only yield, so the run measures the
+# dispatcher itself, give a handler time in seconds to stand in for real
+# work. Memory is traced with tracemalloc, which slows Python down, so the
+# rates are lower than the bridge would manage.
+#
+# Usage: python load_test.py [rate per second] [seconds] [policy] [handler seconds]
+
+import os, sys
+import logging
+logging.basicConfig(stream=sys.stdout,
+    format='[%(asctime)s] %(levelname)s %(module)s/%(funcName)s - %(message)s',
+    level=logging.INFO)
+
+import time
+import random
+import asyncio
+import tracemalloc
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.dispatch import Dispatcher, WORKERS
+
+RATE = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+SECONDS = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+POLICY = sys.argv[3] if len(sys.argv) > 3 else 'block'
+
+# stands in for the handler's work, each worker handles one message at a time
+HANDLER_TIME = float(sys.argv[4]) if len(sys.argv) > 4 else 0
+
+TOPICS = ['aps/{}/power'.format(10000 + i) for i in range(50)] + ['sensors/air/{}/pm25'.format(i) for i in range(50)]
+
+
+class Message:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+async def handle(message):
+    await asyncio.sleep(HANDLER_TIME)
+
+async def main():
+    dispatcher = Dispatcher(handle, policy=POLICY)
+    dispatcher.start()
+    tracemalloc.start()
+
+    if HANDLER_TIME:
+        logging.info('Offering %s msgs/s for %ss to %s workers taking %.1fms per message, at most %.0f msgs/s, policy %s',
+            RATE, SECONDS, WORKERS, HANDLER_TIME * 1000, WORKERS / HANDLER_TIME, POLICY)
+    else:
+        logging.info('Offering %s msgs/s for %ss to %s workers that only yield, policy %s',
+            RATE, SECONDS, WORKERS, POLICY)
+
+    start = time.monotonic()
+    sent = 0
+    blocked = 0.0
+    next_report = start + 1
+
+    while time.monotonic() - start < SECONDS:
+        # send in 10ms batches to hold the target rate
+        due = int((time.monotonic() - start) * RATE)
+        while sent < due and time.monotonic() - start < SECONDS:
+            topic = random.choice(TOPICS)
+            before = time.monotonic()
+            await dispatcher.put(topic, Message(topic, str(random.random() * 1000).encode()))
+            blocked += time.monotonic() - before
+            sent += 1
+
+        if time.monotonic() >= next_report:
+            current, peak = tracemalloc.get_traced_memory()
+            s = dispatcher.get_stats()
+            logging.info('offered %s, sent %s, depth %s, handled %s, dropped %s, coalesced %s, memory %.1f kB (peak %.1f kB)',
+                due, sent, s['depth'], s['handled'], s['dropped'], s['coalesced'], current / 1024, peak / 1024)
+            next_report += 1
+
+        await asyncio.sleep(0.01)
+
+    elapsed = time.monotonic() - start
+    s = dispatcher.get_stats()
+    handled_rate = s['handled'] / elapsed
+    logging.info('Offered %s msgs/s, sent %.0f msgs/s, handled %.0f msgs/s, producer spent %.1fs of %.1fs in put()',
+        RATE, sent / elapsed, handled_rate, blocked, elapsed)
+    logging.info('Queue wait avg %.1fms max %.1fms, %s dropped, %s coalesced',
+        s['wait_avg'] * 1000, s['wait_max'] * 1000, s['dropped'], s['coalesced'])
+    dispatcher.log_stats()
+
+    if handled_rate >= RATE * 0.95:
+        logging.info('Measured: the offered %s msgs/s was handled in full', RATE)
+    else:
+        logging.info('Measured: overload, the handlers took %.0f of the offered %s msgs/s and the %s policy made up the rest',
+            handled_rate, RATE, POLICY)
+    await dispatcher.stop()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -9,7 +9,6 @@ import time
 import json
 
 import asyncio
-import aiohttp
 from aiomqtt import Client, TLSParameters
 
 tls_params = TLSParameters(
@@ -18,25 +17,22 @@ tls_params = TLSParameters(
 
 import secrets
 
-async def process_solar_aps(topic, text):
-    topic_parts = topic.split('/')
-    power = None
-
-    if len(topic_parts) == 3 and topic_parts[2] == 'power':
-        power = text
-    elif len(topic_parts) == 2:
-        try:
-            data = json.loads(text)
-            if 'current_power' in data:
-                power = data['current_power']
-        except json.JSONDecodeError:
-            pass
-
-    if power is None:
-        logging.debug('Not a power message for topic %s, returning', topic)
-        return
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import http_client
+from common.dispatch import Dispatcher, QUEUE_SIZE
+from common.outbox import Outbox
+from common.solar import SolarUploader
+from common.topics import TopicRouter
+
+STATS_INTERVAL = 300
+
+outbox = Outbox()
+solar_uploader = SolarUploader(outbox=outbox)
 
-    ecu_id = topic_parts[1]
+# topic filter -> handler(topic, text), only these are subscribed to
+router = TopicRouter()
+
+async def process_solar_power(ecu_id, power):
     try:
         solar_user = secrets.SOLAR_USERS[ecu_id]
     except KeyError:
@@ -45,48 +41,72 @@ async def process_solar_aps(topic, text):
 
     logging.info('ECU ID: %s, user: %s, power: %s', ecu_id, solar_user, power)
 
-    async with aiohttp.ClientSession() as session:
-        data = dict(user=solar_user, power=power)
+    solar_uploader.update(solar_user, power)
 
-        try:
-            if DEBUG:
-                url = 'https://api.spaceport.dns.t0.vc/stats/solar_data/'
-            else:
-                url = 'https://api.my.protospace.ca/stats/solar_data/'
+@router.route('aps/+/power')
+async def process_solar_aps_power(topic, text):
+    await process_solar_power(topic.split('/')[1], text)
 
-            await session.post(url, json=data, timeout=10)
+@router.route('aps/+')
+async def process_solar_aps(topic, text):
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        data = None
 
-            logging.info('Sent to portal URL: %s', url)
-        except BaseException as e:
-            logging.error('Problem sending json to portal %s:', url)
-            logging.exception(e)
+    if not isinstance(data, dict) or 'current_power' not in data:
+        logging.debug('Not a power message for topic %s, returning', topic)
+        return
+
+    await process_solar_power(topic.split('/')[1], data['current_power'])
 
 
 async def process_mqtt(message):
-    text = message.payload.decode()
     topic = message.topic.value
+    handlers = router.match(topic)
+    if not handlers:
+        return
+
+    text = message.payload.decode()
     logging.debug('MQTT topic: %s, message: %s', topic, text)
 
-    if topic.startswith('aps/'):
-        await process_solar_aps(topic, text)
-    else:
-        logging.debug('Invalid topic, returning')
-        return
+    for handler in handlers:
+        await handler(topic, text)
+
+async def log_stats(dispatcher):
+    while True:
+        await asyncio.sleep(STATS_INTERVAL)
+        dispatcher.log_stats()
+        solar_uploader.log_stats()
+        outbox.log_stats()
+        http_client.log_stats()
 
 async def fetch_mqtt():
     await asyncio.sleep(3)
 
+    # messages for the same topic are handled in order, a full queue makes
+    # the reader wait and the client's own queue drop new messages instead
+    # of piling up tasks
+    dispatcher = Dispatcher(process_mqtt)
+    dispatcher.start()
+    outbox.start()
+    solar_uploader.start()
+    asyncio.ensure_future(log_stats(dispatcher))
+
     async with Client(
         hostname='webhost.protospace.ca',
         port=8883,
         username='reader',
         password=secrets.MQTT_READER_PASSWORD,
         tls_params=tls_params,
+        max_queued_incoming_messages=QUEUE_SIZE,
     ) as client:
-        await client.subscribe('#')
+        for topic_filter in router.filters():
+            await client.subscribe(topic_filter)
+        logging.info('Subscribed to: %s', ', '.join(router.filters()))
+
         async for message in client.messages:
-            loop = asyncio.get_event_loop()
-            loop.create_task(process_mqtt(message))
+            await dispatcher.put(message.topic.value, message)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,144 @@
+# Checks the printer bridges against fake_homeassistant.py.
+#
+# The stand-in Home Assistant runs in this process on a free port, with its
+# own timed changes turned off so the script decides what changes and when.
+# A StatusUploader watches the printers over the WebSocket API and queues
+# into a list instead of the outbox. The payloads queued from the initial
+# snapshot and from each "c" diff have to equal what the printer's format()
+# gives for the fake's states. Then the fake drops every client, like Home
+# Assistant restarting, and the uploader has to reconnect and keep getting
+# changes. Last, poll mode is checked the same way for a Prusa printer with
+# a name other than prusa_xl.
+#
+# Usage: python check_homeassistant.py
+
+import os, sys
+import time
+import asyncio
+import logging
+
+os.environ['CHANGE_INTERVAL'] = '0'
+os.environ['HOMEASSISTANT_DEBOUNCE'] = '0.1'
+os.environ.pop('CHANGES_DELTA', None)   # whole payloads, to compare with format()
+
+from aiohttp import web
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import fake_homeassistant as fake
+from common import printers, http_client
+
+TIMEOUT = 10
+
+
+class ListOutbox:
+    """Keeps what the uploader queues for the portal"""
+
+    def __init__(self):
+        self.items = []
+
+    def put(self, url, data, key=None):
+        self.items.append((url, data))
+
+    def start(self):
+        pass
+
+    def log_stats(self):
+        pass
+
+    def latest(self, printer):
+        url = printers.PORTAL_URL.format(printer.name)
+        for item_url, data in reversed(self.items):
+            if item_url == url:
+                return data
+
+
+async def dev_portal(request):
+    return web.json_response({})
+
+def expected(printer):
+    return printer.format({field: fake.states[entity_id] for entity_id, field in printer.entities.items()})
+
+async def wait_for(check, what):
+    start = time.time()
+    while not check():
+        if time.time() - start > TIMEOUT:
+            raise AssertionError('timed out waiting for ' + what)
+        await asyncio.sleep(0.05)
+
+async def wait_for_payloads(outbox, printer_list, what):
+    def matches():
+        return all(outbox.latest(printer) == expected(printer) for printer in printer_list)
+    await wait_for(matches, what)
+    print('OK', what)
+
+
+async def check_watch(url):
+    outbox = ListOutbox()
+    uploader = printers.StatusUploader([fake.bambu, fake.prusa], outbox, url, 'token')
+    task = asyncio.ensure_future(uploader.watch())
+
+    await wait_for_payloads(outbox, [fake.bambu, fake.prusa], 'initial snapshot')
+    assert len(outbox.items) == 2, outbox.items
+
+    fake.change({
+        'sensor.p1s_01p09c471500459_print_progress': '42',
+        'sensor.prusa_xl_progress': '17.0',
+        'sensor.unrelated_0': '1',
+    })
+    await wait_for_payloads(outbox, [fake.bambu, fake.prusa], 'diff for both printers')
+    assert outbox.latest(fake.bambu)['info']['print_percentage'] == '42', outbox.latest(fake.bambu)
+
+    count = len(outbox.items)
+    fake.change({'sensor.p1s_01p09c471500459_nozzle_temperature': '220.5'})
+    await wait_for_payloads(outbox, [fake.bambu], 'diff for one printer')
+    assert len(outbox.items) == count + 1, 'unchanged printer was sent again'
+
+    await fake.drop_clients()
+    await wait_for(lambda: uploader.watcher.stats['connects'] == 2 and fake.subscriptions, 'reconnect')
+    print('OK reconnect')
+
+    fake.change({'sensor.p1s_01p09c471500459_print_progress': '43'})
+    await wait_for_payloads(outbox, [fake.bambu], 'diff after reconnect')
+    assert outbox.latest(fake.bambu)['info']['print_percentage'] == '43', outbox.latest(fake.bambu)
+
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+async def check_poll(url):
+    prusa = printers.PrusaPrinter('prusa_mk4')
+    fake.states.update({entity_id: '0' for entity_id in prusa.entities})
+    fake.states['sensor.prusa_mk4'] = 'idle'
+
+    outbox = ListOutbox()
+    uploader = printers.StatusUploader([prusa], outbox, url, 'token')
+    task = asyncio.ensure_future(uploader.poll(interval=0.1))
+
+    await wait_for_payloads(outbox, [prusa], 'poll of prusa_mk4')
+
+    fake.states['sensor.prusa_mk4_progress'] = '55.0'
+    await wait_for_payloads(outbox, [prusa], 'poll after change')
+
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+async def main():
+    fake.app.router.add_post('/dev/{name}/', dev_portal)
+    runner = web.AppRunner(fake.app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    url = 'http://127.0.0.1:{}'.format(port)
+    printers.DEV_PORTAL_URL = url + '/dev/{}/'
+
+    try:
+        await check_watch(url)
+        await check_poll(url)
+    finally:
+        await http_client.close()
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(main())
@@ -0,0 +1,125 @@
+# Stand-in Home Assistant for trying the printer bridges without a real
+# instance. Serves /api/states and the WebSocket API's subscribe_entities
+# for one Bambu and one Prusa printer, plus unrelated entities, and changes
+# a few printer states every CHANGE_INTERVAL seconds, or never if it's 0.
+#
+# Usage: python fake_homeassistant.py [port]
+# Then point HOMEASSISTANT_URL at http://127.0.0.1:8123 with any token.
+
+import os, sys
+import random
+import asyncio
+import logging
+
+from aiohttp import web
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import printers
+
+logging.basicConfig(
+        format='[%(asctime)s] %(levelname)s %(module)s/%(funcName)s - %(message)s',
+        level=logging.INFO)
+
+PORT = int(sys.argv[1]) if len(sys.argv) > 1 else 8123
+CHANGE_INTERVAL = float(os.environ.get('CHANGE_INTERVAL', 3))
+UNRELATED = 500
+
+bambu = printers.BambuPrinter('p1s1', '01P09C471500459')
+prusa = printers.PrusaPrinter('prusa_xl')
+
+states = {entity_id: '0' for entity_id in bambu.entities}
+states.update({entity_id: 'unavailable' for entity_id in prusa.entities})
+states['sensor.p1s_01p09c471500459_print_status'] = 'running'
+states['sensor.prusa_xl'] = 'printing'
+for i in range(UNRELATED):
+    states['sensor.unrelated_{}'.format(i)] = '0'
+
+subscriptions = []   # (queue, entity ids, subscription id, websocket)
+
+
+def entity(entity_id):
+    return dict(entity_id=entity_id, state=states[entity_id], attributes={})
+
+async def api_states(request):
+    return web.json_response([entity(entity_id) for entity_id in states])
+
+async def api_websocket(request):
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+
+    await ws.send_json(dict(type='auth_required', ha_version='2025.10.0'))
+    msg = await ws.receive_json()
+    if msg.get('type') != 'auth' or not msg.get('access_token'):
+        await ws.send_json(dict(type='auth_invalid', message='Invalid access token or password'))
+        await ws.close()
+        return ws
+    await ws.send_json(dict(type='auth_ok', ha_version='2025.10.0'))
+
+    msg = await ws.receive_json()
+    entity_ids = set(msg.get('entity_ids') or states)
+    await ws.send_json(dict(id=msg['id'], type='result', success=True, result=None))
+
+    initial = {entity_id: dict(s=states[entity_id], a={}) for entity_id in entity_ids if entity_id in states}
+    await ws.send_json(dict(id=msg['id'], type='event', event=dict(a=initial)))
+    logging.info('Client subscribed to %s entities', len(entity_ids))
+
+    queue = asyncio.Queue()
+    subscription = (queue, entity_ids, msg['id'], ws)
+    subscriptions.append(subscription)
+
+    async def send_changes():
+        while True:
+            changes = await queue.get()
+            await ws.send_json(dict(id=msg['id'], type='event', event=dict(c=changes)))
+
+    sender = asyncio.ensure_future(send_changes())
+    try:
+        async for msg_in in ws:
+            pass
+    finally:
+        sender.cancel()
+        subscriptions.remove(subscription)
+        logging.info('Client disconnected')
+
+    return ws
+
+def change(changes):
+    # sets states and sends the diffs to subscribers
+    states.update(changes)
+    for queue, entity_ids, id, ws in subscriptions:
+        diff = {entity_id: {'+': dict(s=state)} for entity_id, state in changes.items() if entity_id in entity_ids}
+        if diff:
+            queue.put_nowait(diff)
+
+async def drop_clients():
+    # like Home Assistant restarting
+    for queue, entity_ids, id, ws in list(subscriptions):
+        await ws.close()
+
+async def change_states(app):
+    async def run():
+        progress = 0
+        while True:
+            await asyncio.sleep(CHANGE_INTERVAL)
+            progress += 1
+
+            changes = {
+                'sensor.p1s_01p09c471500459_print_progress': str(progress),
+                'sensor.p1s_01p09c471500459_nozzle_temperature': str(random.choice([219.5, 220.0, 220.5])),
+                'sensor.prusa_xl_progress': str(float(progress)),
+            }
+            for i in random.sample(range(UNRELATED), 50):
+                changes['sensor.unrelated_{}'.format(i)] = str(random.random())
+            change(changes)
+
+    if CHANGE_INTERVAL:
+        app['changer'] = asyncio.ensure_future(run())
+
+
+app = web.Application()
+app.router.add_get('/api/states', api_states)
+app.router.add_get('/api/websocket', api_websocket)
+app.on_startup.append(change_states)
+
+if __name__ == '__main__':
+    web.run_app(app, host='127.0.0.1', port=PORT)
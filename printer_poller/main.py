@@ -0,0 +1,56 @@
+# Script that gets the status of every 3D printer from Home Assistant in
+# one request and then sends each to Spaceport.
+#
+# Replaces running a bamboo_tracker / prusa_tracker process per printer for
+# status, printers are listed in secrets.PRINTERS instead.
+
+import os, logging
+DEBUG = os.environ.get('DEBUG')
+logging.basicConfig(
+        format='[%(asctime)s] %(levelname)s %(module)s/%(funcName)s - %(message)s',
+        level=logging.DEBUG if DEBUG else logging.INFO)
+logging.getLogger('aiohttp').setLevel(logging.DEBUG if DEBUG else logging.WARNING)
+
+logging.info('Boot up...')
+
+import time
+import asyncio
+import sys
+import ssl
+
+import secrets
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import printers
+from common.outbox import Outbox
+
+
+sslcontext = ssl.create_default_context()
+sslcontext.check_hostname = False
+sslcontext.verify_mode = ssl.CERT_NONE
+
+PRINTERS = [printers.from_config(config) for config in secrets.PRINTERS]
+
+# 'poll' fetches /api/states every minute, 'websocket' subscribes to changes
+MODE = os.environ.get('HOMEASSISTANT_MODE', 'poll')
+
+outbox = Outbox()
+
+uploader = printers.StatusUploader(PRINTERS, outbox,
+    secrets.HOMEASSISTANT_URL, secrets.HOMEASSISTANT_TOKEN, ssl=sslcontext)
+
+
+def task_died(future):
+    if os.environ.get('SHELL'):
+        logging.error('Printer poller task died!')
+    else:
+        logging.error('Printer poller task died! Waiting 60s and exiting...')
+        time.sleep(60)
+    exit()
+
+loop = asyncio.get_event_loop()
+if MODE == 'websocket':
+    loop.create_task(uploader.watch()).add_done_callback(task_died)
+else:
+    loop.create_task(uploader.poll(5 if DEBUG else 60)).add_done_callback(task_died)
+loop.run_forever()
@@ -15,14 +15,20 @@ from email import policy
 import io
 import zipfile
 import xmltodict
-import requests
 import time
 import json
+import sys
 
 import secrets
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.outbox import Outbox
+
 PROTOCOIN_PRINTER_URL = 'https://api.my.protospace.ca/protocoin/printer_report/'
 
+# reports are billed, so they're kept until the portal takes them
+outbox = Outbox()
+
 class mySMTPServer(SMTPServer):
     def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
         logging.info('Received printer accounting email')
@@ -67,17 +73,17 @@ class mySMTPServer(SMTPServer):
             ink_ul=accounting_info['INK_INFO']['INK_USED']['@value'],
         )
 
-        logging.info('Sending to portal:\n' + str(print_info))
+        logging.info('Queueing for portal:\n' + str(print_info))
 
         headers = {'Authorization': 'Bearer ' + secrets.PRINTER_API_TOKEN}
-        r = requests.post(PROTOCOIN_PRINTER_URL, json=print_info, headers=headers, timeout=10)
-        r.raise_for_status()
+        outbox.put(PROTOCOIN_PRINTER_URL, print_info, headers=headers)
 
         logging.info('Done.')
         return
 
 
 def run():
+    outbox.start_thread()
     _ = mySMTPServer(('0.0.0.0', 1025), None)
     try:
         logging.info('Starting event loop...')
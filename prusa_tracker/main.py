@@ -11,14 +11,16 @@ logging.getLogger('aiohttp').setLevel(logging.DEBUG if DEBUG else logging.WARNIN
 logging.info('Boot up...')
 
 import time
-import json
 import asyncio
-import aiohttp
 import sys
 import ssl
 
 import secrets
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import printers
+from common.outbox import Outbox, DIRECTORY
+
 
 sslcontext = ssl.create_default_context()
 sslcontext.check_hostname = False
@@ -33,74 +35,14 @@ if len(sys.argv) != 2:
 
 _, NAME, = sys.argv
 
-printer = dict(
-    info=dict(),
-)
-
-async def printer_status():
-    while True:
-        sleep_time = 5 if DEBUG else 60
-        await asyncio.sleep(sleep_time)
-
-        try:
-            headers = {'Authorization': 'Bearer ' + secrets.HOMEASSISTANT_TOKEN}
-            url = secrets.HOMEASSISTANT_URL + '/api/states'
-            async with aiohttp.ClientSession() as session:
-                res = await session.get(url, headers=headers, timeout=10, ssl=sslcontext)
-                res.raise_for_status()
-                res = await res.json()
-        except KeyboardInterrupt:
-            break
-        except BaseException as e:
-            printer['info']['online'] = False
-            logging.error('Problem getting status from Home Assistant URL %s:', url)
-            logging.exception(e)
-
-        status = {}
-        prefix = 'sensor.' + NAME   # sensor.prusa_xl
-
-        for entry in res:
-            if entry['entity_id'].startswith(prefix):
-                status[entry['entity_id']] = entry['state']
-
-        logging.debug('Status data:\n%s', json.dumps(status, indent=4))
-
-        if not status:
-            raise Exception('Status empty, do you have the correct serial number?')
-
-        printer['info']['online'] = True
-        printer['info']['state'] = status['sensor.prusa_xl'].title()
-        printer['info']['print_speed'] = status['sensor.prusa_xl_print_speed']
-        printer['info']['material'] = status['sensor.prusa_xl_material']
-        printer['info']['progress'] = status['sensor.prusa_xl_progress']
-        printer['info']['filename'] = status['sensor.prusa_xl_filename']
-        printer['info']['print_start'] = status['sensor.prusa_xl_print_start']
-        printer['info']['print_finish'] = status['sensor.prusa_xl_print_finish']
-
-        logging.info('Sending to portal...')
-        logging.debug('JSON data:\n%s', json.dumps(printer, indent=4))
-
-        try:
-            url = 'https://api.my.protospace.ca/stats/{}/printer3d/'.format(NAME)
-            async with aiohttp.ClientSession() as session:
-                await session.post(url, json=printer, timeout=10)
-        except KeyboardInterrupt:
-            break
-        except BaseException as e:
-            logging.error('Problem sending printer data to portal %s:', url)
-            logging.exception(e)
-
-        try:
-            url = 'https://api.spaceport.dns.t0.vc/stats/{}/printer3d/'.format(NAME)
-            async with aiohttp.ClientSession() as session:
-                await session.post(url, json=printer, timeout=10)
-        except KeyboardInterrupt:
-            break
-        except BaseException as e:
-            logging.info('Problem sending printer data to dev portal %s:', url)
-
-        logging.debug('Done sending.')
+# one outbox per printer, several trackers can run from this directory
+outbox = Outbox(path=os.environ.get('OUTBOX_PATH', os.path.join(DIRECTORY, 'outbox_{}.db'.format(NAME))))
+
+# 'poll' fetches /api/states every minute, 'websocket' subscribes to changes
+MODE = os.environ.get('HOMEASSISTANT_MODE', 'poll')
 
+uploader = printers.StatusUploader([printers.PrusaPrinter(NAME)], outbox,
+    secrets.HOMEASSISTANT_URL, secrets.HOMEASSISTANT_TOKEN, ssl=sslcontext)
 
 
 def task_died(future):
@@ -112,6 +54,9 @@ def task_died(future):
     exit()
 
 loop = asyncio.get_event_loop()
-loop.create_task(printer_status()).add_done_callback(task_died)
+if MODE == 'websocket':
+    loop.create_task(uploader.watch()).add_done_callback(task_died)
+else:
+    loop.create_task(uploader.poll(5 if DEBUG else 60)).add_done_callback(task_died)
 loop.run_forever()
 
@@ -7,12 +7,66 @@ logging.basicConfig(stream=sys.stdout,
 
 import time
 import json
+import random
 
 import asyncio
-import aiohttp
 
 import secrets
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import http_client
+from common.outbox import Outbox
+from common.solar import SolarUploader
+
+API_URL = os.environ.get('SOLAREDGE_API_URL', 'https://monitoringapi.solaredge.com')
+INTERVAL = 180
+
+# SolarEdge allows 3 concurrent requests per source IP and 300 requests a
+# day per API key, one bulk request for many sites counts once
+CONCURRENCY = int(os.environ.get('SOLAREDGE_CONCURRENCY', 3))
+RATE = float(os.environ.get('SOLAREDGE_RATE', 2))
+DAILY_QUOTA = int(os.environ.get('SOLAREDGE_DAILY_QUOTA', 300))
+JITTER = float(os.environ.get('SOLAREDGE_JITTER', 10))
+BULK_SIZE = 100
+
+outbox = Outbox()
+solar_uploader = SolarUploader(outbox=outbox)
+
+
+class RateLimiter:
+    # caps requests in flight and spaces out their starts to rate per second
+    def __init__(self, rate, concurrency):
+        self.gap = 1 / rate
+        self.next_start = 0
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+
+        now = time.monotonic()
+        wait = self.next_start - now
+        self.next_start = max(now, self.next_start) + self.gap
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def __aexit__(self, *args):
+        self.semaphore.release()
+
+limiter = None
+
+# api key -> time of its last request
+last_request = {}
+
+def quota_allows(api_key, count):
+    # spread the daily quota evenly over the day, so a key needing count
+    # requests a cycle doesn't run out late in the day
+    min_gap = 86400 / DAILY_QUOTA * count
+    last = last_request.get(api_key)
+    return last is None or time.monotonic() - last >= min_gap - JITTER
+
+def quota_used(api_key):
+    last_request[api_key] = time.monotonic()
+
 async def process_solar_data(user, data):
     try:
         site_id = user['site_id']
@@ -21,48 +75,115 @@ async def process_solar_data(user, data):
 
         logging.info('Site ID: %s, user: %s, power: %s', site_id, name, power)
 
-        async with aiohttp.ClientSession() as session:
-            data = dict(user=name, power=power)
+        solar_uploader.update(name, power)
+    except BaseException as e:
+        logging.error('Problem processing SolarEdge data:')
+        logging.exception(e)
 
-            if DEBUG:
-                url = 'https://api.spaceport.dns.t0.vc/stats/solar_data/'
-            else:
-                url = 'https://api.my.protospace.ca/stats/solar_data/'
+async def get_solaredge_data(user):
+    try:
+        data = dict(api_key=user['api_key'])
 
-            await session.post(url, json=data, timeout=10)
+        url = API_URL + '/site/{}/overview'.format(user['site_id'])
+        async with limiter:
+            quota_used(user['api_key'])
+            data = await http_client.get(url, params=data)
 
-            logging.info('Sent to portal URL: %s', url)
+        logging.info('Got SolarEdge data: %s', data)
+        return data
     except BaseException as e:
-        logging.error('Problem sending json to portal:')
+        logging.error('Problem getting json from SolarEdge:')
         logging.exception(e)
+        return False
 
-async def get_solaredge_data(user):
+async def get_solaredge_bulk(api_key, users):
+    # one request for up to BULK_SIZE sites the key can see, returns
+    # site id -> overview
     try:
-        async with aiohttp.ClientSession() as session:
-            data = dict(api_key=user['api_key'])
+        data = dict(api_key=api_key)
+
+        site_ids = ','.join(str(user['site_id']) for user in users)
+        url = API_URL + '/sites/{}/overview'.format(site_ids)
+        async with limiter:
+            quota_used(api_key)
+            data = await http_client.get(url, params=data)
 
-            url = 'https://monitoringapi.solaredge.com/site/{}/overview'.format(user['site_id'])
-            res = await session.get(url, params=data, timeout=10)
-            data = await res.json()
+        logging.info('Got SolarEdge bulk data: %s', data)
 
-            logging.info('Got SolarEdge data: %s', data)
-            return data
+        sites = data['sitesOverviews']['siteEnergyList']
+        return {str(site['siteId']): site['siteOverview'] for site in sites}
     except BaseException as e:
-        logging.error('Problem getting json from SolarEdge:')
+        logging.error('Problem getting bulk json from SolarEdge:')
         logging.exception(e)
         return False
 
+async def poll_user(user):
+    data = await get_solaredge_data(user)
+    if not data:
+        logging.info('Bad data, skipping.')
+        return
+
+    await process_solar_data(user, data)
+
+async def poll_bulk(api_key, users):
+    overviews = await get_solaredge_bulk(api_key, users)
+    if not overviews:
+        logging.info('Bad bulk data, skipping %s sites.', len(users))
+        return
+
+    for user in users:
+        overview = overviews.get(str(user['site_id']))
+        if not overview:
+            logging.info('Site ID %s missing from bulk data, skipping.', user['site_id'])
+            continue
+
+        await process_solar_data(user, dict(overview=overview))
+
+async def poll_key(api_key, users):
+    # jitter spreads keys over the start of the cycle
+    await asyncio.sleep(random.uniform(0, JITTER))
+
+    chunks = [users[i:i+BULK_SIZE] for i in range(0, len(users), BULK_SIZE)]
+    if not quota_allows(api_key, len(chunks)):
+        logging.debug('Skipping %s sites this cycle to stay within quota.', len(users))
+        return
+
+    if len(users) == 1:
+        await poll_user(users[0])
+    else:
+        await asyncio.gather(*[poll_bulk(api_key, chunk) for chunk in chunks])
+
 async def main():
+    global limiter
+    limiter = RateLimiter(RATE, CONCURRENCY)
+
+    outbox.start()
+
+    # cycles start every INTERVAL seconds however long polling takes
+    next_cycle = time.monotonic()
+
     while True:
+        start = time.monotonic()
+
+        # users sharing an account API key are polled in bulk
+        by_key = {}
         for user in secrets.SOLAREDGE_USERS:
-            data = await get_solaredge_data(user)
-            if not data:
-                logging.info('Bad data, skipping.')
-                continue
+            by_key.setdefault(user['api_key'], []).append(user)
+
+        await asyncio.gather(*[poll_key(api_key, users) for api_key, users in by_key.items()])
+
+        # all sites polled this round go out together
+        await solar_uploader.flush()
+        outbox.log_stats()
 
-            await process_solar_data(user, data)
+        http_client.log_stats()
+        logging.info('Polled %s API keys in %.1fs.', len(by_key), time.monotonic() - start)
 
-        await asyncio.sleep(180)
+        next_cycle += INTERVAL
+        if next_cycle < time.monotonic():
+            logging.warning('Polling took longer than %ss, skipping ahead.', INTERVAL)
+            next_cycle = time.monotonic()
+        await asyncio.sleep(next_cycle - time.monotonic())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,98 @@
+# Compares parsing tshark field output the way scan() used to, reading it
+# all and averaging per-MAC lists of floats, against the NumPy replay path.
+#
+# A synthetic capture of tshark field output is generated first, with a mix
+# of one and two antenna readings and lines without a source address like
+# real captures have. tshark's own decoding time isn't included.
+#
+# Usage: python benchmark_replay.py [lines]
+
+import os, sys
+import time
+import random
+import tempfile
+
+from wifi_scanner.replay import replay_fields
+
+LINES = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+DEVICES = 2000
+
+
+def generate(path, lines):
+    random.seed(1)
+    macs = ['%02x:%02x:%02x:%02x:%02x:%02x' % tuple(random.randrange(256) for _ in range(6)) for _ in range(DEVICES)]
+    bssids = macs[:20]
+
+    with open(path, 'w') as f:
+        batch = []
+        for i in range(lines):
+            k = random.random()
+            if k < 0.2:
+                batch.append('\t%s\t-%d\n' % (random.choice(bssids), random.randint(30, 95)))
+            elif k < 0.6:
+                batch.append('%s\t%s\t-%d,-%d\n' % (random.choice(macs), random.choice(bssids), random.randint(30, 95), random.randint(30, 95)))
+            else:
+                batch.append('%s\t%s\t-%d\n' % (random.choice(macs), random.choice(bssids), random.randint(30, 95)))
+
+            if len(batch) == 100000:
+                f.write(''.join(batch))
+                batch = []
+        f.write(''.join(batch))
+
+def before(path):
+    # the old loop in scan(), output was all read by communicate()
+    with open(path, 'rb') as f:
+        output = f.read()
+
+    foundMacs = {}
+    for line in output.decode('utf-8').split('\n'):
+        if line.strip() == '':
+            continue
+        mac = line.split()[0].strip().split(',')[0]
+        dats = line.split()
+        if len(dats) == 3:
+            if ':' not in dats[0] or len(dats) != 3:
+                continue
+            if mac not in foundMacs:
+                foundMacs[mac] = []
+            dats_2_split = dats[2].split(',')
+            if len(dats_2_split) > 1:
+                rssi = float(dats_2_split[0]) / 2 + float(dats_2_split[1]) / 2
+            else:
+                rssi = float(dats_2_split[0])
+            foundMacs[mac].append(rssi)
+
+    for key, value in foundMacs.items():
+        foundMacs[key] = float(sum(value)) / float(len(value))
+    return foundMacs
+
+def after(path):
+    with open(path, 'rb') as f:
+        return replay_fields(f).averages()
+
+def measure(function, path):
+    start = time.perf_counter()
+    result = function(path)
+    return time.perf_counter() - start, result
+
+def main():
+    path = os.path.join(tempfile.gettempdir(), 'wifi_scanner_benchmark.txt')
+    print('Generating {} lines...'.format(LINES))
+    generate(path, LINES)
+
+    try:
+        seconds_after, result_after = measure(after, path)
+        print('numpy replay:  {:7.2f}s  {:10.0f} lines/s'.format(seconds_after, LINES / seconds_after))
+
+        seconds_before, result_before = measure(before, path)
+        print('old loop:      {:7.2f}s  {:10.0f} lines/s'.format(seconds_before, LINES / seconds_before))
+
+        same = result_before.keys() == result_after.keys() and all(
+            abs(result_before[mac] - result_after[mac]) < 1e-9 for mac in result_before)
+        print('speedup:       {:7.1f}x, same results: {}'.format(seconds_before / seconds_after, same))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,10 @@ from setuptools import setup
 
 setup(
     name='wifi_scanner',
-    packages=['wifi_scanner'],
+    # the outbox is shared with the bridges, it's installed from the repo's
+    # common directory as wifi_scanner.common
+    packages=['wifi_scanner', 'wifi_scanner.common'],
+    package_dir={'wifi_scanner.common': '../common'},
     version='0.6.0',
     description='A tshark wrapper to count the number of cellphones in the vicinity',
     author='tannercollin',
@@ -11,11 +14,14 @@ setup(
     keywords=['tshark', 'wifi', 'location'],
     classifiers=[],
     install_requires=[
+        'aiohttp',
         'click',
         'netifaces',
         'pick',
-        'requests',
     ],
+    extras_require={
+        'replay': ['numpy'],
+    },
     setup_requires=[],
     tests_require=[],
     entry_points={'console_scripts': [
@@ -6,14 +6,19 @@ import platform
 import subprocess
 import json
 import time
-import requests
 import logging
 
 import netifaces
 import click
 
-from wifi_scanner.oui import load_dictionary, download_oui
+from wifi_scanner.oui import load_index, download_oui, is_local
 from wifi_scanner.analysis import analyze_file
+from wifi_scanner.stream import parse_line, RssiWindow, live_command, stream_windows, stream_merged
+try:
+    from wifi_scanner.replay import replay_pcap
+except ImportError:
+    replay_pcap = None   # needs numpy, pip install .[replay]
+from wifi_scanner.outbox import Outbox
 from wifi_scanner.colors import *
 
 def getserial():
@@ -32,9 +37,13 @@ def getserial():
 
 SERIAL = getserial()
 
-SEND_BUFFER = []
 IOT_URL = 'http://games.protospace.ca:5000/wifi-scan'
 
+# with WIFI_SCANNER_BATCH set, scans that pile up while the server is
+# unreachable are sent as lists of up to that many per request. The server
+# has to accept a list of scans.
+BATCH = int(os.environ.get('WIFI_SCANNER_BATCH', 0))
+
 if os.name != 'nt':
     from pick import pick
     import curses
@@ -79,21 +88,20 @@ def fileToMacSet(path):
     return set([x.strip() for x in maclist])
 
 
-def scan(adapter, scantime, verbose, dictionary, number, nearby, jsonprint, out, allmacaddresses, manufacturers, nocorrection, sort, targetmacs, pcap):
-    """Monitor wifi signals to count the number of people around you"""
-
-    # print("OS: " + os.name)
-    # print("Platform: " + platform.system())
-
+def get_oui(dictionary):
     if (not os.path.isfile(dictionary)) or (not os.access(dictionary, os.R_OK)):
         download_oui(dictionary)
 
-    oui = load_dictionary(dictionary)
+    # cheap after the first call, the index is only rebuilt if the file changed
+    oui = load_index(dictionary)
 
     if not oui:
         print('couldn\'t load [%s]' % dictionary)
         sys.exit(1)
 
+    return oui
+
+def get_tshark():
     try:
         tshark = which("tshark")
     except:
@@ -105,24 +113,69 @@ def scan(adapter, scantime, verbose, dictionary, number, nearby, jsonprint, out,
                 'you may also need to execute: \n\tbrew cask install wireshark-chmodbpf')
         sys.exit(1)
 
+    return tshark
+
+def choose_adapter(adapter):
+    if len(adapter) == 0:
+        if os.name == 'nt':
+            print('You must specify the adapter with   -a ADAPTER')
+            print('Choose from the following: ' +
+                  ', '.join(netifaces.interfaces()))
+            sys.exit(1)
+        title = 'Please choose the adapter you want to use: '
+        try:
+            adapter, index = pick(netifaces.interfaces(), title)
+        except curses.error as e:
+            print('Please check your $TERM settings: %s' % (e))
+            sys.exit(1)
+
+    return adapter
+
+
+def read_pcap(tshark, dump_file, verbose):
+    """Average RSSI of each MAC in a capture file"""
+    command = [
+        tshark, '-r',
+        dump_file, '-T',
+        'fields', '-e',
+        'wlan.sa', '-e',
+        'wlan.bssid', '-e',
+        'radiotap.dbm_antsignal'
+    ]
+    if verbose:
+        print(' '.join(command))
+    run_tshark = subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    window = RssiWindow()
+    for line in run_tshark.stdout:
+        line = line.decode('utf-8', 'replace')
+        if verbose:
+            print(line)
+        found = parse_line(line)
+        if found:
+            window.add(*found)
+    run_tshark.wait()
+
+    return window.averages()
+
+
+def scan(adapter, scantime, verbose, dictionary, number, nearby, jsonprint, out, allmacaddresses, manufacturers, nocorrection, sort, targetmacs, pcap):
+    """Monitor wifi signals to count the number of people around you"""
+
+    # print("OS: " + os.name)
+    # print("Platform: " + platform.system())
+
+    oui = get_oui(dictionary)
+    tshark = get_tshark()
+
     if jsonprint:
         number = True
     if number:
         verbose = False
 
     if not pcap:
-        if len(adapter) == 0:
-            if os.name == 'nt':
-                print('You must specify the adapter with   -a ADAPTER')
-                print('Choose from the following: ' +
-                      ', '.join(netifaces.interfaces()))
-                sys.exit(1)
-            title = 'Please choose the adapter you want to use: '
-            try:
-                adapter, index = pick(netifaces.interfaces(), title)
-            except curses.error as e:
-                print('Please check your $TERM settings: %s' % (e))
-                sys.exit(1)
+        adapter = choose_adapter(adapter)
 
         print("Using %s adapter and scanning for %s seconds..." %
               (adapter, scantime))
@@ -149,52 +202,31 @@ def scan(adapter, scantime, verbose, dictionary, number, nearby, jsonprint, out,
     else:
         dump_file = pcap
 
-    # Read tshark output
-    command = [
-        tshark, '-r',
-        dump_file, '-T',
-        'fields', '-e',
-        'wlan.sa', '-e',
-        'wlan.bssid', '-e',
-        'radiotap.dbm_antsignal'
-    ]
-    if verbose:
-        print(' '.join(command))
-    run_tshark = subprocess.Popen(
-        command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    output, nothing = run_tshark.communicate()
-
     # read target MAC address
     targetmacset = set()
     if targetmacs != '':
         targetmacset = fileToMacSet(targetmacs)
 
-    foundMacs = {}
-    for line in output.decode('utf-8').split('\n'):
-        if verbose:
-            print(line)
-        if line.strip() == '':
-            continue
-        mac = line.split()[0].strip().split(',')[0]
-        dats = line.split()
-        if len(dats) == 3:
-            if ':' not in dats[0] or len(dats) != 3:
-                continue
-            if mac not in foundMacs:
-                foundMacs[mac] = []
-            dats_2_split = dats[2].split(',')
-            if len(dats_2_split) > 1:
-                rssi = float(dats_2_split[0]) / 2 + float(dats_2_split[1]) / 2
-            else:
-                rssi = float(dats_2_split[0])
-            foundMacs[mac].append(rssi)
+    if replay_pcap:
+        foundMacs = replay_pcap(tshark, dump_file, verbose).averages()
+    else:
+        foundMacs = read_pcap(tshark, dump_file, verbose)
 
     if not foundMacs:
         print("Found no signals, are you sure %s supports monitor mode?" % adapter)
         sys.exit(1)
 
-    for key, value in foundMacs.items():
-        foundMacs[key] = float(sum(value)) / float(len(value))
+    results = report(foundMacs, oui, verbose, number, nearby, jsonprint, out,
+        allmacaddresses, manufacturers, nocorrection, sort, targetmacset)
+
+    if not pcap:
+        os.remove(dump_file)
+
+    return adapter, results
+
+
+def report(foundMacs, oui, verbose, number, nearby, jsonprint, out, allmacaddresses, manufacturers, nocorrection, sort, targetmacset):
+    """Counts the people around from the average RSSI of each MAC"""
 
     # Find target MAC address in foundMacs
     if targetmacset:
@@ -228,15 +260,13 @@ def scan(adapter, scantime, verbose, dictionary, number, nearby, jsonprint, out,
 
     cellphone_people = []
     for mac in foundMacs:
-        oui_id = 'Not in OUI'
-        if mac[:8] in oui:
-            oui_id = oui[mac[:8]]
+        oui_id = oui.get(mac, 'Not in OUI')
         if verbose:
             print(mac, oui_id, oui_id in cellphone)
         if allmacaddresses or oui_id in cellphone:
             if not nearby or (nearby and foundMacs[mac] > -70):
                 cellphone_people.append(
-                    {'company': oui_id, 'rssi': foundMacs[mac], 'mac': mac})
+                    {'company': oui_id, 'rssi': foundMacs[mac], 'mac': mac, 'random': is_local(mac)})
     if sort:
         cellphone_people.sort(key=lambda x: x['rssi'], reverse=True)
     if verbose:
@@ -267,21 +297,64 @@ def scan(adapter, scantime, verbose, dictionary, number, nearby, jsonprint, out,
             f.write(json.dumps(data_dump) + "\n")
         if verbose:
             print("Wrote %d records to %s" % (len(cellphone_people), out))
-    if not pcap:
-        os.remove(dump_file)
 
     results = {
         'records': cellphone_people,
         'time': int(time.time()),
         'serial': SERIAL,
     }
-    return adapter, results
+    return results
+
+
+def stream_scan(adapters, scantime, verbose, dictionary, number, nearby, jsonprint, out, allmacaddresses, manufacturers, nocorrection, sort, targetmacs, channels=None, dwell=0.5):
+    """Like scan(), but with one tshark writing to a pipe, yielding a result
+    for every scantime seconds. With several adapters or channels to hop
+    through, each adapter captures in its own process and a MAC's RSSI is
+    the strongest any adapter heard."""
+
+    oui = get_oui(dictionary)
+    tshark = get_tshark()
+
+    if jsonprint:
+        number = True
+    if number:
+        verbose = False
+
+    adapters = list(adapters) or [choose_adapter('')]
+    adapter = ', '.join(adapters)
+    print("Using %s adapter and streaming %s second scans..." %
+          (adapter, scantime))
+    if channels:
+        print("Hopping through channels %s every %s seconds..." %
+              (', '.join(str(c) for c in channels), dwell))
 
+    targetmacset = set()
+    if targetmacs != '':
+        targetmacset = fileToMacSet(targetmacs)
+
+    if len(adapters) == 1 and not channels:
+        windows = stream_windows(live_command(tshark, adapters[0]), float(scantime), verbose)
+    else:
+        captures = [(live_command(tshark, a), a, channels) for a in adapters]
+        windows = stream_merged(captures, float(scantime), dwell, verbose)
+
+    for foundMacs in windows:
+        if not foundMacs:
+            print("Found no signals, are you sure %s supports monitor mode?" % adapter)
+            sys.exit(1)
+
+        results = report(foundMacs, oui, verbose, number, nearby, jsonprint, out,
+            allmacaddresses, manufacturers, nocorrection, sort, targetmacset)
+        yield adapter, results
 
 
 @click.command()
-@click.option('-a', '--adapter', default='', help='adapter to use')
-def main(adapter):
+@click.option('-a', '--adapter', 'adapters', multiple=True, help='adapter to use, can be repeated to capture on several at once')
+@click.option('--channels', default='', help='channels to hop through when streaming, like 1,6,11')
+@click.option('--dwell', default=0.5, help='seconds on each channel when hopping')
+@click.option('--capture', is_flag=True, help='capture to a file then parse it, instead of streaming')
+@click.option('--pcap', multiple=True, help='queue scans of capture files instead, can be repeated')
+def main(adapters, channels, dwell, capture, pcap):
     scantime = '60'
     verbose = False
     dictionary = 'oui.txt'
@@ -294,21 +367,53 @@ def main(adapter):
     nocorrection = True
     sort = False
     targetmacs = ''
-    pcap = ''
 
-    while True:
-        adapter, results = scan(adapter, scantime, verbose, dictionary, number,
+    # capturing to a file and replaying use the first adapter only
+    adapter = adapters[0] if adapters else ''
+    channels = [int(c) for c in channels.split(',') if c.strip()]
+
+    # scans are kept on disk until the server takes them, and sent from
+    # another thread so capturing never waits on the network. The outbox is
+    # in the working directory like oui.txt, not next to the installed package.
+    path = os.environ.get('OUTBOX_PATH', 'outbox.db')
+    if BATCH:
+        outbox = Outbox(path=path, batch=BATCH, combine=True)
+    else:
+        outbox = Outbox(path=path)
+
+    if pcap:
+        # backfill from capture files, timed when each was written. They're
+        # sent by the next scanner to run from this directory.
+        for path in pcap:
+            adapter, results = scan(adapter, scantime, verbose, dictionary, number,
+                 nearby, jsonprint, out, allmacaddresses, manufacturers,
+                 nocorrection, sort, targetmacs, path)
+            results['time'] = int(os.path.getmtime(path))
+            outbox.put(IOT_URL, results)
+        print('Queued %d scans.' % len(pcap))
+        return
+
+    outbox.start_thread()
+
+    def capture_scans(adapter):
+        while True:
+            adapter, results = scan(adapter, scantime, verbose, dictionary, number,
+                 nearby, jsonprint, out, allmacaddresses, manufacturers,
+                 nocorrection, sort, targetmacs, '')
+            yield adapter, results
+
+    if capture:
+        scans = capture_scans(adapter)
+    else:
+        scans = stream_scan(adapters, scantime, verbose, dictionary, number,
              nearby, jsonprint, out, allmacaddresses, manufacturers,
-             nocorrection, sort, targetmacs, pcap)
-        SEND_BUFFER.append(results)
+             nocorrection, sort, targetmacs, channels, dwell)
 
+    for adapter, results in scans:
         try:
-            while len(SEND_BUFFER):
-                r = requests.post(IOT_URL, json=SEND_BUFFER[0], timeout=5)
-                r.raise_for_status()
-                SEND_BUFFER.pop(0)
+            outbox.put(IOT_URL, results)
         except:
-            logging.exception('Problem sending to server:')
+            logging.exception('Problem queueing scan for server:')
 
 
 if __name__ == '__main__':
@@ -1,24 +1,198 @@
+import os
+import sys
+import mmap
+import struct
+from array import array
+from bisect import bisect_left
+
 try: #python3
     from urllib.request import urlopen
 except: #python2
     from urllib2 import urlopen
 
 
-def load_dictionary(file):
-    oui = {}
-    with open(file, 'r') as f:
+URIS = [
+    'http://standards-oui.ieee.org/oui/oui.txt',        # MA-L, 24 bit prefixes
+    'http://standards-oui.ieee.org/oui28/mam.txt',      # MA-M, 28 bit
+    'http://standards-oui.ieee.org/oui36/oui36.txt',    # MA-S, 36 bit
+]
+
+# prefix lengths in the index, longest first so the longest match wins
+BITS = (36, 28, 24)
+
+# the index is written in native byte order, so the magic says which
+MAGIC = b'OUIIDX1' + sys.byteorder[0].encode()
+HEADER = struct.Struct('=8sqq3I4x')
+
+
+def parse_source(file):
+    """Returns {(bits, prefix): company} from IEEE registry text files"""
+    entries = {}
+    pending = None
+
+    with open(file, 'r', encoding='utf-8', errors='replace') as f:
         for line in f:
             if '(hex)' in line:
+                if pending:
+                    entries[(24, pending[0])] = pending[1]
                 data = line.split('(hex)')
-                key = data[0].replace('-', ':').lower().strip()
-                company = data[1].strip()
-                oui[key] = company
-    return oui
+                try:
+                    pending = int(data[0].replace('-', '').strip(), 16), data[1].strip()
+                except ValueError:
+                    pending = None
+            elif '(base 16)' in line and pending:
+                # MA-M and MA-S give the block within the MA-L prefix as a
+                # range like C00000-CFFFFF, MA-L just repeats the prefix
+                block = line.split('(base 16)')[0].strip()
+                prefix, company = pending
+                pending = None
+                if '-' not in block:
+                    entries[(24, prefix)] = company
+                    continue
+                try:
+                    start, end = (int(x, 16) for x in block.split('-'))
+                except ValueError:
+                    continue
+                size = (end - start + 1).bit_length() - 1
+                bits = 48 - size
+                if bits in BITS:
+                    entries[(bits, prefix << (bits - 24) | start >> size)] = company
+
+    if pending:
+        entries[(24, pending[0])] = pending[1]
+    return entries
+
+
+def build_index(file, index_file):
+    """Writes a binary index of file: a header, a sorted array of prefixes
+    for each prefix length, name offsets, then the names"""
+    stat = os.stat(file)
+    entries = parse_source(file)
+
+    tables = []
+    for bits in BITS:
+        tables.append(sorted((prefix, company) for (b, prefix), company in entries.items() if b == bits))
+
+    keys = b''
+    offsets = array('I', [0])
+    names = []
+    for table in tables:
+        keys += array('Q', [prefix for prefix, company in table]).tobytes()
+        for prefix, company in table:
+            names.append(company.encode('utf-8'))
+            offsets.append(offsets[-1] + len(names[-1]))
+
+    tmp = index_file + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, stat.st_size, stat.st_mtime_ns, *[len(table) for table in tables]))
+        f.write(keys)
+        f.write(offsets.tobytes())
+        f.write(b''.join(names))
+    os.replace(tmp, index_file)
+
+
+class OuiIndex:
+    """Longest prefix lookup of the company that owns a MAC, straight out
+    of a memory mapped index built by build_index()"""
+
+    def __init__(self, index_file):
+        with open(index_file, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.size, self.mtime, *counts = HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise ValueError('not an OUI index: %s' % index_file)
+
+        view = memoryview(self.mm)
+        pos = HEADER.size
+        base = 0
+        self.tables = []
+        for bits, count in zip(BITS, counts):
+            self.tables.append((bits, view[pos:pos + count * 8].cast('Q'), base))
+            pos += count * 8
+            base += count
+
+        self.offsets = view[pos:pos + (base + 1) * 4].cast('I')
+        self.names = pos + (base + 1) * 4
+        self.count = base
+
+    def matches(self, stat):
+        return self.size == stat.st_size and self.mtime == stat.st_mtime_ns
+
+    def get(self, mac, default=None):
+        # takes a whole MAC or a prefix of one, like aa:bb:cc
+        digits = mac.replace(':', '').replace('-', '')[:12]
+        try:
+            value = int(digits, 16) << (48 - len(digits) * 4)
+        except ValueError:
+            return default
+
+        for bits, keys, base in self.tables:
+            if bits > len(digits) * 4:
+                continue
+            key = value >> (48 - bits)
+            i = bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key:
+                start = self.names + self.offsets[base + i]
+                end = self.names + self.offsets[base + i + 1]
+                return self.mm[start:end].decode('utf-8')
+        return default
+
+    def __getitem__(self, mac):
+        company = self.get(mac)
+        if company is None:
+            raise KeyError(mac)
+        return company
+
+    def __contains__(self, mac):
+        return self.get(mac) is not None
+
+    def __len__(self):
+        return self.count
+
+
+_indexes = {}
+
+def load_index(file):
+    """Returns the OuiIndex for file, only rebuilding the index next to it
+    when file has changed. Indexes are kept for the life of the process."""
+    stat = os.stat(file)
+    index = _indexes.get(file)
+    if index and index.matches(stat):
+        return index
+
+    index_file = file + '.idx'
+    try:
+        index = OuiIndex(index_file)
+        if not index.matches(stat):
+            index = None
+    except (OSError, ValueError, struct.error):
+        index = None
+
+    if not index:
+        build_index(file, index_file)
+        index = OuiIndex(index_file)
+
+    _indexes[file] = index
+    return index
+
+# older name, the index looks up like the dict it used to return
+load_dictionary = load_index
+
+
+def is_local(mac):
+    # locally administered, which is what phones use for randomized MACs
+    try:
+        return bool(int(mac[:2], 16) & 0x02)
+    except ValueError:
+        return False
 
 
 def download_oui(to_file):
-    uri = 'http://standards-oui.ieee.org/oui/oui.txt'
-    print("Trying to download current version of oui.txt from [%s] to file [%s]" % (uri, to_file))
-    oui_data = urlopen(uri, timeout=10).read()
-    with open(to_file, 'wb') as oui_file:
-        oui_file.write(oui_data)
+    # all three registries go in one file, so there's one file to check for changes
+    tmp = to_file + '.tmp'
+    with open(tmp, 'wb') as oui_file:
+        for uri in URIS:
+            print("Trying to download current version of %s from [%s] to file [%s]" % (uri.split('/')[-1], uri, to_file))
+            oui_file.write(urlopen(uri, timeout=10).read())
+    os.replace(tmp, to_file)
@@ -0,0 +1,12 @@
+# The scanner queues scans in the bridges' outbox, common/outbox.py, so
+# there's one copy of it. setup.py installs the repo's common directory as
+# wifi_scanner.common, and running from a checkout imports it from the repo
+# root the way the bridges do.
+
+import os, sys
+
+try:
+    from wifi_scanner.common.outbox import Outbox
+except ImportError:
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+    from common.outbox import Outbox
@@ -0,0 +1,202 @@
+"""Fast offline parsing of tshark field output, for replaying archived pcaps.
+
+Needs NumPy, install with  pip install .[replay]
+
+Output is read in large chunks and each chunk is parsed as one byte array:
+MACs are decoded into 48 bit integers and RSSI columns into floats without
+splitting lines in Python. Per-MAC RSSI sums and counts are kept in arrays
+sorted by MAC, which is all scan() needs for the averages. Lines that don't fit the usual layout go through
+parse_line() instead, so results match scan().
+"""
+
+import subprocess
+
+import numpy as np
+
+from wifi_scanner.stream import FIELDS, parse_line
+
+
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# bytes of each line looked at, enough for the MAC, bssid and two RSSIs
+WIDTH = 48
+
+HEX_VALUES = np.full(256, 255, dtype=np.uint8)
+for i, c in enumerate(b'0123456789abcdef'):
+    HEX_VALUES[c] = i
+for i, c in enumerate(b'ABCDEF'):
+    HEX_VALUES[c] = 10 + i
+
+TAB = ord('\t')
+NEWLINE = ord('\n')
+COLON = ord(':')
+COMMA = ord(',')
+MINUS = ord('-')
+ZERO = ord('0')
+
+
+def mac_to_int(mac):
+    return int(mac.replace(':', ''), 16)
+
+def int_to_mac(value):
+    digits = '%012x' % value
+    return ':'.join(digits[i:i+2] for i in range(0, 12, 2))
+
+
+class MacAccumulator:
+    """Per-MAC RSSI sum and count in arrays sorted by MAC"""
+
+    def __init__(self):
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.sums = np.empty(0)
+        self.counts = np.empty(0, dtype=np.int64)
+
+    def add(self, macs, rssi):
+        if not len(macs):
+            return
+
+        keys, inverse = np.unique(macs, return_inverse=True)
+        sums = np.bincount(inverse, weights=rssi, minlength=len(keys))
+        counts = np.bincount(inverse, minlength=len(keys))
+
+        self.merge(keys, sums, counts)
+
+    def merge(self, keys, sums, counts):
+        all_keys = np.union1d(self.keys, keys)
+        old = np.searchsorted(all_keys, self.keys)
+        new = np.searchsorted(all_keys, keys)
+
+        merged_sums = np.zeros(len(all_keys))
+        merged_counts = np.zeros(len(all_keys), dtype=np.int64)
+
+        for index, s, c in [(old, self.sums, self.counts), (new, sums, counts)]:
+            merged_sums[index] += s
+            merged_counts[index] += c
+
+        self.keys = all_keys
+        self.sums = merged_sums
+        self.counts = merged_counts
+
+    def averages(self):
+        means = self.sums / self.counts
+        return {int_to_mac(int(key)): float(mean) for key, mean in zip(self.keys, means)}
+
+
+def parse_number(window):
+    """Parses an integer of up to 3 digits with an optional minus sign at
+    the start of each row of window, which is 5 bytes wide. Returns values,
+    lengths and which were valid."""
+    negative = window[:, 0] == MINUS
+    digits = np.where(negative[:, None], window[:, 1:5], window[:, 0:4]).astype(np.int16) - ZERO
+    isdigit = (digits >= 0) & (digits <= 9)
+
+    one = isdigit[:, 0]
+    two = one & isdigit[:, 1]
+    three = two & isdigit[:, 2]
+    valid = one & ~(three & isdigit[:, 3])   # 4 or more digits isn't an RSSI
+
+    value = np.where(three, digits[:, 0] * 100 + digits[:, 1] * 10 + digits[:, 2],
+        np.where(two, digits[:, 0] * 10 + digits[:, 1], digits[:, 0]))
+    value = np.where(negative, -value, value)
+    length = negative.astype(np.int64) + one + two + three
+    return value, length, valid
+
+
+def parse_chunk(chunk, accumulator):
+    """Adds every complete line in chunk to accumulator"""
+    buf = np.frombuffer(chunk + b'\0' * WIDTH, dtype=np.uint8)
+    ends = np.flatnonzero(buf[:len(chunk)] == NEWLINE)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+
+    # lines without a source address are skipped by parse_line() too
+    has_sa = (ends - starts >= 18) & (buf[starts] != TAB)
+    starts = starts[has_sa]
+    ends = ends[has_sa]
+
+    # the start of every line as a row, copied out in one go
+    lines = np.lib.stride_tricks.as_strided(buf, shape=(len(chunk), WIDTH), strides=(1, 1))
+    block = lines[starts]
+
+    # aa:bb:cc:dd:ee:ff and the tab after it is 6 groups of hex, hex, separator
+    groups = block[:, :18].reshape(-1, 6, 3)
+    high = HEX_VALUES[groups[:, :, 0]]
+    low = HEX_VALUES[groups[:, :, 1]]
+    fits = ((high != 255).all(axis=1) & (low != 255).all(axis=1)
+        & (groups[:, :5, 2] == COLON).all(axis=1) & (groups[:, 5, 2] == TAB))
+
+    # the bssid is another MAC, RSSI starts after it
+    fits &= (block[:, 35] == TAB) & (block[:, 20] == COLON)
+
+    # lines missing the bssid or RSSI have too few fields for parse_line()
+    empty = (block[:, 18] == TAB) | (block[:, 18] == NEWLINE) | (block[:, 36] == NEWLINE)
+
+    first, length, valid = parse_number(block[:, 36:41])
+    fits &= valid
+    end = 36 + length
+
+    # two antennas are averaged like parse_line() does, any more are ignored
+    numbers = np.lib.stride_tricks.as_strided(buf, shape=(len(chunk) + WIDTH - 6, 6), strides=(1, 1))
+    after_first = numbers[starts + end]
+    two = after_first[:, 0] == COMMA
+    second, length2, valid2 = parse_number(after_first[:, 1:6])
+    after_second = numbers[starts + end + 1 + length2][:, 0]
+    fits &= np.where(two, valid2 & ((after_second == NEWLINE) | (after_second == COMMA)), after_first[:, 0] == NEWLINE)
+    rssi = np.where(two, first / 2 + second / 2, first.astype(float))
+
+    # pack the 6 bytes of each MAC into a big endian 64 bit integer
+    packed = np.zeros((fits.sum(), 8), dtype=np.uint8)
+    packed[:, 2:] = (high[fits] << 4) | low[fits]
+    macs = packed.view('>u8').ravel().astype(np.uint64)
+    accumulator.add(macs, rssi[fits])
+
+    # anything unusual, like decimal RSSI or several source addresses
+    others = []
+    unusual = ~fits & ~empty
+    for line_start, line_end in zip(starts[unusual], ends[unusual]):
+        found = parse_line(chunk[line_start:line_end].decode('utf-8', 'replace'))
+        if not found:
+            continue
+        try:
+            others.append((mac_to_int(found[0]), found[1]))
+        except ValueError:
+            pass   # not a MAC address
+    if others:
+        accumulator.add(np.array([m for m, r in others], dtype=np.uint64), np.array([r for m, r in others]))
+
+
+def replay_fields(stream, chunk_size=CHUNK_SIZE):
+    """Parses tshark field output from a binary file object, returns a
+    MacAccumulator"""
+    accumulator = MacAccumulator()
+    partial = b''
+
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+
+        chunk = partial + chunk
+        cut = chunk.rfind(b'\n') + 1
+        partial = chunk[cut:]
+        parse_chunk(chunk[:cut], accumulator)
+
+    if partial:
+        parse_chunk(partial + b'\n', accumulator)
+
+    return accumulator
+
+
+def replay_pcap(tshark, pcap, verbose=False):
+    """Runs tshark over a pcap file and parses its output"""
+    command = [tshark, '-r', pcap, '-T', 'fields']
+    for field in FIELDS:
+        command += ['-e', field]
+    if verbose:
+        print(' '.join(command))
+
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        return replay_fields(proc.stdout)
+    finally:
+        proc.stdout.close()
+        proc.wait()
@@ -0,0 +1,210 @@
+import os
+import sys
+import time
+import queue
+import signal
+import logging
+import select
+import threading
+import subprocess
+import multiprocessing
+
+
+FIELDS = ['wlan.sa', 'wlan.bssid', 'radiotap.dbm_antsignal']
+
+
+def parse_line(line):
+    """Returns (mac, rssi) from a line of tshark fields, or None"""
+    dats = line.split()
+    if len(dats) != 3 or ':' not in dats[0]:
+        return None
+    mac = dats[0].strip().split(',')[0]
+    dats_2_split = dats[2].split(',')
+    try:
+        if len(dats_2_split) > 1:
+            rssi = float(dats_2_split[0]) / 2 + float(dats_2_split[1]) / 2
+        else:
+            rssi = float(dats_2_split[0])
+    except ValueError:
+        return None
+    return mac, rssi
+
+
+class RssiWindow:
+    """Running RSSI sum and count per MAC, so memory depends on the number
+    of devices seen and not the number of packets"""
+
+    def __init__(self):
+        self.sums = {}
+        self.counts = {}
+
+    def add(self, mac, rssi):
+        if mac in self.sums:
+            self.sums[mac] += rssi
+            self.counts[mac] += 1
+        else:
+            self.sums[mac] = rssi
+            self.counts[mac] = 1
+
+    def averages(self):
+        return {mac: self.sums[mac] / self.counts[mac] for mac in self.sums}
+
+
+def live_command(tshark, adapter):
+    # -l flushes each packet to the pipe as it's captured
+    command = [tshark, '-I', '-i', adapter, '-l', '-T', 'fields']
+    for field in FIELDS:
+        command += ['-e', field]
+    return command
+
+
+def stream_windows(command, window, verbose=False, start=None):
+    """Runs one tshark for good and yields {mac: average rssi} for every
+    window seconds of packets. Windows are back to back, so no packets are
+    missed between them, and nothing is written to disk. Windows are timed
+    from start, a time.monotonic(), if given."""
+
+    if verbose:
+        print(' '.join(command))
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    fd = proc.stdout.fileno()
+
+    current = RssiWindow()
+    partial = b''
+    deadline = (start or time.monotonic()) + window
+
+    try:
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                yield current.averages()
+                current = RssiWindow()
+                deadline += window
+                continue
+
+            # wait for output or the end of the window, whichever is first
+            ready, _, _ = select.select([fd], [], [], timeout)
+            if not ready:
+                continue
+
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise RuntimeError('tshark exited with code %s' % proc.wait())
+
+            lines = (partial + chunk).split(b'\n')
+            partial = lines.pop()
+
+            for line in lines:
+                line = line.decode('utf-8', 'replace')
+                if verbose:
+                    print(line)
+                found = parse_line(line)
+                if found:
+                    current.add(*found)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def hop_channels(adapter, channels, dwell):
+    """Tunes adapter to each channel in turn, dwell seconds on each"""
+    last_error = None
+    while True:
+        for channel in channels:
+            try:
+                result = subprocess.run(['iw', 'dev', adapter, 'set', 'channel', str(channel)],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            except OSError as e:
+                logging.error('Can\'t hop channels on %s, staying on one: %s', adapter, e)
+                return
+
+            # the same failure would repeat every dwell, log it once
+            error = result.stderr.decode('utf-8', 'replace').strip() if result.returncode else None
+            if error is not None and error != last_error:
+                logging.error('iw failed to set %s to channel %s with code %s: %s',
+                    adapter, channel, result.returncode, error)
+            last_error = error
+            time.sleep(dwell)
+
+
+def capture_worker(command, adapter, channels, dwell, window, start, results, verbose):
+    # one process per adapter, so each one's parsing gets its own CPU
+
+    # terminate() should stop tshark too, through stream_windows' finally
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    if channels:
+        threading.Thread(target=hop_channels, args=(adapter, channels, dwell), daemon=True).start()
+
+    try:
+        for number, averages in enumerate(stream_windows(command, window, verbose, start)):
+            results.put((number, adapter, averages))
+    except Exception as e:
+        results.put((None, adapter, str(e)))
+
+
+def merge_best(tables):
+    """Merges {mac: rssi} tables keeping the strongest RSSI of each MAC"""
+    best = {}
+    for table in tables:
+        for mac, rssi in table.items():
+            if mac not in best or rssi > best[mac]:
+                best[mac] = rssi
+    return best
+
+
+def check_workers(workers, captures, results):
+    """Raises if a capture worker has stopped. One killed by a signal or the
+    OOM killer never reports an error of its own."""
+    for worker, (command, adapter, channels) in zip(workers, captures):
+        if worker.is_alive():
+            continue
+
+        # it may have reported why before exiting
+        try:
+            while True:
+                number, reported, error = results.get(timeout=0.1)
+                if number is None:
+                    raise RuntimeError('capture on %s failed: %s' % (reported, error))
+        except queue.Empty:
+            pass
+        raise RuntimeError('capture on %s died with exit code %s' % (adapter, worker.exitcode))
+
+
+def stream_merged(captures, window, dwell=0.5, verbose=False):
+    """Like stream_windows() for several adapters at once. captures is a
+    list of (command, adapter, channels), with channels to hop through or
+    None. Yields one table per window, merged with merge_best()."""
+
+    results = multiprocessing.Queue()
+    start = time.monotonic()
+    workers = []
+    for command, adapter, channels in captures:
+        worker = multiprocessing.Process(target=capture_worker,
+            args=(command, adapter, channels, dwell, window, start, results, verbose), daemon=True)
+        worker.start()
+        workers.append(worker)
+
+    pending = {}   # window number -> tables received so far
+    try:
+        while True:
+            try:
+                number, adapter, averages = results.get(timeout=window)
+            except queue.Empty:
+                check_workers(workers, captures, results)
+                continue
+
+            if number is None:
+                raise RuntimeError('capture on %s failed: %s' % (adapter, averages))
+
+            # the other workers' windows keep arriving when one is killed
+            check_workers(workers, captures, results)
+
+            pending.setdefault(number, []).append(averages)
+            if len(pending[number]) == len(workers):
+                yield merge_best(pending.pop(number))
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
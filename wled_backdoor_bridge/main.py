@@ -9,7 +9,6 @@ import time
 import json
 
 import asyncio
-import aiohttp
 from aiomqtt import Client, TLSParameters
 
 
@@ -19,28 +18,30 @@ tls_params = TLSParameters(
     
 import secrets
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import http_client
+
 
 async def sign_send():
-    async with aiohttp.ClientSession() as session:
-        preset = {
-            'playlist': {
-                'ps': [3],
-                'dur': [3],
-                'repeat': 1,
-                'end': 1
-            }
+    preset = {
+        'playlist': {
+            'ps': [3],
+            'dur': [3],
+            'repeat': 1,
+            'end': 1
         }
-
-        logging.info('Sending to sign...')
-        logging.debug('JSON data:\n%s', json.dumps(preset, indent=4))
-
-        try:
-            url = 'http://172.17.18.181/json'
-            #url = 'http://wled-ps108sign.local/json'
-            await session.post(url, json=preset, timeout=10)
-        except BaseException as e:
-            logging.error('Problem sending json to sign %s:', url)
-            logging.exception(e)
+    }
+
+    logging.info('Sending to sign...')
+    logging.debug('JSON data:\n%s', json.dumps(preset, indent=4))
+
+    try:
+        url = 'http://172.17.18.181/json'
+        #url = 'http://wled-ps108sign.local/json'
+        await http_client.post(url, json=preset)
+    except BaseException as e:
+        logging.error('Problem sending json to sign %s:', url)
+        logging.exception(e)
 
 
 async def process_mqtt(message):